@@ -0,0 +1,286 @@
+"""
+検索用のJSON API（標準ライブラリの http.server だけで動く）。
+
+    python api_server.py --data-dir data --port 8000
+
+データディレクトリを年度パーティションのストア（partition_store）としてメモリに持ち、
+次のエンドポイントを返す。検索結果はアプリと同じ共有キャッシュ（query_cache）を通す。
+
+- GET /search   検索結果の1ページ分をJSONで返す
+    列名=クエリ        その列を mode で検索（年度の列で範囲として読めるものは mode='range'）
+    filter=列名:mode:クエリ  列ごとにモードを指定する（繰り返し可）
+    mode=contains|startswith|regex|exact|range（既定 contains）、combine=AND|OR
+    page（1始まり）、page_size（既定 DEFAULT_PAGE_SIZE、最大 MAX_PAGE_SIZE）
+- GET /suggest  ?column=列名&q=入力&k=件数&infix=1 で入力候補を返す
+- GET /export   /search と同じ条件の全件をCSV（utf-8-sig）で返す
+
+応答は Accept-Encoding に gzip があれば圧縮する。ETag はデータバージョンとクエリから作るので、
+データが変わらない限り If-None-Match の再検証は検索せずに 304 を返す。
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import math
+import re
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlsplit, parse_qsl
+from kakodata_utils import parse_year_range, MULTI_VALUE_COLUMNS, MULTI_VALUE_SEP
+from ingest import report_problems
+from partition_store import open_store
+from query_cache import shared_cache
+from highlight import page_count
+from suggest import Suggester, DEFAULT_K
+
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+MAX_SUGGEST_K = 50
+MODES = ('contains', 'startswith', 'regex', 'exact', 'range')
+# これより小さい応答は圧縮しない
+GZIP_MIN_BYTES = 512
+# フィルタ以外のクエリパラメータ
+_RESERVED = {'filter', 'mode', 'combine', 'page', 'page_size'}
+
+
+class BadRequest(ValueError):
+    """クエリパラメータが正しくない（400 を返す）。"""
+
+
+def _int_param(params: dict, name: str, default: int, lo: int, hi: int = None) -> int:
+    raw = params.get(name)
+    if raw is None or raw == '':
+        return default
+    try:
+        value = int(raw)
+    except ValueError:
+        raise BadRequest(f"{name} must be an integer: {raw!r}")
+    if value < lo or (hi is not None and value > hi):
+        raise BadRequest(f"{name} out of range: {value}")
+    return value
+
+
+def _json_value(v):
+    if v is None or (isinstance(v, float) and math.isnan(v)):
+        return None
+    if hasattr(v, 'item'):  # numpy のスカラー
+        return _json_value(v.item())
+    return v
+
+
+class SearchService:
+    """HTTPに依存しない部分。クエリパラメータ [(名前, 値)] を受け取り、(ステータス, ヘッダ, 本文) を返す。"""
+
+    def __init__(self, data_dir: str, cache=shared_cache):
+        self.data_dir = data_dir
+        self.cache = cache
+        self._suggester = None
+        self._suggester_version = None
+        self._lock = threading.Lock()
+
+    def store(self):
+        # 呼ぶたびにファイルの変更を反映する（変更がなければ stat だけ）
+        return open_store(self.data_dir)
+
+    def filters(self, store, pairs: list) -> tuple:
+        """クエリパラメータから (filters, combine, mode) を作る。"""
+        params = dict(pairs)
+        mode = params.get('mode') or 'contains'
+        if mode not in MODES:
+            raise BadRequest(f"unknown mode: {mode!r}")
+        combine = (params.get('combine') or 'AND').upper()
+        if combine not in ('AND', 'OR'):
+            raise BadRequest(f"combine must be AND or OR: {combine!r}")
+        filters = []
+        for name, value in pairs:
+            if name == 'filter':
+                col, sep1, rest = value.partition(':')
+                fmode, sep2, q = rest.partition(':')
+                if not sep2 or fmode not in MODES:
+                    raise BadRequest(f"filter must be column:mode:query: {value!r}")
+                filters.append((col, q, fmode))
+            elif name not in _RESERVED:
+                if name not in store.columns:
+                    raise BadRequest(f"unknown column: {name!r}")
+                fmode = mode
+                if name == store.year_col and mode in ('contains', 'exact') and parse_year_range(value) is not None:
+                    fmode = 'range'
+                filters.append((name, value, fmode))
+        for col, q, fmode in filters:
+            if col not in store.columns:
+                raise BadRequest(f"unknown column: {col!r}")
+            if fmode == 'regex':
+                try:
+                    re.compile(q)
+                except re.error as e:
+                    raise BadRequest(f"invalid regex {q!r}: {e}")
+        return filters, combine, mode
+
+    def suggester(self, store) -> Suggester:
+        """データバージョンごとに1回だけ入力候補を作る。"""
+        with self._lock:
+            if self._suggester is None or self._suggester_version != store.version:
+                columns = {c: MULTI_VALUE_SEP if c in MULTI_VALUE_COLUMNS else None
+                           for c in store.columns if c != store.year_col}
+                self._suggester = Suggester.from_counts({c: store.value_counts(c) for c in columns}, columns)
+                self._suggester_version = store.version
+            return self._suggester
+
+    @staticmethod
+    def etag(version: str, path: str, pairs: list) -> str:
+        key = json.dumps([version, path, sorted(pairs)], ensure_ascii=False)
+        return '"' + hashlib.sha1(key.encode('utf-8')).hexdigest()[:20] + '"'
+
+    def handle(self, path: str, pairs: list, if_none_match: str = None) -> tuple:
+        if path not in ('/search', '/suggest', '/export'):
+            return 404, {}, _json_body({'error': f"not found: {path}"})
+        store = self.store()
+        etag = self.etag(store.version, path, pairs)
+        headers = {'ETag': etag, 'Cache-Control': 'no-cache'}
+        if if_none_match and _etag_matches(if_none_match, etag):
+            return 304, headers, b''
+        try:
+            if path == '/suggest':
+                body = self._suggest(store, dict(pairs))
+            elif path == '/search':
+                body = self._search(store, pairs)
+            else:
+                filters, combine, mode = self.filters(store, pairs)
+                cached = self.cache.search_store(store, filters, combine=combine, match_mode=mode)
+                headers['Content-Type'] = 'text/csv; charset=utf-8'
+                headers['Content-Disposition'] = 'attachment; filename="search_results.csv"'
+                return 200, headers, cached.csv_bytes
+        except BadRequest as e:
+            return 400, {}, _json_body({'error': str(e)})
+        return 200, headers, _json_body(body)
+
+    def _search(self, store, pairs: list) -> dict:
+        params = dict(pairs)
+        filters, combine, mode = self.filters(store, pairs)
+        page_size = _int_param(params, 'page_size', DEFAULT_PAGE_SIZE, 1, MAX_PAGE_SIZE)
+        page = _int_param(params, 'page', 1, 1)
+        cached = self.cache.search_store(store, filters, combine=combine, match_mode=mode)
+        # 返すページの行だけを取り出す（コンパクトモードでは共有フレームから）
+        frame = cached.page((page - 1) * page_size, page_size)
+        rows = frame.astype(object).values.tolist()
+        return {
+            'version': store.version,
+            'total': cached.total,
+            'page': page,
+            'page_size': page_size,
+            'pages': page_count(cached.total, page_size),
+            'columns': list(frame.columns),
+            'rows': [[_json_value(v) for v in row] for row in rows],
+        }
+
+    def _suggest(self, store, params: dict) -> dict:
+        column = params.get('column', '')
+        if column not in store.columns:
+            raise BadRequest(f"unknown column: {column!r}")
+        k = _int_param(params, 'k', DEFAULT_K, 1, MAX_SUGGEST_K)
+        infix = params.get('infix', '') not in ('', '0', 'false')
+        hits = self.suggester(store).suggest(column, params.get('q', ''), k=k, infix=infix)
+        return {
+            'version': store.version,
+            'column': column,
+            'suggestions': [{'value': v, 'count': n} for v, n in hits],
+        }
+
+
+def _json_body(obj) -> bytes:
+    return json.dumps(obj, ensure_ascii=False).encode('utf-8')
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    tags = [t.strip() for t in header.split(',')]
+    # 弱いETagとの比較（W/ を無視する）
+    return '*' in tags or any(t.removeprefix('W/') == etag for t in tags)
+
+
+def _accepts_gzip(header: str) -> bool:
+    for part in (header or '').split(','):
+        name, _, params = part.strip().partition(';')
+        if name.strip().lower() in ('gzip', '*'):
+            return params.replace(' ', '') not in ('q=0', 'q=0.0', 'q=0.00', 'q=0.000')
+    return False
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    server_version = 'KakomonAPI/1.0'
+    # server.service に SearchService を持たせる
+
+    def do_OPTIONS(self):
+        self.send_response(204)
+        self._cors()
+        self.send_header('Access-Control-Allow-Methods', 'GET, OPTIONS')
+        self.send_header('Access-Control-Allow-Headers', 'If-None-Match')
+        self.send_header('Access-Control-Max-Age', '86400')
+        self.end_headers()
+
+    def do_GET(self):
+        url = urlsplit(self.path)
+        pairs = parse_qsl(url.query, keep_blank_values=True)
+        status, headers, body = self.server.service.handle(url.path, pairs, self.headers.get('If-None-Match'))
+        headers.setdefault('Content-Type', 'application/json; charset=utf-8')
+        headers['Vary'] = 'Accept-Encoding'
+        if status != 304 and len(body) >= GZIP_MIN_BYTES and _accepts_gzip(self.headers.get('Accept-Encoding')):
+            body = gzip.compress(body, compresslevel=6)
+            headers['Content-Encoding'] = 'gzip'
+        self.send_response(status)
+        self._cors()
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if status != 304:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if status != 304:
+            self.wfile.write(body)
+
+    def _cors(self):
+        # 静的ページ（index.html）から別オリジンで呼べるようにする
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.send_header('Access-Control-Expose-Headers', 'ETag')
+
+    def log_message(self, format, *args):
+        if not self.server.quiet:
+            super().log_message(format, *args)
+
+
+def make_server(data_dir: str, host: str = '127.0.0.1', port: int = 8000, quiet: bool = False) -> ThreadingHTTPServer:
+    """API サーバを作る（serve_forever() で開始）。port=0 なら空いているポートを使う。"""
+    if not Path(data_dir).is_dir():
+        raise FileNotFoundError(f"Directory not found: {data_dir}")
+    server = ThreadingHTTPServer((host, port), ApiHandler)
+    server.service = SearchService(data_dir)
+    server.quiet = quiet
+    return server
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='過去問検索のJSON API')
+    parser.add_argument('--data-dir', default='data')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--quiet', action='store_true', help='アクセスログを出さない')
+    args = parser.parse_args(argv)
+    server = make_server(args.data_dir, args.host, args.port, args.quiet)
+    # 最初のリクエストを待たせないよう、起動時に全パーティションを読み込んでおく
+    store = server.service.store()
+    store.frame()
+    for line in report_problems(store.reports):
+        print(line, file=sys.stderr)
+    print(f"Serving {args.data_dir} on http://{args.host}:{server.server_address[1]}", file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,17 +4,26 @@ Streamlit App: Partial match search on two columns of a CSV and a form to add ro
 Expected CSV: Has arbitrary columns, but the app automatically detects them to generate a form.
 The default CSV path can be set to a user-specified path.
 """
+import threading
 import streamlit as st
 import pandas as pd
 from pathlib import Path
-from kakodata_utils import load_csv, load_csvs_from_dir, search_df
-import re # ハイライト表示のために正規表現ライブラリをインポート
-from html import escape # HTMLエスケープのためにインポート
+from kakodata_utils import search_df, parse_year_range, compact_columns, compact_default, latest_positions
+from partition_store import open_store
+from ingest import ingest_files
+from highlight import render_table_html, page_count
+from normalize import add_normalized_columns
+from query_cache import shared_cache, uncached_result
+from suggest import Suggester, TEACHER_SEP
+import instrument
+from instrument import span
 
 # --- 設定 ---
 # リポジトリのルートからの相対パスとして 'data' ディレクトリを参照します。
 # これにより、ローカル環境でもデプロイ環境でも同様に動作します。
 REPO_DATA_DIR = Path('data')
+# 入力候補の表示件数
+SUGGEST_K = 5
 
 st.set_page_config(page_title="過去問検索", layout="wide")
 st.title("過去問検索ツール")
@@ -45,14 +54,45 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 
+def show_reports(reports):
+    """ファイルごとの取り込み結果（ingest.FileReport）のうち、読めなかったファイルと除いた行を知らせる。"""
+    for r in reports:
+        if not r.ok:
+            st.error(f"{r.name} の読み込み中にエラーが発生しました: {r.error}")
+        elif r.rows_rejected:
+            st.warning(f"{r.name}: 年度が数値でない {r.rows_rejected} 行を除きました（全{r.rows_read}行）")
+
+
+@st.cache_resource
+def build_suggester(_store, version, subject_col, teacher_col):
+    """授業名・教員名の入力候補をデータバージョンごとに1回だけ作る。教員名は「・」で1人ずつに分ける。
+
+    全パーティションを読み込まず、ファイルごとの値の出現回数から作る。
+    """
+    columns = {subject_col: None, teacher_col: TEACHER_SEP}
+    return Suggester.from_counts({c: _store.value_counts(c) for c in columns if c is not None}, columns)
+
+
+# --- 診断情報（処理ごとの時間の記録） ---
+# 記録はこのセッションの実行スレッドだけでオンにし、この実行の分だけを下の「診断情報」に表示する
+instrument.set_thread_enabled(st.session_state.get('diagnostics', False))
+trace_mark = instrument.last_seq()
+
 # --- データ読み込みロジック ---
 df = pd.DataFrame()
+store = None
+data_version = None
 
 # 1. 'data/' ディレクトリからCSVの読み込みを試みます。
 if REPO_DATA_DIR.exists() and REPO_DATA_DIR.is_dir():
     try:
-        df = load_csvs_from_dir(REPO_DATA_DIR)
-        if df.empty:
+        # 年度ごとのパーティションに分けたストア（プロセス内で共有）。
+        # パーティションは検索やプレビューで必要になったときに読み込む。
+        with span('load'):
+            store = open_store(REPO_DATA_DIR)
+        data_version = store.version
+        if not store.columns:
+            store = None
             st.warning(f"'{REPO_DATA_DIR}'ディレクトリは見つかりましたが、読み込み可能なCSVファイルがありません。")
     except Exception as e:
         st.error(f"'{REPO_DATA_DIR}'ディレクトリからのデータ読み込み中にエラーが発生しました: {e}")
@@ -68,39 +108,18 @@ else:
         accept_multiple_files=True
     )
     if uploaded_files:
-        try:
-            uploaded_dfs = [pd.read_csv(uf) for uf in uploaded_files]
-            if uploaded_dfs:
-                df = pd.concat(uploaded_dfs, ignore_index=True)
-        except Exception as e:
-            st.error(f"アップロードされたファイルの読み込み中にエラーが発生しました: {e}")
+        # 複数ファイルは並列に読み、読めなかったファイル・行はファイルごとに知らせる
+        df, reports = ingest_files(uploaded_files)
+        if compact_default():
+            df = compact_columns(df)
+        show_reports(reports)
 
 
 # --- メインアプリケーションUI ---
-if df.empty:
+if store is None and df.empty:
     st.warning("データが読み込まれていません。'data'ディレクトリを作成してCSVを配置するか、上記のフォームからファイルをアップロードしてください。")
 else:
-    cols = list(df.columns)
-
-    # --- 検索フォーム ---
-    st.write('検索したい項目の値を入力し、「検索」ボタンを押してください。')
-
-    # 検索窓を縦に並べる
-    year_q = st.text_input('年度')
-    subject_q = st.text_input('授業名')
-    teacher_q = st.text_input('教員')
-
-    do_search = st.button('検索')
-
-    # 検索オプション（横並びで表示）
-    c1, c2, c3 = st.columns(3)
-    with c1:
-        st.radio('検索モード', options=['含む', '完全一致'], index=0, key='match_mode')
-    with c2:
-        st.radio('条件の結合', options=['AND', 'OR'], index=0, key='combine_mode')
-    with c3:
-        st.checkbox('検索結果をハイライト表示', value=True, key='do_highlight')
-
+    cols = store.columns if store is not None else list(df.columns)
 
     # --- カラム名の自動検出 ---
     def find_col(name_candidates, columns):
@@ -121,101 +140,157 @@ else:
     subject_col = find_col(['科目', '授業名', 'subject', 'class'], cols)
     teacher_col = find_col(['教員', 'teacher', '教員名', 'instructor'], cols)
 
+    def set_query(key, value):
+        st.session_state[key] = value
+
+    def show_suggestions(key, column):
+        """入力中の文字列に対する候補をボタンで表示し、押すと入力欄にセットする。"""
+        q = st.session_state.get(key, '')
+        if store is None or column is None or not q.strip():
+            return
+        # 候補は初めて入力されたときに作る
+        suggester = build_suggester(store, data_version, subject_col, teacher_col)
+        hits = [h for h in suggester.suggest(column, q, k=SUGGEST_K, infix=True) if h[0] != q]
+        if not hits:
+            return
+        for col, (value, count) in zip(st.columns(len(hits)), hits):
+            col.button(f"{value} ({count})", key=f"suggest_{key}_{value}", on_click=set_query, args=(key, value))
+
+    # --- 検索フォーム ---
+    st.write('検索したい項目の値を入力し、「検索」ボタンを押してください。')
+
+    # 検索窓を縦に並べる
+    year_q = st.text_input('年度', help='2019-2023 や 2019- のように範囲でも指定できます')
+    subject_q = st.text_input('授業名', key='subject_q')
+    show_suggestions('subject_q', subject_col)
+    teacher_q = st.text_input('教員', key='teacher_q')
+    show_suggestions('teacher_q', teacher_col)
+
+    do_search = st.button('検索')
+
+    # 検索オプション（横並びで表示）
+    c1, c2, c3 = st.columns(3)
+    with c1:
+        st.radio('検索モード', options=['含む', '完全一致'], index=0, key='match_mode')
+    with c2:
+        st.radio('条件の結合', options=['AND', 'OR'], index=0, key='combine_mode')
+    with c3:
+        st.checkbox('検索結果をハイライト表示', value=True, key='do_highlight')
+
     # --- 検索の実行 ---
-    res = pd.DataFrame()
-    filters = [] # ハイライト表示でも使うため、ifの外で定義
+    result = None
     if do_search:
+        filters = []
         mode = 'contains' if st.session_state.get('match_mode') == '含む' else 'exact'
 
         if year_col and year_q.strip():
-            query = f"^{year_q}$" if mode == 'exact' else year_q
-            op = 'regex' if mode == 'exact' else 'contains'
-            filters.append((year_col, query, op))
+            # 年度として読める入力は数値の範囲で絞り込む（範囲外の年度のパーティションは読まない）
+            year_mode = 'range' if parse_year_range(year_q) is not None else mode
+            filters.append((year_col, year_q, year_mode))
         if subject_col and subject_q.strip():
-            query = f"^{subject_q}$" if mode == 'exact' else subject_q
-            op = 'regex' if mode == 'exact' else 'contains'
-            filters.append((subject_col, query, op))
+            filters.append((subject_col, subject_q, mode))
         if teacher_col and teacher_q.strip():
-            query = f"^{teacher_q}$" if mode == 'exact' else teacher_q
-            op = 'regex' if mode == 'exact' else 'contains'
-            filters.append((teacher_col, query, op))
+            filters.append((teacher_col, teacher_q, mode))
 
-        if filters:
-            combine_mode = st.session_state.get('combine_mode', 'AND')
-            res = search_df(df, filters, combine=combine_mode)
+        # ページ切り替えなどの再実行でも結果を表示し続けるため、検索条件をセッションに保存
+        st.session_state['active_filters'] = filters
+        st.session_state['active_combine'] = st.session_state.get('combine_mode', 'AND')
+        st.session_state['active_match_mode'] = mode
+        st.session_state['result_page'] = 1
+
+    filters = st.session_state.get('active_filters', []) # ハイライト表示でも使う
+    if filters:
+        combine_mode = st.session_state.get('active_combine', 'AND')
+        if store is not None:
+            # 同じ検索・絞り込み検索は全セッション共有のキャッシュから返す。結果は年度降順に並べ済み。
+            with span('search') as s:
+                cached = shared_cache.search_store(
+                    store, filters, combine=combine_mode,
+                    match_mode=st.session_state.get('active_match_mode', 'contains'),
+                )
+                s.set(rows_out=cached.total, cache=cached.hit)
+            # コンパクトモードでは表示する行だけを共有フレームから取り出す
+            result = cached
+        else:
+            # アップロードされたデータはその場限りなのでインデックスを作らずに検索
+            found = search_df(add_normalized_columns(df), filters, combine=combine_mode)
 
             # 可能であれば年度で降順ソート
-            if year_col and year_col in res.columns:
-                res[year_col] = pd.to_numeric(res[year_col], errors='coerce')
-                res = res.sort_values(by=year_col, ascending=False).reset_index(drop=True)
+            with span('sort', rows_in=len(found)):
+                found = found.iloc[latest_positions(found, year_col)]
+            result = uncached_result(found, year_col)
 
 
     # --- 結果の表示 ---
-    st.write(f"該当件数: {len(res)} 件")
-    if not res.empty:
-        # ダウンロードボタン
-        csv_bytes = res.to_csv(index=False).encode('utf-8-sig') # Excelでの文字化けを防ぐために 'utf-8-sig' を使用
+    n_hits = result.total if result is not None else 0
+    st.write(f"該当件数: {n_hits} 件")
+    if n_hits:
+        # ダウンロードボタン（CSVは Excelでの文字化けを防ぐために 'utf-8-sig'）。
+        # CSV はボタンが押されたときに作る（表示のたびに全件を取り出して変換しない）
+        def result_csv(result=result):
+            return result.csv_bytes
+
         st.download_button(
             "結果をCSVでダウンロード",
-            data=csv_bytes,
+            data=result_csv,
             file_name='search_results.csv',
             mime='text/csv'
         )
 
-        # --- ★★★ここを修正しました★★★ ---
-        # ハイライト表示のロジックを、該当単語のみマークする方法に変更
-        def generate_highlighted_html(df, filters):
-            """検索語にマッチした部分を<mark>タグで囲んだHTMLテーブルを生成する"""
-            # ヘッダーを生成
-            table_html = "<table><thead><tr>"
-            for column in df.columns:
-                table_html += f"<th>{escape(str(column))}</th>"
-            table_html += "</tr></thead><tbody>"
-
-            # 各行を生成
-            for _, row in df.iterrows():
-                table_html += "<tr>"
-                for column in df.columns:
-                    cell_value = str(row[column])
-                    # まずはセル全体を安全にエスケープする
-                    highlighted_cell = escape(cell_value)
-
-                    # この列に関連するフィルターを適用してハイライトする
-                    for f_col, f_query, f_mode in filters:
-                        if f_col == column:
-                            pattern = re.escape(f_query) if f_mode == 'contains' else f_query
-                            try:
-                                # マッチした部分を<mark>タグで囲む
-                                highlighted_cell = re.sub(
-                                    f'({pattern})',
-                                    r'<mark>\1</mark>',
-                                    highlighted_cell,
-                                    flags=re.IGNORECASE
-                                )
-                            except re.error:
-                                continue # 不正な正規表現はスキップ
-
-                    table_html += f"<td>{highlighted_cell}</td>"
-                table_html += "</tr>"
-
-            table_html += "</tbody></table>"
-            return table_html
-
+        # 結果はハイライトの有無によらず1ページ分だけ取り出して表示する
+        p1, p2 = st.columns(2)
+        with p1:
+            page_size = st.selectbox('1ページの件数', options=[50, 100, 200, 500], index=1, key='page_size')
+        with p2:
+            n_pages = page_count(n_hits, page_size)
+            if st.session_state.get('result_page', 1) > n_pages:
+                st.session_state['result_page'] = n_pages
+            page = st.number_input('ページ', min_value=1, max_value=n_pages, step=1, key='result_page')
+        offset = (page - 1) * page_size
+        st.caption(f"{offset + 1}–{min(offset + page_size, n_hits)} 件目 / 全{n_hits}件")
+        page_df = result.page(offset, page_size)
         if st.session_state.do_highlight and filters:
-            # カスタムHTMLを生成して表示
-            html_output = generate_highlighted_html(res, filters)
+            html_output = render_table_html(page_df, filters, page_size=page_size)
             st.markdown(html_output, unsafe_allow_html=True)
         else:
             # ハイライトしない場合は通常のデータフレーム表示
-            st.dataframe(res)
+            st.dataframe(page_df)
 
     # --- データプレビューセクション ---
     st.markdown('---')
     st.write('現在のデータプレビュー（最新200件・年度降順）')
 
-    preview_df = df.copy()
-    if year_col and year_col in preview_df.columns:
-        preview_df[year_col] = pd.to_numeric(preview_df[year_col], errors='coerce')
-        preview_df = preview_df.sort_values(by=year_col, ascending=False)
+    with span('preview') as s:
+        if store is not None:
+            # パーティションは年度の降順に並んでいるので、新しい年度から200件を取るだけでよい
+            preview_df = store.head(200)
+        else:
+            # 全体をコピー・並べ替えせず、新しい年度から200件の行位置だけを求める
+            preview_df = df.iloc[latest_positions(df, year_col, 200)]
+            if year_col and year_col in preview_df.columns:
+                preview_df = preview_df.assign(**{year_col: pd.to_numeric(preview_df[year_col], errors='coerce')})
+        s.set(rows_out=len(preview_df))
+
+    st.dataframe(preview_df)
 
-    st.dataframe(preview_df.head(200))
+    if store is not None:
+        # data/ のファイルは必要になったときに読むので、ここまでに読み込んだファイルの分を知らせる
+        show_reports(store.reports)
+
+# --- 診断情報 ---
+with st.expander('診断情報'):
+    st.checkbox('処理ごとの時間・行数・メモリを記録する', key='diagnostics')
+    trace = instrument.records(since=trace_mark, thread=threading.get_ident())
+    if trace:
+        trace_df = pd.DataFrame(trace)
+        trace_df['ms'] = trace_df['seconds'] * 1000
+        cols_shown = [c for c in ['depth', 'name', 'ms', 'rows_in', 'rows_out', 'mem_delta_bytes', 'meta'] if c in trace_df.columns]
+        st.dataframe(trace_df[cols_shown].astype({'meta': str}) if 'meta' in cols_shown else trace_df[cols_shown])
+        st.download_button(
+            "記録をJSON Linesでダウンロード",
+            data=instrument.to_jsonl(trace).encode('utf-8'),
+            file_name='diagnostics.jsonl',
+            mime='application/x-ndjson',
+        )
+    else:
+        st.caption('記録をオンにすると、次の実行から処理ごとの時間・入出力の行数・メモリの増減がここに表示されます。')
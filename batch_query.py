@@ -0,0 +1,361 @@
+"""
+まとめて検索（バッチ）: 数千件の問い合わせを、1回の読み込みと1回のインデックス作成で実行する。
+
+    python batch_query.py queries.csv --data-dir data --format jsonl > results.jsonl
+
+問い合わせのファイル（CSV または JSON Lines）の1行は1つのフィルタ:
+    id, column, query, mode（省略時 contains。年度の列で範囲として読めれば range）, combine（省略時 AND）
+同じ id の行は1つの問い合わせのフィルタとしてまとめる（combine は最初の行のもの）。
+JSON Lines では {"id": ..., "filters": [[列, クエリ, mode], ...], "combine": ...} とも書ける。
+id がなければ行番号（1始まり）を使う。
+
+- データは年度パーティションのストアのコンパクトモード（partition_store）で1つの共有フレームに読み、
+  n-gramインデックス（ngram_index）をその全体に1回だけ作る
+- フィルタ (列, クエリ, mode) ごとの一致行は1回だけ求め、同じフィルタを使う問い合わせで共有する
+- 問い合わせが多ければプロセスプールで分けて実行する（インデックスは fork で子プロセスに引き継ぐ）
+- 結果は「問い合わせの id + 1行」を JSON Lines か CSV で、問い合わせの順に流す。
+  行の文字列は行ごとに1回だけ作るので、問い合わせごとの処理はほぼ出力の書き込みだけになる
+
+結果の行は search_df（とアプリ）と同じで、共有フレームの順（年度の降順）。
+"""
+import argparse
+import csv
+import io
+import json
+import multiprocessing
+import os
+import re
+import sys
+from collections import OrderedDict
+from functools import reduce
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from ingest import YEAR_COLUMNS, report_problems
+from instrument import traced
+from kakodata_utils import _parse_filter, parse_year_range
+from ngram_index import NgramIndex, index_columns
+from normalize import is_normalized_column
+from partition_store import PartitionedStore
+
+
+MODES = ('contains', 'startswith', 'regex', 'exact', 'range')
+FORMATS = ('jsonl', 'csv')
+# これ以上の問い合わせはプロセスプールで実行する
+PARALLEL_MIN_QUERIES = 2000
+# プロセスプールに1回で渡す問い合わせの数
+CHUNK_QUERIES = 500
+# 一致行を覚えておくフィルタの数（プロセスごと）
+PREDICATE_CACHE = 4096
+
+
+class BatchQueryError(ValueError):
+    """問い合わせのファイルが正しくない。"""
+
+
+class BatchQuery:
+    """1つの問い合わせ。filters は search_df と同じ [(列, クエリ)] または [(列, クエリ, mode)]。"""
+
+    def __init__(self, id, filters: list, combine: str = 'AND'):
+        self.id = id
+        self.filters = [_parse_filter(f) for f in filters]
+        self.combine = combine
+
+    def __repr__(self) -> str:
+        return f"BatchQuery({self.id!r}, {self.filters!r}, {self.combine!r})"
+
+
+def _mode_for(col: str, q: str, mode) -> str:
+    if not mode:
+        if str(col).lower() in YEAR_COLUMNS and parse_year_range(q) is not None:
+            return 'range'
+        return 'contains'
+    if mode not in MODES:
+        raise BatchQueryError(f"unknown mode: {mode!r}")
+    return mode
+
+
+def _combine_for(combine) -> str:
+    combine = (combine or 'AND').upper()
+    if combine not in ('AND', 'OR'):
+        raise BatchQueryError(f"combine must be AND or OR: {combine!r}")
+    return combine
+
+
+def _text(v) -> str:
+    return '' if v is None else str(v)
+
+
+def parse_queries(records) -> list:
+    """レコード（dict）の列から問い合わせのリストを作る。同じ id のレコードは1つの問い合わせにまとめる。"""
+    queries = OrderedDict()
+    for lineno, rec in enumerate(records, 1):
+        qid = rec.get('id')
+        if qid is None or qid == '':
+            qid = lineno
+        try:
+            if 'filters' in rec:
+                filters = []
+                for f in rec['filters']:
+                    col, q = _text(f[0]), _text(f[1])
+                    filters.append((col, q, _mode_for(col, q, f[2] if len(f) > 2 else None)))
+            else:
+                if not rec.get('column'):
+                    raise BatchQueryError('column is required')
+                col, q = _text(rec['column']), _text(rec.get('query'))
+                filters = [(col, q, _mode_for(col, q, rec.get('mode')))]
+            combine = _combine_for(rec.get('combine'))
+        except (BatchQueryError, IndexError, TypeError) as e:
+            raise BatchQueryError(f"line {lineno}: {e}")
+        if qid in queries:
+            queries[qid].filters.extend(filters)
+        else:
+            queries[qid] = BatchQuery(qid, filters, combine)
+    return list(queries.values())
+
+
+def read_queries(source, fmt: str = None) -> list:
+    """問い合わせのファイル（パスまたはテキストのファイルオブジェクト）を読む。
+
+    fmt は 'csv' か 'jsonl'。省略時は拡張子で決める（.jsonl/.ndjson/.json なら JSON Lines、それ以外は CSV）。
+    """
+    if isinstance(source, (str, Path)):
+        if fmt is None:
+            fmt = 'jsonl' if Path(source).suffix.lower() in ('.jsonl', '.ndjson', '.json') else 'csv'
+        with open(source, encoding='utf-8-sig', newline='') as f:
+            return read_queries(f, fmt)
+    if fmt == 'jsonl':
+        records = []
+        for lineno, line in enumerate(source, 1):
+            if line.strip():
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError as e:
+                    raise BatchQueryError(f"line {lineno}: {e}")
+        return parse_queries(records)
+    return parse_queries(csv.DictReader(source))
+
+
+def _value(v):
+    if v is None or v is pd.NA or (isinstance(v, float) and v != v):
+        return None
+    if hasattr(v, 'item'):  # numpy のスカラー
+        return _value(v.item())
+    return v
+
+
+def _csv_field(v) -> str:
+    s = '' if v is None else str(v)
+    if any(c in s for c in ',"\r\n'):
+        return '"' + s.replace('"', '""') + '"'
+    return s
+
+
+def _intersect_sorted(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """昇順の行位置 a のうち b（昇順）にもあるもの。len(a) が小さければ b の長さにほぼよらない。"""
+    if len(a) == 0 or len(b) == 0:
+        return a[:0]
+    i = np.searchsorted(b, a)
+    i[i == len(b)] = 0
+    return a[b[i] == a]
+
+
+class BatchRunner:
+    """1つのフレームとそのn-gramインデックスで問い合わせを実行し、結果の行を出力の文字列にする。
+
+    frame はそのまま検索する（search_df と同じ。正規化列があればそれを使う）。
+    """
+
+    def __init__(self, frame: pd.DataFrame, index: NgramIndex = None):
+        self.frame = frame
+        if index is None:
+            index = NgramIndex(frame, index_columns(frame))
+        self.index = index
+        self.columns = [c for c in frame.columns if not is_normalized_column(c)]
+        self._predicates = OrderedDict()
+        # 行位置 -> 出力する行の文字列（形式ごと）
+        self._rows = {fmt: [None] * len(frame) for fmt in FORMATS}
+        self.reports = []
+
+    def _predicate(self, f: tuple) -> np.ndarray:
+        hit = self._predicates.get(f)
+        if hit is not None:
+            self._predicates.move_to_end(f)
+            return hit
+        hit = self.index.search_positions([f])
+        self._predicates[f] = hit
+        if len(self._predicates) > PREDICATE_CACHE:
+            self._predicates.popitem(last=False)
+        return hit
+
+    def positions(self, query: BatchQuery) -> np.ndarray:
+        """問い合わせに一致する行位置（昇順）。search_df(frame, query.filters, query.combine) と同じ行。"""
+        for col, q, mode in query.filters:
+            if col not in self.frame.columns:
+                raise BatchQueryError(f"unknown column: {col!r}")
+            if mode == 'regex':
+                try:
+                    re.compile(q)
+                except re.error as e:
+                    raise BatchQueryError(f"invalid regex {q!r}: {e}")
+        filters = [f for f in query.filters if str(f[1]).strip()]
+        if not filters:
+            return np.arange(len(self.frame))
+        hits = [self._predicate(f) for f in dict.fromkeys(filters)]
+        if query.combine == 'AND':
+            hits.sort(key=len)
+            return reduce(_intersect_sorted, hits)
+        return reduce(np.union1d, hits)
+
+    def _format_rows(self, positions: list, fmt: str) -> None:
+        """まだ文字列にしていない行をまとめて出力の文字列にする。"""
+        rows = self._rows[fmt]
+        need = [p for p in positions if rows[p] is None]
+        if not need:
+            return
+        sub = self.frame.iloc[need]
+        values = zip(*[[_value(v) for v in sub[c].tolist()] for c in self.columns])
+        for p, row in zip(need, values):
+            if fmt == 'jsonl':
+                # 先頭の '{' を除いた残り（問い合わせの id の後ろにつなげる）
+                rows[p] = json.dumps(dict(zip(self.columns, row)), ensure_ascii=False, separators=(',', ':'))[1:]
+            else:
+                rows[p] = ','.join(_csv_field(v) for v in row)
+
+    def header(self, fmt: str) -> str:
+        """出力の先頭（CSV のヘッダ行）。"""
+        if fmt == 'csv':
+            return ','.join(_csv_field(c) for c in ['query_id'] + self.columns) + '\n'
+        return ''
+
+    def run_chunk(self, queries: list, fmt: str, limit: int = None) -> tuple:
+        """問い合わせを順に実行し、(出力の文字列, 結果の行数, [(id, エラー)]) を返す。"""
+        results = []
+        errors = []
+        for query in queries:
+            try:
+                positions = self.positions(query)
+            except BatchQueryError as e:
+                errors.append((query.id, str(e)))
+                results.append((query, None, str(e)))
+                continue
+            results.append((query, positions if limit is None else positions[:limit], None))
+        # 結果の行は問い合わせごとではなく、チャンク全体でまとめて文字列にする
+        hits = [positions for _, positions, _ in results if positions is not None and len(positions)]
+        if hits:
+            self._format_rows(np.unique(np.concatenate(hits)).tolist(), fmt)
+
+        rows = self._rows[fmt]
+        out = []
+        n_rows = 0
+        for query, positions, error in results:
+            if error is not None:
+                if fmt == 'jsonl':
+                    out.append(json.dumps({'query_id': query.id, 'error': error}, ensure_ascii=False) + '\n')
+                continue
+            if fmt == 'jsonl':
+                prefix = '{"query_id":' + json.dumps(query.id, ensure_ascii=False) + ','
+            else:
+                prefix = _csv_field(query.id) + ','
+            out.extend(prefix + rows[p] + '\n' for p in positions.tolist())
+            n_rows += len(positions)
+        return ''.join(out), n_rows, errors
+
+
+# プロセスプールの子プロセスで使う BatchRunner（fork なら親のものをそのまま引き継ぐ）
+_worker = None
+
+
+def _init_worker(runner: BatchRunner) -> None:
+    global _worker
+    _worker = runner
+
+
+def _run_worker_chunk(args: tuple) -> tuple:
+    return _worker.run_chunk(*args)
+
+
+def _pool_context():
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    return multiprocessing.get_context()
+
+
+@traced('batch_query')
+def run_batch(runner: BatchRunner, queries: list, out, fmt: str = 'jsonl', workers: int = None,
+              limit: int = None, chunk_size: int = CHUNK_QUERIES) -> dict:
+    """問い合わせを実行し、結果をテキストのストリーム out に問い合わせの順に書く。
+
+    workers が 1、または問い合わせが PARALLEL_MIN_QUERIES 件より少なければこのプロセスで実行する。
+    workers を省略するとCPUの数。limit は問い合わせごとの結果の行数の上限。
+    返り値は {'queries': 件数, 'rows': 出力した行数, 'errors': [(id, エラー)]}。
+    """
+    if fmt not in FORMATS:
+        raise ValueError(f"fmt must be one of {FORMATS}: {fmt!r}")
+    if workers is None:
+        workers = os.cpu_count() or 1
+    stats = {'queries': len(queries), 'rows': 0, 'errors': []}
+    out.write(runner.header(fmt))
+    chunks = [(queries[i:i + chunk_size], fmt, limit) for i in range(0, len(queries), chunk_size)]
+    if workers <= 1 or len(queries) < PARALLEL_MIN_QUERIES or len(chunks) <= 1:
+        results = (runner.run_chunk(*c) for c in chunks)
+        for text, n_rows, errors in results:
+            out.write(text)
+            stats['rows'] += n_rows
+            stats['errors'] += errors
+        return stats
+
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=min(workers, len(chunks)), mp_context=_pool_context(),
+                             initializer=_init_worker, initargs=(runner,)) as ex:
+        for text, n_rows, errors in ex.map(_run_worker_chunk, chunks):
+            out.write(text)
+            stats['rows'] += n_rows
+            stats['errors'] += errors
+    return stats
+
+
+def open_runner(data_dir: str) -> BatchRunner:
+    """data_dir のCSVをコンパクトモードの共有フレームに読み、BatchRunner を作る。"""
+    store = PartitionedStore(data_dir, compact=True)
+    runner = BatchRunner(store.base().frame)
+    # 読めなかったファイル・除いた行（ingest.FileReport）
+    runner.reports = store.reports
+    return runner
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='問い合わせのファイルをまとめて検索する')
+    parser.add_argument('queries', help="問い合わせのファイル（CSV / JSON Lines）。'-' なら標準入力")
+    parser.add_argument('--data-dir', default='data')
+    parser.add_argument('--input-format', choices=FORMATS, help='省略時は拡張子で決める（標準入力は CSV）')
+    parser.add_argument('--format', choices=FORMATS, default='jsonl', help='出力の形式')
+    parser.add_argument('--out', help='出力先（省略時は標準出力）')
+    parser.add_argument('--workers', type=int, help='プロセス数（省略時はCPUの数、1 ならプールを使わない）')
+    parser.add_argument('--limit', type=int, help='問い合わせごとの結果の行数の上限')
+    args = parser.parse_args(argv)
+
+    try:
+        if args.queries == '-':
+            queries = read_queries(io.TextIOWrapper(sys.stdin.buffer, encoding='utf-8-sig'), args.input_format or 'csv')
+        else:
+            queries = read_queries(args.queries, args.input_format)
+    except BatchQueryError as e:
+        print(f"{args.queries}: {e}", file=sys.stderr)
+        return 2
+    runner = open_runner(args.data_dir)
+    for line in report_problems(runner.reports):
+        print(line, file=sys.stderr)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8', newline='') as out:
+            stats = run_batch(runner, queries, out, args.format, args.workers, args.limit)
+    else:
+        stats = run_batch(runner, queries, sys.stdout, args.format, args.workers, args.limit)
+    for qid, error in stats['errors']:
+        print(f"query {qid}: {error}", file=sys.stderr)
+    print(f"{stats['queries']} queries, {stats['rows']} rows, {len(stats['errors'])} errors", file=sys.stderr)
+    return 1 if stats['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,6 @@
+"""
+ベンチマーク: 合成データの生成（generate）と、読み込み・検索・追記の計測（harness）。
+
+    python -m benchmarks run --rows 10000 100000 --out bench.json
+    python -m benchmarks compare old.json new.json
+"""
@@ -0,0 +1,48 @@
+"""
+python -m benchmarks run --rows 10000 100000 --out bench.json
+python -m benchmarks compare old.json new.json
+"""
+import argparse
+import json
+import sys
+from benchmarks.harness import run, compare, format_results, format_comparison, DEFAULT_ROWS, BACKENDS
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p_run = sub.add_parser('run', help='合成データで計測してJSONに書き出す')
+    p_run.add_argument('--rows', type=int, nargs='+', default=list(DEFAULT_ROWS))
+    p_run.add_argument('--repeat', type=int, default=3)
+    p_run.add_argument('--seed', type=int, default=0)
+    p_run.add_argument('--backends', nargs='+', choices=BACKENDS, default=list(BACKENDS))
+    p_run.add_argument('--workdir', default=None, help='合成データを置く一時ディレクトリの場所')
+    p_run.add_argument('--out', default=None, help='結果のJSONファイル（省略時は標準出力）')
+
+    p_cmp = sub.add_parser('compare', help='2つの結果のJSONを比べる')
+    p_cmp.add_argument('old')
+    p_cmp.add_argument('new')
+
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        report = run(args.rows, repeat=args.repeat, seed=args.seed, backends=args.backends, workdir=args.workdir)
+        text = json.dumps(report, ensure_ascii=False, indent=2)
+        if args.out:
+            with open(args.out, 'w', encoding='utf-8') as f:
+                f.write(text + '\n')
+            print(format_results(report['results']))
+        else:
+            print(text)
+        return 0
+
+    with open(args.old, encoding='utf-8') as f:
+        old = json.load(f)
+    with open(args.new, encoding='utf-8') as f:
+        new = json.load(f)
+    print(format_comparison(compare(old, new)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
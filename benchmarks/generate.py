@@ -0,0 +1,83 @@
+"""
+年度,授業名,教員名 のスキーマの合成データ（1万〜1000万行）を作る。
+
+授業名は実データと同じく「基本科目」「上級」などの接頭辞・科目名・番号・組の組み合わせ、
+教員名は姓と名の組み合わせで、約25%の行は「・」区切りの共同担当（2〜3人）にする。
+行ごとの乱数は値の表（重複のない授業名・教員名）への添字だけなので、行数が多くても速い。
+"""
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+
+SUBJECT_STEMS = (
+    '民法', '刑法', '憲法', '行政法', '商法', '会社法', '民事訴訟法', '刑事訴訟法', '労働法', '知的財産法',
+    '国際私法', '国際法', '租税法', '経済法', '環境法', '倒産法', '民事執行・保全法', '社会保障法', '地方自治法',
+    '医事法', '情報法', '比較法', '法哲学', '法社会学', '国際民事訴訟法', '公法訴訟システム', '民事実務基礎',
+    '刑事実務基礎', '現代法過程論', '国際商事仲裁',
+)
+SUBJECT_PREFIXES = ('', '', '基本科目', '上級', 'A基本科目', 'B基本科目', '①', '②', '①②')
+SUBJECT_SUFFIXES = ('', '', '1', '2', '3', 'Ⅰ', 'Ⅱ', '演習', '(1組)', '(2組)', '③', '④')
+FAMILY_NAMES = (
+    '森田', '小粥', '石川', '藤田', '飯田', '畑', '垣内', '川出', '北島', '山本', '佐藤', '田中', '中原', '岩村',
+    '小島', '神作', '新田', '中谷', '児玉', '水野', '宮村', '古田', '高見澤', '巽', '藤枝', '海老原', '内海',
+    '近澤', '末吉', '笠木', '溜箭', '柿嶋', '山川', '齊藤', '北嶋', '淵邊', '江渕', '荒木', '大村', '松下',
+)
+GIVEN_NAMES = (
+    '宏樹', '太郎', '博康', '友敬', '秀総', '瑞穂', '秀介', '敏裕', '周作', '隆司', '正彦', '慎司', '裕之',
+    '一郎', '和弘', '安司', '大', '啓太', '啓昌', '磨', '智彦', '純', '明夫', '健司', '諒', '亙', '映里',
+    '将之', '美子', '隆一', '誠', '良蔵', '善彦', '悠紀', '尚志', '敦志', '淳', '幸子', '恵', '直樹',
+)
+TEACHER_SEP = '・'
+CO_TEACHER_RATE = 0.25
+DEFAULT_YEARS = tuple(range(2015, 2025))
+
+
+def subject_vocabulary() -> list:
+    """重複のない授業名の表。"""
+    return [p + s + x for s in SUBJECT_STEMS for p in dict.fromkeys(SUBJECT_PREFIXES) for x in dict.fromkeys(SUBJECT_SUFFIXES)]
+
+
+def teacher_vocabulary() -> list:
+    return [f + g for f in FAMILY_NAMES for g in GIVEN_NAMES]
+
+
+def _zipf_weights(n: int, s: float = 0.8) -> np.ndarray:
+    w = 1.0 / np.arange(1, n + 1) ** s
+    return w / w.sum()
+
+
+def generate(rows: int, seed: int = 0, years: tuple = DEFAULT_YEARS) -> pd.DataFrame:
+    """rows 行の合成データを返す（年度の昇順）。同じ seed なら同じデータになる。"""
+    rng = np.random.default_rng(seed)
+    subjects = np.array(subject_vocabulary(), dtype=object)
+    teachers = np.array(teacher_vocabulary(), dtype=object)
+
+    # 授業名と単独担当の教員名は偏りのある分布（よく開講される科目・教員がある）にする
+    subject_w = rng.permutation(_zipf_weights(len(subjects)))
+    teacher_w = rng.permutation(_zipf_weights(len(teachers)))
+    # 共同担当の組み合わせは表を作っておき、行からはその添字を引く
+    n_pairs = min(5000, max(100, rows // 20))
+    sizes = rng.integers(2, 4, n_pairs)
+    pairs = np.array([
+        TEACHER_SEP.join(rng.choice(teachers, size=k, replace=False)) for k in sizes
+    ], dtype=object)
+
+    year = np.sort(rng.choice(np.asarray(years), rows))
+    subject = subjects[rng.choice(len(subjects), rows, p=subject_w)]
+    single = teachers[rng.choice(len(teachers), rows, p=teacher_w)]
+    co = rng.random(rows) < CO_TEACHER_RATE
+    teacher = np.where(co, pairs[rng.integers(0, n_pairs, rows)], single)
+    return pd.DataFrame({'年度': year, '授業名': subject, '教員名': teacher}).astype({'授業名': str, '教員名': str})
+
+
+def write_dir(dir_path: str, rows: int, seed: int = 0, years: tuple = DEFAULT_YEARS) -> list:
+    """合成データを data/ と同じく年度ごとの kakodata_YYYY.csv に書き出し、書いたファイルのリストを返す。"""
+    p = Path(dir_path)
+    p.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for y, part in generate(rows, seed, years).groupby('年度', sort=True):
+        path = p / f"kakodata_{y}.csv"
+        part.to_csv(path, index=False)
+        paths.append(path)
+    return paths
@@ -0,0 +1,186 @@
+"""
+読み込み・検索・追記の計測。
+
+各計測は repeat 回の実行時間（最小値と中央値）と、tracemalloc で測った1回分のピークメモリを記録する
+（tracemalloc はPythonのメモリ確保だけを数えるので、SQLite内部のメモリは含まない）。
+検索は mode（contains/startswith/regex）× combine（AND/OR）× クエリの選択度の組み合わせを
+search_df と search_db で測り、ヒット件数と選択度（ヒット件数/行数）も残す。
+どちらもアプリと同じく正規化済みのシャドウ列があるデータを検索する。
+結果はJSONにして、compare() で別の実行と比べられる。
+"""
+from pathlib import Path
+import platform
+import re
+import sqlite3
+import statistics
+import tempfile
+import time
+import tracemalloc
+import pandas as pd
+from benchmarks.generate import write_dir, TEACHER_SEP
+from db_utils import import_dir_to_db, search_db, append_row_db, get_db
+from kakodata_utils import load_csvs_from_dir, search_df, append_row
+from normalize import add_normalized_columns
+
+
+DEFAULT_ROWS = (10_000, 100_000)
+MODES = ('contains', 'startswith', 'regex')
+COMBINES = ('AND', 'OR')
+BACKENDS = ('df', 'db')
+# 比べるときに同じ計測とみなすキー
+KEY_FIELDS = ('name', 'rows', 'mode', 'combine', 'selectivity')
+
+
+def measure(fn, repeat: int = 3) -> tuple:
+    """fn を repeat 回実行した時間と、もう1回 tracemalloc の下で実行したピークメモリを返す。
+
+    戻り値: ({'seconds_min', 'seconds_median', 'peak_bytes'}, 最後の fn() の戻り値)
+    """
+    times = []
+    result = None
+    for _ in range(max(1, repeat)):
+        start = time.perf_counter()
+        result = fn()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {'seconds_min': min(times), 'seconds_median': statistics.median(times), 'peak_bytes': peak}, result
+
+
+def selectivity_queries(df: pd.DataFrame) -> dict:
+    """選択度の異なるクエリ {名前: (授業名のクエリ, 教員名のクエリ)} をデータから選ぶ。"""
+    subjects = df['授業名'].value_counts()
+    teachers = df['教員名'].str.split(TEACHER_SEP).explode().value_counts()
+    top_teacher = teachers.index[0]
+    return {
+        'none': ('存在しない授業', '該当者なし'),
+        'rare': (subjects.index[-1], teachers.index[-1]),
+        'medium': (subjects.index[0], top_teacher),
+        'common': ('法', top_teacher[:1]),
+    }
+
+
+def _query(q: str, mode: str) -> str:
+    # regex は同じ文字列のリテラルとして一致するパターンにして、選択度をそろえる
+    return re.escape(q) if mode == 'regex' else q
+
+
+def _search_matrix(name: str, rows: int, queries: dict, search, repeat: int, record) -> None:
+    for selectivity, (sq, tq) in queries.items():
+        for mode in MODES:
+            for combine in COMBINES:
+                filters = [('授業名', _query(sq, mode), mode), ('教員名', _query(tq, mode), mode)]
+                stats, res = measure(lambda: search(filters, combine), repeat)
+                record(name, rows, stats, mode=mode, combine=combine, selectivity=selectivity,
+                       hits=len(res), selectivity_ratio=len(res) / rows if rows else 0.0)
+
+
+def _fresh_import(data: Path, db_path: str) -> dict:
+    """毎回空のデータベースに取り込む（2回目以降が差分なしの取り込みにならないように）。"""
+    get_db(db_path).close()
+    for suffix in ('', '-wal', '-shm'):
+        Path(db_path + suffix).unlink(missing_ok=True)
+    return import_dir_to_db(str(data), db_path)
+
+
+def run(rows_list=DEFAULT_ROWS, repeat: int = 3, seed: int = 0, backends=BACKENDS, workdir: str = None) -> dict:
+    """行数ごとに合成データを作って計測し、JSONにできる dict を返す。"""
+    results = []
+
+    def record(name, rows, stats, **extra):
+        entry = {'name': name, 'rows': rows, 'mode': None, 'combine': None, 'selectivity': None}
+        entry.update(extra)
+        entry.update(stats)
+        results.append(entry)
+
+    for rows in rows_list:
+        with tempfile.TemporaryDirectory(dir=workdir) as tmp:
+            data = Path(tmp) / 'data'
+            write_dir(data, rows, seed)
+
+            stats, df = measure(lambda: load_csvs_from_dir(data), repeat)
+            record('load_csvs_from_dir', rows, stats)
+            queries = selectivity_queries(df)
+            new_row = {'年度': int(df['年度'].max()), '授業名': '上級民法1', '教員名': '森田宏樹'}
+
+            if 'df' in backends:
+                ndf = add_normalized_columns(df)
+                _search_matrix('search_df', rows, queries,
+                               lambda f, c: search_df(ndf, f, combine=c), repeat, record)
+
+            if 'db' in backends:
+                db_path = str(Path(tmp) / 'bench.db')
+                stats, _ = measure(lambda: _fresh_import(data, db_path), repeat)
+                record('import_dir_to_db', rows, stats)
+                _search_matrix('search_db', rows, queries,
+                               lambda f, c: search_db(db_path, f, combine=c), repeat, record)
+                stats, _ = measure(lambda: append_row_db(db_path, new_row), repeat)
+                record('append_row_db', rows, stats)
+                get_db(db_path).close()
+
+            if 'df' in backends:
+                # CSVへの追記は取り込み・検索の計測が終わってから（データを変えるため）
+                last = sorted(data.glob('*.csv'))[-1]
+                stats, _ = measure(lambda: append_row(str(last), new_row), repeat)
+                record('append_row', rows, stats)
+
+    return {
+        'meta': {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'rows': list(rows_list),
+            'repeat': repeat,
+            'seed': seed,
+            'backends': list(backends),
+        },
+        'results': results,
+    }
+
+
+def _key(entry: dict) -> tuple:
+    return tuple(entry.get(k) for k in KEY_FIELDS)
+
+
+def compare(old: dict, new: dict) -> list:
+    """2回の実行結果の同じ計測どうしを比べる。ratio は新しい実行の時間/古い実行の時間（最小値どうし）。"""
+    before = {_key(e): e for e in old['results']}
+    out = []
+    for e in new['results']:
+        o = before.get(_key(e))
+        if o is None:
+            continue
+        ratio = e['seconds_min'] / o['seconds_min'] if o['seconds_min'] else float('inf')
+        out.append({
+            **{k: e.get(k) for k in KEY_FIELDS},
+            'old_seconds': o['seconds_min'],
+            'new_seconds': e['seconds_min'],
+            'ratio': ratio,
+            'old_peak_bytes': o['peak_bytes'],
+            'new_peak_bytes': e['peak_bytes'],
+        })
+    return out
+
+
+def format_results(results: list) -> str:
+    """計測結果を1行1計測のテキストにする。"""
+    lines = []
+    for e in results:
+        label = ' '.join(str(e[k]) for k in KEY_FIELDS if e.get(k) is not None)
+        hits = f" hits={e['hits']}" if 'hits' in e else ''
+        lines.append(f"{label:<48} {e['seconds_min'] * 1000:10.2f} ms  peak={e['peak_bytes'] / 1024:10.1f} KiB{hits}")
+    return '\n'.join(lines)
+
+
+def format_comparison(rows: list) -> str:
+    lines = []
+    for r in rows:
+        label = ' '.join(str(r[k]) for k in KEY_FIELDS if r.get(k) is not None)
+        lines.append(f"{label:<48} {r['old_seconds'] * 1000:10.2f} -> {r['new_seconds'] * 1000:10.2f} ms  x{r['ratio']:.2f}")
+    return '\n'.join(lines)
@@ -1,11 +1,26 @@
 """
-SQLiteベースのユーティリティ: CSVのインポート、検索（部分一致AND）、行追加
+SQLiteベースのユーティリティ: CSVのインポート、検索、行追加。
+モジュールレベルの関数は KakoDB（長寿命のコネクションを持つハンドル）の薄いラッパー。
 """
 import sqlite3
+import functools
+import json
+import os
+import re
+import threading
+import weakref
 from pathlib import Path
 import pandas as pd
-import shutil
 import time
+from ingest import read_files
+from instrument import traced
+from kakodata_cache import file_fingerprint
+from kakodata_utils import exact_keys, MULTI_VALUE_COLUMNS
+from normalize import (
+    add_normalized_columns, is_normalized_column,
+    normalized_column, normalize_text,
+)
+from query_planner import make_plan
 
 
 def init_db(db_path: str, table_name: str = 'kakodata') -> None:
@@ -16,42 +31,386 @@ def init_db(db_path: str, table_name: str = 'kakodata') -> None:
     conn.close()
 
 
-def import_csv_to_db(csv_path: str, db_path: str, table_name: str = 'kakodata', if_exists: str = 'replace') -> None:
-    """CSVを読み込んでSQLiteのテーブルに保存する。"""
-    p = Path(csv_path)
-    if not p.exists():
-        raise FileNotFoundError(csv_path)
-    df = pd.read_csv(p)
+FTS_SUFFIX = '_fts'
+# trigramトークナイザは3文字未満のクエリを扱えない
+FTS_MIN_QUERY_LEN = 3
+
+
+def _quote(name: str) -> str:
+    """SQLiteの識別子としてクォートする。"""
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+@functools.lru_cache(maxsize=256)
+def _compile_regex(pattern: str):
+    return re.compile(pattern, re.IGNORECASE)
+
+
+def _regexp(pattern, value) -> bool:
+    """SQLの `X REGEXP Y` 用。pandasの str.contains(case=False, regex=True) と同じ判定。"""
+    if value is None:
+        return False
+    return _compile_regex(pattern).search(str(value)) is not None
+
+
+def _exact_multi(value, key) -> bool:
+    """SQLの `EXACT_MULTI(X, key)` 用。search_df の exact と同じく exact_keys の照合キーで判定する。"""
+    if value is None:
+        return False
+    return key in exact_keys(str(value), True)
+
+
+def _connect(db_path: str) -> sqlite3.Connection:
     conn = sqlite3.connect(db_path)
+    conn.create_function('REGEXP', 2, _regexp, deterministic=True)
+    conn.create_function('EXACT_MULTI', 2, _exact_multi, deterministic=True)
+    return conn
+
+
+def _table_exists(conn: sqlite3.Connection, name: str) -> bool:
+    cur = conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (name,))
+    return cur.fetchone() is not None
+
+
+def fts_supported(conn: sqlite3.Connection) -> bool:
+    """FTS5のtrigramトークナイザが使えるか。"""
     try:
-        df.to_sql(table_name, conn, if_exists=if_exists, index=False)
-    finally:
-        conn.close()
+        conn.execute("CREATE VIRTUAL TABLE temp._fts_probe USING fts5(x, tokenize='trigram')")
+        conn.execute("DROP TABLE temp._fts_probe")
+        return True
+    except sqlite3.OperationalError:
+        return False
 
 
-def get_table_columns(db_path: str, table_name: str = 'kakodata') -> list:
-    conn = sqlite3.connect(db_path)
+# import_dir で取り込んだ行の元ファイル名を入れる列と、取り込んだファイルの一覧のテーブル
+SOURCE_COLUMN = '_source'
+MANIFEST_SUFFIX = '_manifest'
+# import_dir の一括投入の後にインデックスを張る列（年度・授業名・教員名）
+INDEX_COLUMNS = ('年度', '年', 'year', '授業名', '科目', 'subject', 'class', '教員名', '教員', 'teacher', 'instructor')
+
+
+def _is_internal(col) -> bool:
+    """検索結果やバックアップに出さない列（シャドウ列と取り込み元の列）。"""
+    return is_normalized_column(col) or col == SOURCE_COLUMN
+
+
+def rebuild_fts(conn: sqlite3.Connection, table_name: str = 'kakodata') -> bool:
+    """テーブルの全列を対象にしたFTS5(trigram)のシャドウテーブルを作り直す。
+
+    外部コンテンツテーブルとして作り、INSERT/UPDATE/DELETEはトリガで同期する。
+    FTS5が使えない環境では何もせずFalseを返す。
+    """
+    if not fts_supported(conn):
+        return False
+    fts = table_name + FTS_SUFFIX
+    cols = [r[1] for r in conn.execute(f"PRAGMA table_info({_quote(table_name)})") if r[1] != SOURCE_COLUMN]
+    qcols = ', '.join(_quote(c) for c in cols)
+    new_cols = ', '.join(f"new.{_quote(c)}" for c in cols)
+    old_cols = ', '.join(f"old.{_quote(c)}" for c in cols)
+    qt, qf = _quote(table_name), _quote(fts)
+    with conn:
+        # トリガは元のテーブルにあるので、FTSのテーブルを消しても古い列の並びのまま残る
+        for suffix in ('_ai', '_ad', '_au'):
+            conn.execute(f"DROP TRIGGER IF EXISTS {_quote(fts + suffix)}")
+        conn.execute(f"DROP TABLE IF EXISTS {qf}")
+        conn.execute(
+            f"CREATE VIRTUAL TABLE {qf} USING fts5({qcols}, content={qt}, "
+            f"content_rowid='rowid', tokenize='trigram')"
+        )
+        conn.execute(f"INSERT INTO {qf}({qf}) VALUES('rebuild')")
+        conn.execute(f"""
+            CREATE TRIGGER {_quote(fts + '_ai')} AFTER INSERT ON {qt} BEGIN
+                INSERT INTO {qf}(rowid, {qcols}) VALUES (new.rowid, {new_cols});
+            END""")
+        conn.execute(f"""
+            CREATE TRIGGER {_quote(fts + '_ad')} AFTER DELETE ON {qt} BEGIN
+                INSERT INTO {qf}({qf}, rowid, {qcols}) VALUES ('delete', old.rowid, {old_cols});
+            END""")
+        conn.execute(f"""
+            CREATE TRIGGER {_quote(fts + '_au')} AFTER UPDATE ON {qt} BEGIN
+                INSERT INTO {qf}({qf}, rowid, {qcols}) VALUES ('delete', old.rowid, {old_cols});
+                INSERT INTO {qf}(rowid, {qcols}) VALUES (new.rowid, {new_cols});
+            END""")
+    return True
+
+
+EXACT_SUFFIX = '_exact'
+
+
+def _exact_entries(conn: sqlite3.Connection, table_name: str, after_rowid: int = None) -> list:
+    """完全一致索引の (列, キー, rowid) を作る。教員名の列は「・」で区切った1人ずつも登録する。"""
+    sql = f"SELECT rowid AS __rowid__, * FROM {_quote(table_name)}"
+    params = []
+    if after_rowid is not None:
+        sql += " WHERE rowid > ?"
+        params.append(after_rowid)
+    df = pd.read_sql_query(sql, conn, params=params)
+    entries = []
+    for col in df.columns:
+        if col == '__rowid__' or _is_internal(col):
+            continue
+        ncol = normalized_column(col)
+        src = ncol if ncol in df.columns else col
+        multi = col in MULTI_VALUE_COLUMNS
+        for rowid, value in zip(df['__rowid__'], df[src]):
+            if value is None or pd.isna(value):
+                continue
+            for key in exact_keys(str(value), multi):
+                entries.append((col, key, int(rowid)))
+    return entries
+
+
+def rebuild_exact(conn: sqlite3.Connection, table_name: str = 'kakodata') -> None:
+    """完全一致用の索引テーブル <table>_exact (col, value, row) を作り直す。
+
+    値（正規化列があれば正規化した値）から rowid を引けるよう (col, value) にインデックスを張る。
+    """
+    qe = _quote(table_name + EXACT_SUFFIX)
+    entries = _exact_entries(conn, table_name)
+    with conn:
+        conn.execute(f"DROP TABLE IF EXISTS {qe}")
+        conn.execute(f"CREATE TABLE {qe} (col TEXT NOT NULL, value TEXT NOT NULL, row INTEGER NOT NULL)")
+        conn.executemany(f"INSERT INTO {qe} (col, value, row) VALUES (?, ?, ?)", entries)
+        conn.execute(f"CREATE INDEX {_quote(table_name + EXACT_SUFFIX + '_idx')} ON {qe} (col, value)")
+
+
+def _fts_phrase(col: str, q: str) -> str:
+    """FTS5のMATCH式: 列を限定したフレーズ検索。"""
+    return '{' + _quote(col) + '} : "' + q.replace('"', '""') + '"'
+
+
+# 変更ログがこのサイズを超えたらCSVバックアップに畳み込む
+BACKUP_LOG_MAX_BYTES = 1 << 20
+
+
+def _changelog_path(db_path: str) -> Path:
+    return Path(db_path).with_name(f"{Path(db_path).stem}.changelog.jsonl")
+
+
+def _backup_csv_path(db_path: str) -> Path:
+    return Path(db_path).with_name(f"{Path(db_path).stem}.backup.csv")
+
+
+def _write_changelog(db_path: str, table_name: str, rows: list) -> None:
+    """追加した行を追記専用の変更ログに書く。"""
+    ts = time.time()
+    with open(_changelog_path(db_path), 'a', encoding='utf-8') as f:
+        for row in rows:
+            f.write(json.dumps({'ts': ts, 'table': table_name, 'row': row}, ensure_ascii=False, default=str) + '\n')
+
+
+def compact_backup(db_path: str, table_name: str = 'kakodata', conn: sqlite3.Connection = None) -> Path:
+    """テーブル全体を1つのCSVバックアップに書き出し、変更ログを空にする。"""
+    own = conn is None
+    if own:
+        conn = _connect(db_path)
     try:
-        cur = conn.cursor()
-        cur.execute(f"PRAGMA table_info('{table_name}')")
-        rows = cur.fetchall()
-        return [r[1] for r in rows]
+        backup_csv = _backup_csv_path(db_path)
+        tmp = backup_csv.with_name(backup_csv.name + '.tmp')
+        df = pd.read_sql_query(f"SELECT * FROM {_quote(table_name)}", conn)
+        df.drop(columns=[c for c in df.columns if _is_internal(c)]).to_csv(tmp, index=False)
+        os.replace(tmp, backup_csv)
+        open(_changelog_path(db_path), 'w').close()
+        return backup_csv
     finally:
-        conn.close()
+        if own:
+            conn.close()
 
 
-def search_db(db_path: str, filters: list, table_name: str = 'kakodata', combine: str = 'AND') -> pd.DataFrame:
-    """filters: list of (column_name, query_string, mode)
-    mode: 'contains' | 'startswith' | 'regex'
-    SQLiteで可能な検索はSQLで実行し、regexモードが含まれる場合は一旦絞ってからpandasで正規表現フィルタをかける。
+def _with_normalized(row: dict) -> dict:
+    out = dict(row)
+    for c, v in row.items():
+        out[normalized_column(c)] = '' if v is None or pd.isna(v) else normalize_text(str(v))
+    return out
+
+
+def _close_connections(conns: list) -> None:
+    for conn in conns:
+        try:
+            conn.close()
+        except sqlite3.Error:
+            pass
+    conns.clear()
+
+
+class _ThreadConnections:
+    """1スレッド分のコネクション（threading.local に置く）。
+
+    スレッドが終わって threading.local の値が捨てられると、ファイナライザでコネクションを閉じる。
     """
-    conn = sqlite3.connect(db_path)
-    try:
-        cur = conn.cursor()
-        sql_parts = []
-        params = []
-        post_regex_filters = []
 
+    def __init__(self):
+        self.reader = None
+        self.writer = None
+        self.conns = []
+        self._finalizer = weakref.finalize(self, _close_connections, self.conns)
+
+    def close(self) -> None:
+        self._finalizer()
+
+
+class KakoDB:
+    """1つのSQLiteデータベース・テーブルへの長寿命ハンドル。
+
+    - コネクションはスレッドごとに1本ずつ保持して使い回す（書き込み用と検索用）。
+      スレッドが終わればそのスレッドのコネクションは閉じる（リクエストごとにスレッドを作るサーバでも増え続けない）
+    - 検索用は読み取り専用（mode=ro のURI）で開く
+    - WALジャーナルと mmap_size / cache_size を設定する
+    - 組み立てたSQL文はフィルタの形ごとにキャッシュし、準備済みステートメントは
+      sqlite3 の cached_statements で再利用する
+    - 列名リストはスキーマが変わるまでキャッシュする
+    """
+
+    MMAP_SIZE = 256 * 1024 * 1024
+    CACHE_SIZE_KIB = 16 * 1024
+    STATEMENT_CACHE_SIZE = 256
+
+    def __init__(self, db_path: str, table_name: str = 'kakodata'):
+        self.db_path = str(db_path)
+        self.table_name = table_name
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._columns = None
+        self._fts = None
+        self._exact = None
+        self._schema_version = None
+        self._sql_cache = {}
+        # コネクションを持つスレッドの _ThreadConnections（スレッドが終われば消える）
+        self._threads = weakref.WeakSet()
+
+    # --- コネクション ---
+    def _open(self, readonly: bool) -> sqlite3.Connection:
+        conn = None
+        if readonly:
+            uri = Path(self.db_path).resolve().as_uri() + '?mode=ro'
+            try:
+                # 暗黙のトランザクションで古いスナップショットを掴み続けないよう autocommit にする
+                conn = sqlite3.connect(uri, uri=True, isolation_level=None, check_same_thread=False,
+                                       cached_statements=self.STATEMENT_CACHE_SIZE)
+                conn.execute("SELECT 1 FROM sqlite_master LIMIT 1")
+            except sqlite3.OperationalError:
+                # まだファイルがない、WALの共有メモリが作れない等の場合は通常の接続で読み取り専用にする
+                if conn is not None:
+                    conn.close()
+                conn = None
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, isolation_level=None if readonly else '', check_same_thread=False,
+                                   cached_statements=self.STATEMENT_CACHE_SIZE)
+            if readonly:
+                conn.execute("PRAGMA query_only=1")
+            else:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("PRAGMA synchronous=NORMAL")
+        conn.create_function('REGEXP', 2, _regexp, deterministic=True)
+        conn.create_function('EXACT_MULTI', 2, _exact_multi, deterministic=True)
+        conn.execute("PRAGMA busy_timeout=5000")
+        conn.execute(f"PRAGMA mmap_size={self.MMAP_SIZE}")
+        conn.execute(f"PRAGMA cache_size=-{self.CACHE_SIZE_KIB}")
+        return conn
+
+    def _thread_connections(self) -> _ThreadConnections:
+        local = self._local
+        tc = getattr(local, 'conns', None)
+        if tc is None:
+            tc = local.conns = _ThreadConnections()
+            with self._lock:
+                self._threads.add(tc)
+        return tc
+
+    def reader(self) -> sqlite3.Connection:
+        """このスレッドの検索用（読み取り専用）コネクション。"""
+        tc = self._thread_connections()
+        if tc.reader is None:
+            tc.reader = self._open(readonly=True)
+            tc.conns.append(tc.reader)
+        return tc.reader
+
+    def writer(self) -> sqlite3.Connection:
+        """このスレッドの書き込み用コネクション。"""
+        tc = self._thread_connections()
+        if tc.writer is None:
+            tc.writer = self._open(readonly=False)
+            tc.conns.append(tc.writer)
+        return tc.writer
+
+    def close(self) -> None:
+        """このハンドルが開いた全てのスレッドのコネクションを閉じる。
+
+        別スレッドで検索・書き込みの途中のコネクションも閉じるので、使い終わってから呼ぶこと。
+        閉じた後に使うと、各スレッドで新しいコネクションを開き直す。
+        """
+        with self._lock:
+            threads = list(self._threads)
+            self._threads = weakref.WeakSet()
+            self._local = threading.local()
+        for tc in threads:
+            tc.close()
+
+    # --- スキーマ ---
+    def _refresh_schema(self, conn: sqlite3.Connection) -> None:
+        version = conn.execute("PRAGMA schema_version").fetchone()[0]
+        if version == self._schema_version:
+            return
+        rows = conn.execute(f"PRAGMA table_info({_quote(self.table_name)})").fetchall()
+        with self._lock:
+            self._columns = [r[1] for r in rows]
+            self._fts = _table_exists(conn, self.table_name + FTS_SUFFIX)
+            self._exact = _table_exists(conn, self.table_name + EXACT_SUFFIX)
+            self._sql_cache.clear()
+            self._schema_version = version
+
+    def columns(self) -> list:
+        """テーブルの列名リスト（スキーマが変わるまでキャッシュ）。シャドウ列は含まない。"""
+        self._refresh_schema(self.reader())
+        return [c for c in self._columns if not _is_internal(c)]
+
+    # --- 検索 ---
+    def _build_sql(self, shape: tuple, combine: str) -> str:
+        key = (shape, combine)
+        sql = self._sql_cache.get(key)
+        if sql is not None:
+            return sql
+        fts = _quote(self.table_name + FTS_SUFFIX)
+        clauses = []
+        for col, kind, use_fts in shape:
+            if kind == 'missing':
+                # 存在しない列は常にFalseにする
+                clauses.append("0")
+                continue
+            qc = _quote(col)
+            if kind == 'exact_index':
+                qe = _quote(self.table_name + EXACT_SUFFIX)
+                clauses.append(f"rowid IN (SELECT row FROM {qe} WHERE col = ? AND value = ?)")
+                continue
+            if kind == 'exact':
+                clause = f"lower({qc}) = ?"
+            elif kind == 'exact_multi':
+                clause = f"EXACT_MULTI({qc}, ?)"
+            elif kind == 'regex':
+                clause = f"{qc} REGEXP ?"
+            elif kind == 'substring':
+                clause = f"instr({qc}, ?) > 0"
+            elif kind == 'prefix':
+                clause = f"instr({qc}, ?) = 1"
+            else:
+                clause = f"lower({qc}) LIKE ?"
+            if use_fts:
+                clause = f"(rowid IN (SELECT rowid FROM {fts} WHERE {fts} MATCH ?) AND {clause})"
+            clauses.append(clause)
+        if not clauses:
+            where = "1"
+        else:
+            joiner = f" {combine} " if combine in ('AND', 'OR') else ' AND '
+            where = joiner.join(clauses)
+        select = ', '.join(_quote(c) for c in self._columns if not _is_internal(c)) or '*'
+        sql = f"SELECT {select} FROM {_quote(self.table_name)} WHERE {where}"
+        with self._lock:
+            self._sql_cache[key] = sql
+        return sql
+
+    def _clauses(self, filters: list, columns: list, has_fts: bool, has_exact: bool) -> list:
+        """フィルタごとに (col, q, mode, SQLの形の要素, パラメータ) を作る。空のクエリは除く。"""
+        out = []
         for item in filters:
             if len(item) == 3:
                 col, q, mode = item
@@ -60,65 +419,404 @@ def search_db(db_path: str, filters: list, table_name: str = 'kakodata', combine
                 mode = 'contains'
             if not q or str(q).strip() == "":
                 continue
+            q = str(q)
+            if col not in columns:
+                out.append((col, q, mode, (col, 'missing', False), []))
+                continue
             if mode == 'regex':
-                post_regex_filters.append((col, q))
-            elif mode == 'startswith':
-                sql_parts.append((f"lower({col}) LIKE ?", f"{q.lower()}%"))
+                out.append((col, q, mode, (col, 'regex', False), [q]))
+                continue
+            ncol = normalized_column(col)
+            if mode == 'exact':
+                key = normalize_text(q.strip()) if ncol in columns else q.strip().lower()
+                if has_exact:
+                    out.append((col, q, mode, (col, 'exact_index', False), [col, key]))
+                elif col in MULTI_VALUE_COLUMNS:
+                    out.append((col, q, mode, (ncol if ncol in columns else col, 'exact_multi', False),
+                                [key]))
+                else:
+                    out.append((col, q, mode, (ncol if ncol in columns else col, 'exact', False), [key]))
+                continue
+            tq = q
+            if ncol in columns:
+                tcol, kind, value = ncol, 'prefix' if mode == 'startswith' else 'substring', normalize_text(q)
+                tq = value
             else:
-                sql_parts.append((f"lower({col}) LIKE ?", f"%{q.lower()}%"))
+                tcol, kind = col, 'like'
+                value = f"{q.lower()}%" if mode == 'startswith' else f"%{q.lower()}%"
+            use_fts = has_fts and len(tq) >= FTS_MIN_QUERY_LEN and not (kind == 'like' and set(tq) & set('%_'))
+            params = [_fts_phrase(tcol, tq)] if use_fts else []
+            out.append((col, q, mode, (tcol, kind, use_fts), params + [value]))
+        return out
 
-        # Build SQL
-        if not sql_parts:
-            base_where = "1"
-            base_params = []
-        else:
-            clauses = [p[0] for p in sql_parts]
-            vals = [p[1] for p in sql_parts]
-            joiner = f" {combine} " if combine in ('AND','OR') else ' AND '
-            base_where = joiner.join(clauses)
-            base_params = vals
-
-        sql = f"SELECT * FROM {table_name} WHERE {base_where}"
-        df = pd.read_sql_query(sql, conn, params=base_params)
-
-        # If there are regex filters, apply them with pandas. For combine='OR', we need to union results:
-        if post_regex_filters:
-            if combine == 'AND':
-                for col, q in post_regex_filters:
-                    if col not in df.columns:
-                        return df.iloc[0:0]
-                    df = df[df[col].astype(str).str.contains(q, case=False, regex=True)]
+    # --- 実行計画 ---
+    def _stats(self, conn: sqlite3.Connection) -> dict:
+        """このスレッドの検索用コネクションから見た行数と、列ごとの値の出現回数（データが変わるまでキャッシュ）。"""
+        # data_version はほかのコネクション（書き込み用を含む）がコミットすると変わる
+        marker = (conn.execute("PRAGMA data_version").fetchone()[0], self._schema_version)
+        stats = getattr(self._local, 'stats', None)
+        if stats is None or stats['marker'] != marker:
+            rows = conn.execute(f"SELECT count(*) FROM {_quote(self.table_name)}").fetchone()[0]
+            stats = self._local.stats = {'marker': marker, 'rows': rows, 'values': {}}
+        return stats
+
+    def _value_counts(self, conn: sqlite3.Connection, stats: dict, col: str) -> pd.Series:
+        """完全一致索引から求めた列の値（照合キー）ごとの行数。"""
+        vc = stats['values'].get(col)
+        if vc is None:
+            qe = _quote(self.table_name + EXACT_SUFFIX)
+            rows = conn.execute(f"SELECT value, count(*) FROM {qe} WHERE col = ? GROUP BY value", (col,)).fetchall()
+            vc = stats['values'][col] = pd.Series([r[1] for r in rows], index=[r[0] for r in rows], dtype='int64')
+        return vc
+
+    def _estimator(self, conn: sqlite3.Connection, stats: dict, has_exact: bool):
+        """完全一致索引の件数と値ごとの行数から選択度を見積もる。完全一致索引がなければ見積もらない。"""
+        n = stats['rows']
+
+        def estimate(step, rank):
+            shape, params = step.state
+            kind = shape[1]
+            step.target = shape
+            if kind == 'missing':
+                step.estimate, step.source, step.exact = 0.0, 'missing', True
+                return
+            if not rank or not has_exact or n == 0:
+                return
+            if kind == 'exact_index':
+                qe = _quote(self.table_name + EXACT_SUFFIX)
+                hits = conn.execute(f"SELECT count(*) FROM {qe} WHERE col = ? AND value = ?", params).fetchone()[0]
+                step.estimate, step.source, step.exact = hits / n, 'exact_index', True
+                return
+            keys = self._value_counts(conn, stats, step.col).index.to_series()
+            q = params[-1]
+            if kind == 'like':
+                q = q.strip('%')
+                kind = 'prefix' if step.mode == 'startswith' else 'substring'
+            try:
+                if kind == 'substring':
+                    m = keys.str.contains(q, regex=False)
+                elif kind == 'prefix':
+                    m = keys.str.startswith(q)
+                elif kind == 'regex':
+                    # 検索と同じ Python の re で判定する（Arrow の文字列列の str.contains は RE2 なので、
+                    # 書ける正規表現が違い、エラーも ArrowInvalid になる）
+                    pattern = _compile_regex(q)
+                    m = keys.map(lambda v: pattern.search(v) is not None)
+                else:
+                    return
+            except re.error:
+                # 不正な正規表現は見積もらない（検索時にエラーになる）
+                return
+            counts = stats['values'][step.col]
+            step.estimate = min(1.0, float(counts[m.to_numpy(dtype=bool)].sum()) / n)
+            step.source = 'value_counts'
+        return estimate
+
+    def plan(self, filters: list, combine: str = 'AND'):
+        """search() の実行計画（query_planner.Plan）。各ステップの state は (SQLの形の要素, パラメータ)。"""
+        conn = self.reader()
+        self._refresh_schema(conn)
+        clauses = self._clauses(filters, self._columns, self._fts, self._exact)
+        stats = self._stats(conn)
+        items = [(col, q, mode, (shape, params)) for col, q, mode, shape, params in clauses]
+        return make_plan(items, combine, stats['rows'], self._estimator(conn, stats, self._exact))
+
+    def explain(self, filters: list, combine: str = 'AND') -> str:
+        """選んだ評価順と見積もり、実行するSQLと SQLite の EXPLAIN QUERY PLAN を返す。"""
+        plan = self.plan(filters, combine)
+        lines = [plan.explain()]
+        if plan.empty:
+            lines.append('(empty: not executed)')
+            return '\n'.join(lines)
+        sql, params = self._plan_sql(plan)
+        lines.append(sql)
+        for row in self.reader().execute("EXPLAIN QUERY PLAN " + sql, params):
+            lines.append(f"  {row[-1]}")
+        return '\n'.join(lines)
+
+    def _plan_sql(self, plan) -> tuple:
+        shape = tuple(step.state[0] for step in plan.steps)
+        params = [p for step in plan.steps for p in step.state[1]]
+        return self._build_sql(shape, plan.combine), params
+
+    def search(self, filters: list, combine: str = 'AND') -> pd.DataFrame:
+        """filters: list of (column_name, query_string, mode)
+        mode: 'contains' | 'startswith' | 'regex' | 'exact'
+        全てのモードを1回のSQLで実行する。regexはコネクションに登録したREGEXP関数で評価し、
+        部分一致はFTS5(trigram)テーブルがあればそれで候補を絞ってから元の条件で確認する。
+        3文字未満のクエリや、LIKEのワイルドカード(%, _)を含むクエリはFTSを使わない。
+        正規化済みのシャドウ列があれば、contains/startswith は正規化した文字列どうしで比較する。
+        exact は完全一致索引（<table>_exact）があればそれを引き、教員名は1人ずつとも照合する。
+        条件は query_planner の計画の順に並べる（AND は絞り込みの強い順、OR は一致の多い順なので、
+        SQLiteの行ごとの評価が早く決まる）。AND で一致が0件と確定した条件があればSQLを実行しない。
+        """
+        plan = self.plan(filters, combine)
+        if plan.empty:
+            return pd.DataFrame(columns=[c for c in self._columns if not _is_internal(c)])
+        sql, params = self._plan_sql(plan)
+        return pd.read_sql_query(sql, self.reader(), params=params)
+
+    # --- 書き込み ---
+    def import_csv(self, csv_path: str, if_exists: str = 'replace', fts: bool = True, normalized: bool = True,
+                   exact: bool = True) -> None:
+        """CSVを読み込んでテーブルに保存する。
+
+        fts=True の場合は部分一致検索用のFTS5(trigram)シャドウテーブルも作り直す。
+        normalized=True の場合は正規化済みのシャドウ列（_norm_<列名>）も保存する。
+        exact=True の場合は完全一致用の索引テーブル（<table>_exact）も作り直す。
+        """
+        p = Path(csv_path)
+        if not p.exists():
+            raise FileNotFoundError(csv_path)
+        df = pd.read_csv(p)
+        if normalized:
+            df = add_normalized_columns(df)
+        conn = self.writer()
+        df.to_sql(self.table_name, conn, if_exists=if_exists, index=False)
+        if fts:
+            rebuild_fts(conn, self.table_name)
+        if exact:
+            rebuild_exact(conn, self.table_name)
+
+    def import_dir(self, dir_path: str, fts: bool = True, normalized: bool = True, exact: bool = True) -> dict:
+        """ディレクトリ内のCSVのうち、新しいファイルと内容が変わったファイルだけを取り込む。
+
+        取り込んだファイルは <table>_manifest に (ファイル名, sha1, サイズ, mtime, rowidの範囲, 行数) を記録する。
+        行には元のファイル名（_source 列）を付け、変わったファイル・消えたファイルの古い行はその列で削除する。
+        削除と追加は1トランザクションの executemany で行い、一括投入の後に年度・授業名・教員名と
+        _source の列にインデックスを張る。manifest のない既存のテーブル（import_csv で作ったもの）は作り直す。
+        読めなかったファイルは前回取り込んだ行をそのまま残す。
+
+        戻り値: {'imported': [...], 'removed': [...], 'unchanged': [...], 'reports': [FileReport]}
+        """
+        p = Path(dir_path)
+        if not p.exists() or not p.is_dir():
+            raise FileNotFoundError(f"Directory not found: {dir_path}")
+        table_name = self.table_name
+        qt, qm = _quote(table_name), _quote(table_name + MANIFEST_SUFFIX)
+        conn = self.writer()
+        had_table = _table_exists(conn, table_name)
+        rebuild = had_table and not _table_exists(conn, table_name + MANIFEST_SUFFIX)
+        manifest = {}
+        if had_table and not rebuild:
+            for source, sha1, size, mtime_ns in conn.execute(f"SELECT source, sha1, size, mtime_ns FROM {qm}"):
+                manifest[source] = (sha1, size, mtime_ns)
+
+        files = sorted(p.glob('*.csv'))
+        changed, touched, unchanged = [], [], []
+        for f in files:
+            st = f.stat()
+            old = manifest.get(f.name)
+            if old is not None and old[1:] == (st.st_size, st.st_mtime_ns):
+                unchanged.append(f.name)
+                continue
+            digest = file_fingerprint(f)[3]
+            if old is not None and old[0] == digest:
+                # touchされただけで内容は同じ
+                touched.append((st.st_size, st.st_mtime_ns, f.name))
+                unchanged.append(f.name)
+                continue
+            changed.append((f, digest, st.st_size, st.st_mtime_ns))
+        names = {f.name for f in files}
+        removed = [name for name in manifest if name not in names]
+
+        loaded = []
+        reports = []
+        for (f, digest, size, mtime_ns), (df, report) in zip(changed, read_files([c[0] for c in changed])):
+            reports.append(report)
+            if df is None:
+                continue
+            if normalized:
+                df = add_normalized_columns(df)
+            loaded.append((f.name, digest, size, mtime_ns, df.assign(**{SOURCE_COLUMN: f.name})))
+
+        conn.execute("BEGIN")
+        try:
+            if rebuild:
+                for name in (table_name + FTS_SUFFIX, table_name + EXACT_SUFFIX, table_name):
+                    conn.execute(f"DROP TABLE IF EXISTS {_quote(name)}")
+            conn.execute(
+                f"CREATE TABLE IF NOT EXISTS {qm} (source TEXT PRIMARY KEY, sha1 TEXT NOT NULL, size INTEGER, "
+                f"mtime_ns INTEGER, first_row INTEGER, last_row INTEGER, rows INTEGER, imported_at REAL)"
+            )
+            if not had_table:
+                conn.execute(f"DELETE FROM {qm}")
+            columns = [r[1] for r in conn.execute(f"PRAGMA table_info({qt})")]
+            new_cols = {}
+            for *_, df in loaded:
+                for c in df.columns:
+                    if c not in columns and c not in new_cols:
+                        new_cols[c] = 'INTEGER' if pd.api.types.is_integer_dtype(df[c]) else 'TEXT'
+            if not columns and new_cols:
+                defs = ', '.join(f"{_quote(c)} {t}" for c, t in new_cols.items())
+                conn.execute(f"CREATE TABLE {qt} ({defs})")
             else:
-                # OR: need to run separate queries for regex filters and union with existing df
-                frames = [df]
-                for col, q in post_regex_filters:
-                    # select all rows then filter
-                    all_df = pd.read_sql_query(f"SELECT * FROM {table_name}", conn)
-                    if col in all_df.columns:
-                        m = all_df[all_df[col].astype(str).str.contains(q, case=False, regex=True)]
-                        frames.append(m)
-                if frames:
-                    df = pd.concat(frames, ignore_index=True).drop_duplicates().reset_index(drop=True)
-
-        return df
-    finally:
-        conn.close()
+                for c, t in new_cols.items():
+                    conn.execute(f"ALTER TABLE {qt} ADD COLUMN {_quote(c)} {t}")
+            has_exact = exact and _table_exists(conn, table_name + EXACT_SUFFIX)
+
+            # 変わったファイル・消えたファイルの古い行を消す
+            for name in removed + [l[0] for l in loaded if l[0] in manifest]:
+                if has_exact:
+                    conn.execute(
+                        f"DELETE FROM {_quote(table_name + EXACT_SUFFIX)} "
+                        f"WHERE row IN (SELECT rowid FROM {qt} WHERE {_quote(SOURCE_COLUMN)} = ?)", (name,))
+                conn.execute(f"DELETE FROM {qt} WHERE {_quote(SOURCE_COLUMN)} = ?", (name,))
+                conn.execute(f"DELETE FROM {qm} WHERE source = ?", (name,))
+
+            for name, digest, size, mtime_ns, df in loaded:
+                first = conn.execute(f"SELECT coalesce(max(rowid), 0) FROM {qt}").fetchone()[0] + 1
+                qcols = ', '.join(_quote(c) for c in df.columns)
+                marks = ', '.join('?' for _ in df.columns)
+                values = df.astype(object).where(df.notna(), None).itertuples(index=False, name=None)
+                conn.executemany(f"INSERT INTO {qt} ({qcols}) VALUES ({marks})", values)
+                last = conn.execute(f"SELECT coalesce(max(rowid), 0) FROM {qt}").fetchone()[0]
+                if has_exact:
+                    conn.executemany(
+                        f"INSERT INTO {_quote(table_name + EXACT_SUFFIX)} (col, value, row) VALUES (?, ?, ?)",
+                        _exact_entries(conn, table_name, after_rowid=first - 1),
+                    )
+                conn.execute(
+                    f"INSERT OR REPLACE INTO {qm} VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (name, digest, size, mtime_ns, first, last, len(df), time.time()),
+                )
+            conn.executemany(f"UPDATE {qm} SET size = ?, mtime_ns = ? WHERE source = ?", touched)
+            conn.commit()
+        except BaseException:
+            conn.rollback()
+            raise
+
+        if _table_exists(conn, table_name):
+            columns = [r[1] for r in conn.execute(f"PRAGMA table_info({qt})")]
+            with conn:
+                for c in [c for c in INDEX_COLUMNS if c in columns] + [SOURCE_COLUMN]:
+                    if c in columns:
+                        conn.execute(
+                            f"CREATE INDEX IF NOT EXISTS {_quote(f'{table_name}_{c}_idx')} ON {qt} ({_quote(c)})")
+            if fts and (new_cols or not _table_exists(conn, table_name + FTS_SUFFIX)):
+                rebuild_fts(conn, table_name)
+            if exact and not has_exact:
+                rebuild_exact(conn, table_name)
+        return {
+            'imported': [l[0] for l in loaded],
+            'removed': removed,
+            'unchanged': unchanged,
+            'reports': reports,
+        }
+
+    def append_rows(self, rows: list, backup: bool = True) -> None:
+        """テーブルに複数行を1トランザクションで追加する。
+
+        既存の行は読み直さず、パラメータ化したINSERTのみを実行する（WALジャーナル）。
+        テーブルにない列が含まれていれば列を追加する。
+        backup=True の場合は追加した行を変更ログ（<db>.changelog.jsonl）に追記し、
+        ログが BACKUP_LOG_MAX_BYTES を超えたらテーブル全体を <db>.backup.csv に書き出してログを空にする。
+        変更ログとバックアップは行の追加と同じ BEGIN IMMEDIATE のトランザクションの中で書くので、
+        別のスレッドやプロセスからの追加と混ざらず、ログの並びはコミットの順になる。
+        """
+        rows = [dict(r) for r in rows]
+        if not rows:
+            return
+        table_name = self.table_name
+        qt = _quote(table_name)
+        conn = self.writer()
+        if not _table_exists(conn, table_name):
+            # 列の型だけ決めて空のテーブルを作り、行は下のトランザクションで入れる
+            try:
+                pd.DataFrame(rows).head(0).to_sql(table_name, conn, index=False)
+            except ValueError:
+                # 別の書き込みが先に作った
+                pass
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            columns = [r[1] for r in conn.execute(f"PRAGMA table_info({qt})")]
+            db_rows = rows
+            if any(is_normalized_column(c) for c in columns):
+                # シャドウ列のあるテーブルには正規化した値も書き込む
+                db_rows = [_with_normalized(row) for row in rows]
+            new_cols = []
+            for row in db_rows:
+                for c in row:
+                    if c not in columns and c not in new_cols:
+                        new_cols.append(c)
+            has_exact = _table_exists(conn, table_name + EXACT_SUFFIX)
+            last_rowid = conn.execute(f"SELECT coalesce(max(rowid), 0) FROM {qt}").fetchone()[0]
+            for c in new_cols:
+                conn.execute(f"ALTER TABLE {qt} ADD COLUMN {_quote(c)}")
+            # 列の並びごとにまとめてexecutemanyする
+            groups = {}
+            for row in db_rows:
+                groups.setdefault(tuple(row), []).append(tuple(row.values()))
+            for cols, values in groups.items():
+                qcols = ', '.join(_quote(c) for c in cols)
+                marks = ', '.join('?' for _ in cols)
+                conn.executemany(f"INSERT INTO {qt} ({qcols}) VALUES ({marks})", values)
+            if has_exact:
+                # 追加した行（rowid > last_rowid）の分だけ完全一致索引に登録する
+                conn.executemany(
+                    f"INSERT INTO {_quote(table_name + EXACT_SUFFIX)} (col, value, row) VALUES (?, ?, ?)",
+                    _exact_entries(conn, table_name, after_rowid=last_rowid),
+                )
+            if backup:
+                _write_changelog(self.db_path, table_name, rows)
+                if _changelog_path(self.db_path).stat().st_size > BACKUP_LOG_MAX_BYTES:
+                    compact_backup(self.db_path, table_name, conn)
+        if new_cols and _table_exists(conn, table_name + FTS_SUFFIX):
+            rebuild_fts(conn, table_name)
+
+
+_handles = {}
+_handles_lock = threading.Lock()
+
+
+def get_db(db_path: str, table_name: str = 'kakodata') -> KakoDB:
+    """(db_path, table_name) ごとにプロセス内で共有される KakoDB を返す。"""
+    key = (str(Path(db_path).resolve()), table_name)
+    with _handles_lock:
+        db = _handles.get(key)
+        if db is None:
+            db = _handles[key] = KakoDB(db_path, table_name)
+        return db
+
+
+def import_csv_to_db(csv_path: str, db_path: str, table_name: str = 'kakodata', if_exists: str = 'replace', fts: bool = True, normalized: bool = True, exact: bool = True) -> None:
+    """CSVを読み込んでSQLiteのテーブルに保存する（KakoDB.import_csv を参照）。"""
+    get_db(db_path, table_name).import_csv(csv_path, if_exists=if_exists, fts=fts, normalized=normalized, exact=exact)
+
+
+@traced('import_dir_to_db')
+def import_dir_to_db(dir_path: str, db_path: str, table_name: str = 'kakodata', fts: bool = True, normalized: bool = True, exact: bool = True) -> dict:
+    """ディレクトリ内のCSVを差分だけSQLiteのテーブルに取り込む（KakoDB.import_dir を参照）。"""
+    return get_db(db_path, table_name).import_dir(dir_path, fts=fts, normalized=normalized, exact=exact)
+
+
+def get_table_columns(db_path: str, table_name: str = 'kakodata') -> list:
+    return get_db(db_path, table_name).columns()
+
+
+@traced('search_db')
+def search_db(db_path: str, filters: list, table_name: str = 'kakodata', combine: str = 'AND') -> pd.DataFrame:
+    """filters: list of (column_name, query_string, mode)
+    mode: 'contains' | 'startswith' | 'regex' | 'exact'
+    KakoDB.search を参照。
+    """
+    return get_db(db_path, table_name).search(filters, combine=combine)
+
+
+def explain_db(db_path: str, filters: list, table_name: str = 'kakodata', combine: str = 'AND') -> str:
+    """search_db の実行計画を返す（KakoDB.explain を参照）。"""
+    return get_db(db_path, table_name).explain(filters, combine=combine)
+
+
+def append_rows_db(db_path: str, rows: list, table_name: str = 'kakodata', backup: bool = True) -> None:
+    """テーブルに複数行を1トランザクションで追加する（KakoDB.append_rows を参照）。"""
+    get_db(db_path, table_name).append_rows(rows, backup=backup)
 
 
 def append_row_db(db_path: str, row: dict, table_name: str = 'kakodata', backup: bool = True) -> None:
-    """テーブルに行を追加する。バックアップとしてテーブルをCSVにダンプするオプションあり。"""
-    conn = sqlite3.connect(db_path)
-    try:
-        df = pd.read_sql_query(f"SELECT * FROM {table_name}", conn)
-        new_df = pd.concat([df, pd.DataFrame([row])], ignore_index=True)
-        if backup:
-            ts = int(time.time())
-            backup_csv = Path(db_path).with_name(f"{Path(db_path).stem}.backup_{ts}.csv")
-            new_df.to_csv(backup_csv, index=False)
-        # replace table
-        new_df.to_sql(table_name, conn, if_exists='replace', index=False)
-    finally:
-        conn.close()
+    """テーブルに行を追加する。backup=True の場合は変更ログに追記する（append_rows_db を参照）。"""
+    append_rows_db(db_path, [row], table_name=table_name, backup=backup)
+
 
 if __name__ == '__main__':
     print('db_utils loaded')
@@ -0,0 +1,116 @@
+"""
+検索結果のハイライト表示用HTMLテーブルを生成する。
+
+- フィルタごとの正規表現は1回だけコンパイルし、同じ列のフィルタは1つのパターンにまとめる
+- contains/startswith は正規化した文字列で照合し、マッチ位置を元の文字列に戻してハイライトする
+- フィルタ対象の列だけマッチ箇所を<mark>で囲み、それ以外の列はエスケープのみ行う
+- 1ページ分の行だけを描画するので、描画時間はヒット件数ではなくページサイズで決まる
+"""
+import re
+from html import escape
+import pandas as pd
+from instrument import traced
+from normalize import find_spans, drop_normalized_columns
+
+
+DEFAULT_PAGE_SIZE = 100
+
+
+def compile_filters(filters: list) -> dict:
+    """filters (col, q, mode) から {列名: (正規表現 or None, [(クエリ, 前方一致か)])} を作る。
+
+    regex は1つのパターンにまとめてコンパイルし、不正な正規表現は無視する。
+    contains/startswith は検索と同じく正規化した文字列どうしで照合する。
+    """
+    regexes = {}
+    literals = {}
+    for item in filters:
+        if len(item) == 3:
+            col, q, mode = item
+        else:
+            col, q = item
+            mode = 'contains'
+        if not q or str(q).strip() == "":
+            continue
+        q = str(q)
+        if mode == 'range':
+            continue  # 年度の範囲はハイライトしない
+        if mode == 'regex':
+            try:
+                re.compile(q)
+            except re.error:
+                continue  # 不正な正規表現はスキップ
+            regexes.setdefault(col, []).append(q)
+        else:
+            literals.setdefault(col, []).append((q, mode == 'startswith'))
+    compiled = {}
+    for col in set(regexes) | set(literals):
+        patterns = regexes.get(col)
+        regex = re.compile('|'.join(f'(?:{p})' for p in patterns), re.IGNORECASE) if patterns else None
+        compiled[col] = (regex, literals.get(col, []))
+    return compiled
+
+
+def _spans(text: str, matcher: tuple) -> list:
+    regex, literals = matcher
+    spans = []
+    if regex is not None:
+        spans.extend(m.span() for m in regex.finditer(text) if m.end() > m.start())
+    for q, prefix in literals:
+        spans.extend(find_spans(text, q, prefix=prefix))
+    spans.sort()
+    # 重なったマッチは1つにまとめる
+    merged = []
+    for start, end in spans:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _mark(text: str, matcher: tuple) -> str:
+    """マッチした部分を<mark>で囲み、それ以外をエスケープする。"""
+    out = []
+    pos = 0
+    for start, end in _spans(text, matcher):
+        out.append(escape(text[pos:start]))
+        out.append('<mark>' + escape(text[start:end]) + '</mark>')
+        pos = end
+    out.append(escape(text[pos:]))
+    return ''.join(out)
+
+
+def _escape_series(s: pd.Series) -> pd.Series:
+    return (s.str.replace('&', '&amp;', regex=False)
+             .str.replace('<', '&lt;', regex=False)
+             .str.replace('>', '&gt;', regex=False)
+             .str.replace('"', '&quot;', regex=False)
+             .str.replace("'", '&#x27;', regex=False))
+
+
+def page_count(total: int, page_size: int = DEFAULT_PAGE_SIZE) -> int:
+    return max(1, -(-total // page_size))
+
+
+@traced('render_table_html')
+def render_table_html(df: pd.DataFrame, filters: list, page_size: int = DEFAULT_PAGE_SIZE, offset: int = 0) -> str:
+    """df の offset 行目から page_size 行を、検索語をハイライトしたHTMLテーブルにする。"""
+    page = drop_normalized_columns(df.iloc[offset:offset + page_size])
+    matchers = compile_filters(filters)
+
+    cells = []
+    for column in page.columns:
+        values = page[column].astype(str)
+        matcher = matchers.get(column)
+        if matcher is None:
+            cells.append(_escape_series(values).tolist())
+        else:
+            cells.append([_mark(v, matcher) for v in values])
+
+    header = ''.join(f"<th>{escape(str(c))}</th>" for c in page.columns)
+    body = ''.join(
+        '<tr>' + ''.join(f"<td>{v}</td>" for v in row) + '</tr>'
+        for row in zip(*cells)
+    )
+    return f"<table><thead><tr>{header}</tr></thead><tbody>{body}</tbody></table>"
@@ -0,0 +1,150 @@
+"""
+CSVの取り込み: スキーマを指定した型付きの読み込み、チャンク単位の読み込み、並列読み込み。
+
+- 年度の列は整数、それ以外の列は文字列として読む（型推論をしない）
+- 大きなファイルは CHUNK_ROWS 行ずつ読み、チャンクごとに型を変換する
+- 年度が空欄の行は欠損として残し、整数として読めない値の行は取り込まずに件数を数える
+- 複数ファイルはスレッドプールで並列に読み、ファイルごとの結果（FileReport）を返す
+  読めなかったファイルも黙って飛ばさず、error に理由を入れて返す
+"""
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import time
+import numpy as np
+import pandas as pd
+
+
+YEAR_COLUMNS = ('年度', '年', 'year')
+# 1回に読む行数（ピーク時のメモリはおおよそこの行数分のパース結果で決まる）
+CHUNK_ROWS = 100_000
+
+
+class FileReport:
+    """1ファイル分の取り込み結果。"""
+
+    def __init__(self, name: str, rows_read: int = 0, rows_rejected: int = 0, seconds: float = 0.0, error: str = None):
+        self.name = name
+        self.rows_read = rows_read
+        self.rows_rejected = rows_rejected
+        self.seconds = seconds
+        self.error = error
+
+    @property
+    def ok(self) -> bool:
+        return self.error is None
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            'rows_read': self.rows_read,
+            'rows_rejected': self.rows_rejected,
+            'seconds': round(self.seconds, 6),
+            'error': self.error,
+        }
+
+    def __repr__(self) -> str:
+        return f"FileReport({self.to_dict()!r})"
+
+
+def report_problems(reports) -> list:
+    """読めなかったファイルと、行を除いたファイルの内訳を1行ずつの文字列にする（CLIの表示用）。"""
+    lines = []
+    for r in reports:
+        if not r.ok:
+            lines.append(f"{r.name}: {r.error}")
+        elif r.rows_rejected:
+            lines.append(f"{r.name}: rejected {r.rows_rejected} of {r.rows_read} rows (year is not an integer)")
+    return lines
+
+
+def default_schema(columns) -> dict:
+    """列名からスキーマ {列名: 'int' | 'str'} を作る。年度の列だけ整数にする（空欄があれば欠損を含む float64）。"""
+    return {c: 'int' if str(c).lower() in YEAR_COLUMNS else 'str' for c in columns}
+
+
+def _source_name(source) -> str:
+    return str(getattr(source, 'name', source))
+
+
+def _apply_schema(chunk: pd.DataFrame, schema: dict) -> tuple:
+    """チャンクを schema の型にそろえ、(型変換したチャンク, 取り込めなかった行数) を返す。"""
+    keep = np.ones(len(chunk), dtype=bool)
+    ints = {}
+    for col, kind in schema.items():
+        if kind != 'int' or col not in chunk.columns:
+            continue
+        text = chunk[col].str.strip()
+        values = pd.to_numeric(text, errors='coerce')
+        # 空欄は欠損（NaN）として残し、数値として読めない値・整数でない値の行だけを除く
+        blank = text.isna() | (text == '')
+        valid = blank | (values.notna() & (values == values.round()))
+        keep &= valid.fillna(False).to_numpy(dtype=bool)
+        ints[col] = values
+    if not keep.all():
+        chunk = chunk[keep]
+    if ints:
+        # 欠損がなければ int64、あれば float64（pd.read_csv と同じ）
+        chunk = chunk.assign(**{col: v[keep].astype('int64') if v[keep].notna().all() else v[keep].astype('float64')
+                                for col, v in ints.items()})
+    return chunk, int((~keep).sum())
+
+
+def iter_csv_chunks(source, schema: dict = None, chunksize: int = CHUNK_ROWS):
+    """CSVを chunksize 行ずつ読み、(型変換したチャンク, 取り込めなかった行数) を順に返す。
+
+    source はパスかファイルオブジェクト。schema を省略すると default_schema を使う。
+    """
+    reader = pd.read_csv(source, dtype=str, chunksize=chunksize)
+    with reader:
+        for chunk in reader:
+            if schema is None:
+                schema = default_schema(chunk.columns)
+            yield _apply_schema(chunk, schema)
+
+
+def read_csv_typed(source, schema: dict = None, chunksize: int = CHUNK_ROWS) -> tuple:
+    """CSVを1ファイル読み、(DataFrame or None, FileReport) を返す。読めなかった場合は DataFrame が None。"""
+    report = FileReport(_source_name(source))
+    start = time.perf_counter()
+    try:
+        frames = []
+        for chunk, rejected in iter_csv_chunks(source, schema, chunksize):
+            report.rows_read += len(chunk) + rejected
+            report.rows_rejected += rejected
+            frames.append(chunk)
+        if not frames:
+            df = pd.DataFrame()
+        else:
+            df = pd.concat(frames, ignore_index=True) if len(frames) > 1 else frames[0].reset_index(drop=True)
+    except Exception as e:
+        df = None
+        report.error = f"{type(e).__name__}: {e}"
+    report.seconds = time.perf_counter() - start
+    return df, report
+
+
+def read_files(sources: list, schema: dict = None, max_workers: int = None, chunksize: int = CHUNK_ROWS) -> list:
+    """複数のCSVを並列に読み、元の順に [(DataFrame or None, FileReport)] を返す。"""
+    if not sources:
+        return []
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        return list(ex.map(lambda s: read_csv_typed(s, schema, chunksize), sources))
+
+
+def ingest_files(sources: list, schema: dict = None, max_workers: int = None, chunksize: int = CHUNK_ROWS) -> tuple:
+    """複数のCSVを並列に読み、元の順に結合した DataFrame とファイルごとの FileReport のリストを返す。"""
+    if not sources:
+        return pd.DataFrame(), []
+    results = read_files(sources, schema, max_workers, chunksize)
+    dfs = [df for df, _ in results if df is not None]
+    reports = [r for _, r in results]
+    combined = pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame()
+    return combined, reports
+
+
+def ingest_dir(dir_path: str, schema: dict = None, max_workers: int = None, chunksize: int = CHUNK_ROWS) -> tuple:
+    """ディレクトリ内の全てのCSV（ファイル名順）を ingest_files で読む。"""
+    p = Path(dir_path)
+    if not p.exists() or not p.is_dir():
+        raise FileNotFoundError(f"Directory not found: {dir_path}")
+    return ingest_files(sorted(p.glob('*.csv')), schema, max_workers, chunksize)
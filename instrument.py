@@ -0,0 +1,196 @@
+"""
+処理段階ごとの計測（span）。
+
+    with span('sort', rows_in=len(df)) as s:
+        res = ...
+        s.set(rows_out=len(res))
+
+    @traced('search_df')
+    def search_df(df, ...): ...
+
+記録は既定でオフ。オフのときは span() が何もしないオブジェクトを返し、traced は関数をそのまま
+呼ぶだけなので、コストはフラグの確認1回分しかかからない。enable() でプロセス全体、
+set_thread_enabled() で呼び出したスレッド（Streamlit ではセッションの実行スレッド）だけを記録する。
+環境変数 KAKOMON_TRACE=1 なら起動時から記録する。
+
+1件の記録は 名前・開始時刻・所要時間・入出力の行数・メモリ（RSS）の増減・スレッド・入れ子の深さ。
+直近 MAX_RECORDS 件をプロセス内に持ち、records() で取り出し、to_jsonl() / export_jsonl() で
+JSON Lines にできる。
+"""
+from collections import deque
+import functools
+import itertools
+import json
+import os
+import threading
+import time
+
+
+MAX_RECORDS = 10_000
+
+_enabled = os.environ.get('KAKOMON_TRACE', '') not in ('', '0')
+_local = threading.local()
+_records = deque(maxlen=MAX_RECORDS)
+_records_lock = threading.Lock()
+_seq = itertools.count(1)
+
+try:
+    _PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError):  # Windows など
+    _PAGE_SIZE = None
+
+
+def _rss():
+    """現在の常駐メモリ（バイト）。取れない環境では None。"""
+    if _PAGE_SIZE is None:
+        return None
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def enable() -> None:
+    global _enabled
+    _enabled = True
+
+
+def disable() -> None:
+    global _enabled
+    _enabled = False
+
+
+def set_thread_enabled(flag: bool) -> None:
+    """呼び出したスレッドだけ記録をオン／オフにする。"""
+    _local.enabled = bool(flag)
+
+
+def is_enabled() -> bool:
+    return _enabled or getattr(_local, 'enabled', False)
+
+
+def _rows(obj):
+    shape = getattr(obj, 'shape', None)
+    return shape[0] if shape else None
+
+
+class Span:
+    """1区間の計測。with で使う。"""
+
+    def __init__(self, name: str, rows_in=None, **meta):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.meta = meta
+
+    def set(self, rows_out=None, **meta) -> None:
+        if rows_out is not None:
+            self.rows_out = rows_out
+        self.meta.update(meta)
+
+    def __enter__(self):
+        self._depth = getattr(_local, 'depth', 0)
+        _local.depth = self._depth + 1
+        self._start = time.time()
+        self._mem = _rss()
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        seconds = time.perf_counter() - self._t0
+        mem = _rss()
+        _local.depth = self._depth
+        record = {
+            'seq': next(_seq),
+            'name': self.name,
+            'start': self._start,
+            'seconds': seconds,
+            'rows_in': self.rows_in,
+            'rows_out': self.rows_out,
+            'mem_delta_bytes': mem - self._mem if mem is not None and self._mem is not None else None,
+            'thread': threading.get_ident(),
+            'depth': self._depth,
+        }
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+        if self.meta:
+            record['meta'] = self.meta
+        with _records_lock:
+            _records.append(record)
+        return False
+
+
+class _NullSpan:
+    """記録がオフのときの span。何もしない。"""
+
+    def set(self, rows_out=None, **meta) -> None:
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name: str, rows_in=None, **meta):
+    """区間を計測するコンテキストマネージャ。記録がオフなら何もしない。"""
+    if not (_enabled or getattr(_local, 'enabled', False)):
+        return _NULL_SPAN
+    return Span(name, rows_in, **meta)
+
+
+def traced(name: str):
+    """関数の呼び出しを span で囲むデコレータ。
+
+    第1引数と戻り値が DataFrame（shape を持つもの）なら、その行数を入出力の行数として記録する。
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not (_enabled or getattr(_local, 'enabled', False)):
+                return fn(*args, **kwargs)
+            with Span(name, _rows(args[0]) if args else None) as s:
+                result = fn(*args, **kwargs)
+                s.rows_out = _rows(result)
+                return result
+        return wrapper
+    return decorator
+
+
+def last_seq() -> int:
+    """これまでの記録の最後の通し番号（records(since=...) の目印）。"""
+    with _records_lock:
+        return _records[-1]['seq'] if _records else 0
+
+
+def records(since: int = 0, thread: int = None) -> list:
+    """記録のリスト（古い順）。since より後の通し番号のもの、thread を指定すればそのスレッドのものだけ。"""
+    with _records_lock:
+        snapshot = list(_records)
+    return [r for r in snapshot if r['seq'] > since and (thread is None or r['thread'] == thread)]
+
+
+def clear() -> None:
+    with _records_lock:
+        _records.clear()
+
+
+def to_jsonl(recs: list = None) -> str:
+    """記録を JSON Lines の文字列にする（省略時は全件）。"""
+    if recs is None:
+        recs = records()
+    return ''.join(json.dumps(r, ensure_ascii=False, default=str) + '\n' for r in recs)
+
+
+def export_jsonl(path: str, recs: list = None) -> int:
+    """記録を JSON Lines としてファイルに追記し、書いた件数を返す。"""
+    if recs is None:
+        recs = records()
+    with open(path, 'a', encoding='utf-8') as f:
+        f.write(to_jsonl(recs))
+    return len(recs)
@@ -0,0 +1,167 @@
+"""
+CSVスナップショットキャッシュ: ディレクトリ内のCSVをファイル単位のフィンガープリントで管理し、
+プロセス内の全セッションで共有する。
+
+- フィンガープリント: (パス, サイズ, mtime, 内容ハッシュ)
+- パースしたCSVはファイル単位（年度単位）でディスクにバイナリスナップショットとして保存し、
+  コールドスタート時もCSVを再パースしない。
+- 1ファイルだけ変更された場合は、そのファイルだけを読み直す。
+- スナップショットがないファイルは ingest の型付き読み込みで並列にパースする。
+  ファイルごとの取り込み結果（ingest.FileReport）もスナップショットと一緒に残し、file_report で返す。
+"""
+from pathlib import Path
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from ingest import read_csv_typed, FileReport
+
+
+SNAPSHOT_DIRNAME = '.snapshot'
+# 読み込み方（型など）を変えたら上げる。古い形式のスナップショットは使わない。
+SNAPSHOT_FORMAT = 3
+
+_lock = threading.RLock()
+# path -> ((size, mtime_ns), fingerprint, DataFrame or None, FileReport)
+_partitions = {}
+# dir -> (fingerprints, DataFrame, version)
+_combined = {}
+
+
+def _file_hash(path: Path) -> str:
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def file_fingerprint(path: str) -> tuple:
+    """ファイルのフィンガープリント (パス, サイズ, mtime_ns, sha1) を返す。"""
+    p = Path(path)
+    st = p.stat()
+    return (str(p), st.st_size, st.st_mtime_ns, _file_hash(p))
+
+
+def _read_partition(path: Path) -> tuple:
+    """CSVを1ファイル読み込み、(DataFrame or None, FileReport) を返す（ingest.read_csv_typed）。
+    読めないファイルの DataFrame は None（load_csvs_from_dirと同じくスキップ扱い。理由は FileReport にある）。"""
+    return read_csv_typed(path)
+
+
+def _snapshot_path(cache_dir: Path, digest: str) -> Path:
+    return cache_dir / f"{digest}.v{SNAPSHOT_FORMAT}.pkl"
+
+
+def _load_partition(path: Path, cache_dir: Path):
+    """1ファイル分のDataFrameとフィンガープリントを返す。メモリ→ディスク→CSVの順に探す。"""
+    key = str(path)
+    st = path.stat()
+    stat_key = (st.st_size, st.st_mtime_ns)
+    cached = _partitions.get(key)
+    if cached is not None and cached[0] == stat_key:
+        return cached[1], cached[2]
+
+    digest = _file_hash(path)
+    fp = (key, st.st_size, st.st_mtime_ns, digest)
+    if cached is not None and cached[1][3] == digest:
+        # touchされただけで内容は同じ
+        _partitions[key] = (stat_key, fp, cached[2], cached[3])
+        return fp, cached[2]
+    if cached is not None:
+        # 古い内容のスナップショットは不要になる
+        try:
+            _snapshot_path(cache_dir, cached[1][3]).unlink()
+        except OSError:
+            pass
+
+    snap = _snapshot_path(cache_dir, digest)
+    df = None
+    if snap.exists():
+        try:
+            saved = pd.read_pickle(snap)
+            df, report = saved['frame'], FileReport(**saved['report'])
+        except Exception:
+            df = None
+    if df is None:
+        df, report = _read_partition(path)
+        if df is not None:
+            _write_snapshot(df, report, snap)
+    _partitions[key] = (stat_key, fp, df, report)
+    return fp, df
+
+
+def _write_snapshot(df: pd.DataFrame, report: FileReport, snap: Path) -> None:
+    try:
+        snap.parent.mkdir(parents=True, exist_ok=True)
+        tmp = snap.with_name(f"{snap.name}.{os.getpid()}.tmp")
+        pd.to_pickle({'frame': df, 'report': report.to_dict()}, tmp)
+        os.replace(tmp, snap)
+    except OSError:
+        # 書き込めない環境（読み取り専用FSなど）ではメモリキャッシュのみで動く
+        pass
+
+
+def load_partition(path: str, cache_dir: str = None) -> tuple:
+    """CSVを1ファイルだけ (フィンガープリント, DataFrame or None) で返す。スナップショットは load_snapshot と共有する。"""
+    p = Path(path)
+    cdir = Path(cache_dir) if cache_dir is not None else p.parent / SNAPSHOT_DIRNAME
+    with _lock:
+        return _load_partition(p, cdir)
+
+
+def file_report(path: str) -> FileReport:
+    """読み込み済みのCSVの取り込み結果（FileReport）。まだ読み込んでいなければ None。"""
+    with _lock:
+        cached = _partitions.get(str(Path(path)))
+    return cached[3] if cached is not None else None
+
+
+def data_version(fingerprints) -> str:
+    """ファイルのフィンガープリントの列からデータバージョン文字列を作る（ファイル名と内容ハッシュで決まる）。"""
+    h = hashlib.sha1()
+    for fp in fingerprints:
+        h.update(f"{Path(fp[0]).name}:{fp[3]}\n".encode('utf-8'))
+    return h.hexdigest()[:16]
+
+
+def load_snapshot(dir_path: str, cache_dir: str = None) -> tuple:
+    """ディレクトリ内の全CSVを結合したDataFrameと、そのデータバージョン文字列を返す。
+
+    結果は load_csvs_from_dir と同じ内容。返すDataFrameは全セッションで共有されるため、
+    呼び出し側で破壊的に変更しないこと。
+    """
+    p = Path(dir_path)
+    if not p.exists() or not p.is_dir():
+        raise FileNotFoundError(f"Directory not found: {dir_path}")
+    cdir = Path(cache_dir) if cache_dir is not None else p / SNAPSHOT_DIRNAME
+    csv_files = sorted(p.glob('*.csv'))
+
+    with _lock:
+        # スナップショットがないファイルのパースは並列に行う
+        with ThreadPoolExecutor() as ex:
+            parts = list(ex.map(lambda f: _load_partition(f, cdir), csv_files))
+        fingerprints = tuple(fp for fp, _ in parts)
+        dir_key = str(p.resolve())
+        cached = _combined.get(dir_key)
+        if cached is not None and cached[0] == fingerprints:
+            return cached[1], cached[2]
+
+        dfs = [df for _, df in parts if df is not None]
+        combined = pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame()
+        version = data_version(fingerprints)
+        _combined[dir_key] = (fingerprints, combined, version)
+        return combined, version
+
+
+def load_csvs_cached(dir_path: str, cache_dir: str = None) -> pd.DataFrame:
+    """load_csvs_from_dir のキャッシュ版。"""
+    return load_snapshot(dir_path, cache_dir)[0]
+
+
+def clear_cache() -> None:
+    """プロセス内のメモリキャッシュを破棄する（ディスクのスナップショットは残る）。"""
+    with _lock:
+        _partitions.clear()
+        _combined.clear()
@@ -1,10 +1,31 @@
 """
 CSV読み込み・検索・追記のユーティリティ
 """
+from contextlib import contextmanager
 from pathlib import Path
+import csv
+import json
+import os
+import re
+import unicodedata
+import numpy as np
 import pandas as pd
 import shutil
 import time
+from ingest import ingest_dir, YEAR_COLUMNS
+from instrument import traced
+from normalize import normalized_column, normalize_text
+from query_planner import make_plan, sample_positions
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
 
 
 def load_csv(path: str) -> pd.DataFrame:
@@ -15,26 +36,18 @@ def load_csv(path: str) -> pd.DataFrame:
     return pd.read_csv(p)
 
 
-def load_csvs_from_dir(dir_path: str) -> pd.DataFrame:
+@traced('load_csvs_from_dir')
+def load_csvs_from_dir(dir_path: str, reports: list = None) -> pd.DataFrame:
     """指定ディレクトリ内の全てのCSVを読み込み、結合して返す。
     ファイルがない場合は空のDataFrameを返す。
+    年度の列は整数（空欄があれば欠損を含む float）、それ以外は文字列として並列に読む。
+    読めなかったファイルと、年度が数値として読めない行は結果に含まれない。
+    reports にリストを渡すと、ファイルごとの内訳（ingest.FileReport）を追加する。
     """
-    p = Path(dir_path)
-    if not p.exists() or not p.is_dir():
-        raise FileNotFoundError(f"Directory not found: {dir_path}")
-    csv_files = sorted(p.glob('*.csv'))
-    if not csv_files:
-        return pd.DataFrame()
-    dfs = []
-    for f in csv_files:
-        try:
-            dfs.append(pd.read_csv(f))
-        except Exception:
-            # skip unreadable files
-            continue
-    if not dfs:
-        return pd.DataFrame()
-    return pd.concat(dfs, ignore_index=True)
+    df, file_reports = ingest_dir(dir_path)
+    if reports is not None:
+        reports.extend(file_reports)
+    return df
 
 
 def get_columns(path: str) -> list:
@@ -43,89 +56,381 @@ def get_columns(path: str) -> list:
     return list(df.columns)
 
 
+def _parse_filter(item) -> tuple:
+    """(col, q) または (col, q, mode) を (col, q, mode) にそろえる。"""
+    # item can be (col, q) or (col, q, mode)
+    if len(item) == 3:
+        return tuple(item)
+    col, q = item
+    return col, q, 'contains'
+
+
+_YEAR_RANGE_RE = re.compile(r'(\d{4})?(?:\s*(-|~|〜|\.\.)\s*(\d{4})?)?')
+
+
+def parse_year_range(q) -> tuple:
+    """年度の指定を (下限, 上限) にする（両端を含み、省略した端は None）。
+
+    '2019' -> (2019, 2019)、'2019-2023' -> (2019, 2023)、'2019-' -> (2019, None)、'-2020' -> (None, 2020)
+    全角数字や「〜」も使える。年度の範囲として読めない場合は None を返す。
+    """
+    m = _YEAR_RANGE_RE.fullmatch(unicodedata.normalize('NFKC', str(q)).strip())
+    if m is None:
+        return None
+    lo, sep, hi = m.groups()
+    if sep is None:
+        return (int(lo), int(lo)) if lo else None
+    if lo is None and hi is None:
+        return None
+    lo = int(lo) if lo else None
+    hi = int(hi) if hi else None
+    if lo is not None and hi is not None and lo > hi:
+        lo, hi = hi, lo
+    return lo, hi
+
+
+def in_year_range(year, bounds: tuple) -> bool:
+    """整数の年度 year が parse_year_range の範囲に入るか。"""
+    if year is None:
+        return False
+    lo, hi = bounds
+    return (lo is None or year >= lo) and (hi is None or year <= hi)
+
+
+# 「小粥太郎・石川博康」のように複数の値を区切って持つ列（完全一致では1人ずつ照合する）
+MULTI_VALUE_SEP = '・'
+MULTI_VALUE_COLUMNS = ('教員', 'teacher', '教員名', 'instructor')
+
+
+def exact_keys(value: str, multi: bool = False) -> set:
+    """完全一致の照合キー（小文字化した値全体と、multi なら区切った各要素）。"""
+    low = value.lower()
+    keys = {low}
+    if multi:
+        keys.update(p.strip() for p in low.split(MULTI_VALUE_SEP) if p.strip())
+    return keys
+
+
+def _filter_target(df: pd.DataFrame, col, q, mode: str) -> tuple:
+    """フィルタを評価する (列, クエリ, モード) を返す。
+
+    正規化済みのシャドウ列があれば、contains/startswith/exact は正規化したクエリで
+    シャドウ列に対して評価する（'substring' / 'prefix' はリテラル一致）。
+    exact は複数の値を持つ列（MULTI_VALUE_COLUMNS）なら 'exact_multi' になる。
+    range は元の列の数値で評価する。
+    """
+    ncol = normalized_column(col)
+    if mode == 'exact':
+        emode = 'exact_multi' if col in MULTI_VALUE_COLUMNS else 'exact'
+        if ncol in df.columns:
+            return ncol, normalize_text(str(q).strip()), emode
+        return col, str(q).strip().lower(), emode
+    if mode not in ('regex', 'range') and ncol in df.columns:
+        return ncol, normalize_text(str(q)), 'prefix' if mode == 'startswith' else 'substring'
+    return col, q, mode
+
+
+def _predicate_mask(s: pd.Series, q, mode: str) -> pd.Series:
+    """文字列化済みのSeriesに1つのフィルタを適用したbool Seriesを返す。"""
+    if mode in ('exact', 'exact_multi'):
+        multi = mode == 'exact_multi'
+        hits = [v for v in pd.unique(s.dropna()) if q in exact_keys(v, multi)]
+        return s.isin(hits)
+    elif mode == 'range':
+        bounds = parse_year_range(q)
+        if bounds is None:
+            return pd.Series(False, index=s.index)
+        years = pd.to_numeric(s, errors='coerce')
+        lo, hi = bounds
+        m = years.notna()
+        if lo is not None:
+            m &= years >= lo
+        if hi is not None:
+            m &= years <= hi
+        return m
+    elif mode == 'substring':
+        return s.str.contains(str(q), regex=False, na=False)
+    elif mode == 'prefix':
+        return s.str.startswith(str(q), na=False)
+    elif mode == 'contains':
+        return s.str.contains(str(q), case=False, na=False)
+    elif mode == 'startswith':
+        return s.str.lower().str.startswith(str(q).lower(), na=False)
+    elif mode == 'regex':
+        return s.str.contains(str(q), case=False, na=False, regex=True)
+    return s.str.contains(str(q), case=False, na=False)
+
+
+def _column_mask(s: pd.Series, q, mode: str) -> pd.Series:
+    """列に1つのフィルタを適用したbool Seriesを返す。
+
+    カテゴリ型（辞書エンコード済み）の列は、述語を重複のない値（categories）にだけ適用し、
+    コードを通して行のマスクに展開する。欠損値は一致しない。
+    """
+    if isinstance(s.dtype, pd.CategoricalDtype):
+        cats = pd.Series(s.cat.categories).astype(str)
+        cat_mask = _predicate_mask(cats, q, mode).to_numpy(dtype=bool)
+        codes = s.cat.codes.to_numpy()
+        m = np.zeros(len(s), dtype=bool)
+        present = codes >= 0
+        m[present] = cat_mask[codes[present]]
+        return pd.Series(m, index=s.index)
+    if isinstance(s.dtype, pd.StringDtype):
+        # 文字列型（Arrow の文字列を含む）はそのまま評価する（astype(str) のコピーを作らない）
+        return _predicate_mask(s, q, mode)
+    return _predicate_mask(s.astype(str), q, mode)
+
+
+def encode_columns(df: pd.DataFrame, columns: list = None, max_ratio: float = 0.5) -> pd.DataFrame:
+    """文字列の列をカテゴリ型（コード＋重複のない値の表）に変換したDataFrameを返す。
+
+    columns を省略した場合は、重複のない値の数が行数の max_ratio 以下の文字列列を対象にする
+    （授業名・教員名のように毎年同じ値が繰り返される列）。
+    """
+    if df is None or df.empty:
+        return df
+    if columns is None:
+        columns = [
+            c for c in df.columns
+            if (pd.api.types.is_object_dtype(df[c]) or pd.api.types.is_string_dtype(df[c]))
+            and df[c].nunique(dropna=True) <= len(df) * max_ratio
+        ]
+    return df.assign(**{c: df[c].astype('category') for c in columns})
+
+
+# 1 なら年度ごとのストア（partition_store.open_store）を既定でコンパクトモードにする
+COMPACT_ENV = 'KAKOMON_COMPACT'
+_INT16 = np.iinfo(np.int16)
+
+
+def compact_default() -> bool:
+    """環境変数 KAKOMON_COMPACT でコンパクトモードが指定されているか。"""
+    return os.environ.get(COMPACT_ENV, '') not in ('', '0')
+
+
+def arrow_string_dtype():
+    """Arrow の文字列型（欠損値は NaN）。pyarrow がなければ None。"""
+    if pyarrow is None:
+        return None
+    try:
+        return pd.StringDtype('pyarrow', na_value=np.nan)
+    except TypeError:  # pandas 2.3 より前
+        return pd.StringDtype('pyarrow')
+
+
+def compact_columns(df: pd.DataFrame, year_col=None) -> pd.DataFrame:
+    """メモリの少ない型にしたDataFrameを返す（コンパクトモード）。
+
+    - カテゴリ型以外の文字列の列は Arrow の文字列型（Pythonの文字列オブジェクトを行ごとに持たない）
+    - 年度の列（year_col、省略時は YEAR_COLUMNS の名前の列）は欠損がなく範囲に収まれば int16
+    pyarrow がなければ文字列の列はそのまま。すでにその型の列は変換しない。
+    """
+    if df is None or df.empty:
+        return df
+    if year_col is None:
+        year_col = next((c for c in df.columns if str(c).lower() in YEAR_COLUMNS), None)
+    sdtype = arrow_string_dtype()
+    changes = {}
+    for c in df.columns:
+        s = df[c]
+        if c == year_col:
+            if (pd.api.types.is_integer_dtype(s) and s.dtype != np.int16 and not s.isna().any()
+                    and _INT16.min <= s.min() and s.max() <= _INT16.max):
+                changes[c] = s.astype(np.int16)
+        elif sdtype is not None and s.dtype != sdtype and not isinstance(s.dtype, pd.CategoricalDtype) \
+                and (pd.api.types.is_object_dtype(s) or pd.api.types.is_string_dtype(s)):
+            changes[c] = s.astype(sdtype)
+    return df.assign(**changes) if changes else df
+
+
+def latest_positions(df: pd.DataFrame, year_col, n: int = None) -> np.ndarray:
+    """年度の降順（同じ年度は元の順、年度のない行は最後）に並べた行位置（n 件まで）。df は変更しない。"""
+    if year_col is None or year_col not in df.columns:
+        order = np.arange(len(df))
+    else:
+        years = pd.to_numeric(df[year_col], errors='coerce').to_numpy(dtype=float)
+        order = np.argsort(-years, kind='stable')
+    return order if n is None else order[:n]
+
+
+def _df_estimator(df: pd.DataFrame):
+    """search_df 用の見積もり。カテゴリ型の列は重複のない値の出現回数から実際の割合を、それ以外は標本の行から見積もる。"""
+    def estimate(step, rank):
+        if step.col not in df.columns:
+            step.estimate, step.source, step.exact = 0.0, 'missing', True
+            return
+        step.target = _filter_target(df, step.col, step.q, step.mode)
+        if not rank:
+            return
+        tcol, tq, tmode = step.target
+        s = df[tcol]
+        if isinstance(s.dtype, pd.CategoricalDtype):
+            # 重複のない値ごとの一致を求め、標本の行のコードで割合にする。カテゴリごとの一致は評価でもそのまま使う
+            cat_mask = _predicate_mask(pd.Series(s.cat.categories).astype(str), tq, tmode).to_numpy(dtype=bool)
+            codes = s.cat.codes.to_numpy()[sample_positions(len(s))]
+            hit = cat_mask[codes] & (codes >= 0) if len(cat_mask) else np.zeros(len(codes), dtype=bool)
+            step.estimate = float(hit.mean())
+            # どの値にも一致しなければ、見積もりではなく確かに0件
+            step.source, step.exact, step.state = 'categories', not cat_mask.any(), cat_mask
+        else:
+            m = _column_mask(s.iloc[sample_positions(len(s))], tq, tmode).to_numpy(dtype=bool)
+            step.estimate, step.source = float(m.mean()), 'sample'
+    return estimate
+
+
+def _df_evaluator(df: pd.DataFrame):
+    """search_df 用の評価: positions の行だけにフィルタを適用する。"""
+    def evaluate(step, positions):
+        tcol, tq, tmode = step.target
+        s = df[tcol]
+        if step.state is not None:
+            codes = s.cat.codes.to_numpy()
+            if positions is not None:
+                codes = codes[positions]
+            if len(step.state) == 0:
+                return np.zeros(len(codes), dtype=bool)
+            return (codes >= 0) & step.state[codes]
+        if positions is not None:
+            s = s.iloc[positions]
+        return _column_mask(s, tq, tmode).to_numpy(dtype=bool)
+    return evaluate
+
+
+def plan_df(df: pd.DataFrame, filters: list, combine: str = 'AND'):
+    """search_df の実行計画（query_planner.Plan）を作る。空のクエリのフィルタは除く。"""
+    items = []
+    for item in filters:
+        col, q, mode = _parse_filter(item)
+        if not q or str(q).strip() == "":
+            continue
+        items.append((col, q, mode))
+    return make_plan(items, combine, 0 if df is None else len(df), _df_estimator(df))
+
+
+def explain_df(df: pd.DataFrame, filters: list, combine: str = 'AND') -> str:
+    """search_df と同じ検索を実行し、選んだ評価順と各フィルタで評価した行数・一致した行数を返す。"""
+    plan = plan_df(df, filters, combine)
+    if df is not None and not df.empty and plan.steps:
+        plan.execute(_df_evaluator(df))
+    return plan.explain()
+
+
+@traced('search_df')
 def search_df(df: pd.DataFrame, filters: list, combine: str = 'AND') -> pd.DataFrame:
     """検索を行う。
 
     filters: list of (column_name, query_string, mode)
-      mode: 'contains' | 'startswith' | 'regex'
+      mode: 'contains' | 'startswith' | 'regex' | 'exact' | 'range'
     query が空文字または空白のみの場合はそのフィルタは無視される。
+    'exact' は値全体の一致（前後の空白は無視）。教員名の列は「・」で区切った1人ずつとも照合する。
+    'range' は年度などの数値の範囲（'2019-2023'、'2019-' など。parse_year_range を参照）。
     大文字小文字は無視して検索（case-insensitive）、ただし'regex'はユーザ指定に従う。
     複数フィルタはANDで結合。
+    df に正規化済みのシャドウ列（normalize.add_normalized_columns）があれば、
+    contains/startswith は正規化した文字列どうしのリテラル一致になる（「民法Ⅲ」で「民法３」もヒット）。
+    カテゴリ型の列（encode_columns）は重複のない値に対してだけ述語を評価する。
+    フィルタは query_planner の計画の順に、前のフィルタで残った行（OR ではまだ一致していない行）だけに適用する
+    （評価順は explain_df で確認できる）。
     """
     if df is None or df.empty:
         return df
 
-    if combine not in ('AND', 'OR'):
-        combine = 'AND'
+    plan = plan_df(df, filters, combine)
+    if not plan.steps:
+        return df
+    return df.iloc[plan.execute(_df_evaluator(df))]
 
-    masks = []
-    for item in filters:
-        # item can be (col, q) or (col, q, mode)
-        if len(item) == 3:
-            col, q, mode = item
-        else:
-            col, q = item
-            mode = 'contains'
-        if not q or str(q).strip() == "":
-            continue
-        if col not in df.columns:
-            # 存在しない列は常にFalseにする
-            m = pd.Series(False, index=df.index)
-            masks.append(m)
-            continue
-        s = df[col].astype(str)
-        if mode == 'contains':
-            m = s.str.contains(str(q), case=False, na=False)
-        elif mode == 'startswith':
-            m = s.str.lower().str.startswith(str(q).lower(), na=False)
-        elif mode == 'regex':
-            m = s.str.contains(str(q), case=False, na=False, regex=True)
-        else:
-            m = s.str.contains(str(q), case=False, na=False)
-        masks.append(m)
 
-    # combine masks
-    if not masks:
-        return df
-    if combine == 'AND':
-        final_mask = masks[0]
-        for m in masks[1:]:
-            final_mask &= m
-    else:
-        final_mask = masks[0]
-        for m in masks[1:]:
-            final_mask |= m
+# 追記ジャーナルのローテーション設定（ジャーナルは最大 JOURNAL_BACKUP_COUNT 世代まで残す）
+JOURNAL_MAX_BYTES = 1 << 20
+JOURNAL_BACKUP_COUNT = 3
 
-    return df[final_mask]
 
+@contextmanager
+def _file_lock(path: Path):
+    """<path>.lock に排他ロックをとる。fcntlがない環境（Windows）ではロックしない。"""
+    lock_path = path.with_name(path.name + '.lock')
+    with open(lock_path, 'a') as lf:
+        if fcntl is not None:
+            fcntl.flock(lf, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lf, fcntl.LOCK_UN)
 
-def append_row(path: str, row: dict, backup: bool = True) -> None:
-    """CSVに行を追記する。既存ファイルがあればバックアップをとって上書き保存する方式。
+
+def _read_header(p: Path) -> list:
+    with open(p, newline='', encoding='utf-8-sig') as f:
+        return next(csv.reader(f), [])
+
+
+def _ends_with_newline(p: Path) -> bool:
+    with open(p, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) in (b'\n', b'\r')
+
+
+def _journal_path(p: Path) -> Path:
+    return p.with_name(p.name + '.journal.jsonl')
+
+
+def _write_journal(p: Path, rows: list) -> None:
+    """追記した行をジャーナルに書く。上限を超えたらローテーションし、その時点のCSVを <name>.bak に保存する。
+
+    バックアップの拡張子を .csv にしないのは、load_csvs_from_dir がデータとして読み込まないようにするため。
+    """
+    journal = _journal_path(p)
+    if journal.exists() and journal.stat().st_size > JOURNAL_MAX_BYTES:
+        for i in range(JOURNAL_BACKUP_COUNT - 1, 0, -1):
+            src = journal.with_name(f"{journal.name}.{i}")
+            if src.exists():
+                os.replace(src, journal.with_name(f"{journal.name}.{i + 1}"))
+        os.replace(journal, journal.with_name(f"{journal.name}.1"))
+        shutil.copy(p, p.with_name(p.name + '.bak'))
+    ts = time.time()
+    with open(journal, 'a', encoding='utf-8') as f:
+        for row in rows:
+            f.write(json.dumps({'ts': ts, 'row': row}, ensure_ascii=False, default=str) + '\n')
+
+
+def append_rows(path: str, rows: list, backup: bool = True) -> None:
+    """CSVの末尾に複数行を追記する。既存の行は読み直さない。
 
     - path: CSVのパス
-    - row: カラム名をキーとする辞書
+    - rows: カラム名をキーとする辞書のリスト。既存のヘッダーにない列があればValueError。
+    - backup: 追記した行をジャーナル（<name>.journal.jsonl）に記録する
+    同時に書き込むプロセスがあっても壊れないよう、追記中はファイルロックをとる。
     """
     p = Path(path)
-    if not p.exists():
-        # 新規ファイル作成
-        df = pd.DataFrame([row])
-        df.to_csv(p, index=False)
+    rows = [dict(r) for r in rows]
+    if not rows:
         return
+    with _file_lock(p):
+        if not p.exists() or p.stat().st_size == 0:
+            # 新規ファイル作成
+            pd.DataFrame(rows).to_csv(p, index=False)
+        else:
+            header = _read_header(p)
+            unknown = [c for r in rows for c in r if c not in header]
+            if unknown:
+                raise ValueError(f"Unknown columns for {path}: {sorted(set(map(str, unknown)))}")
+            new_df = pd.DataFrame(rows, columns=header)
+            with open(p, 'a', encoding='utf-8', newline='') as f:
+                if not _ends_with_newline(p):
+                    f.write('\n')
+                new_df.to_csv(f, header=False, index=False, lineterminator='\n')
+        if backup:
+            _write_journal(p, rows)
 
-    # 既存ファイル読み込み
-    df = pd.read_csv(p)
-
-    # 新しい行をDFに追加
-    new_df = pd.concat([df, pd.DataFrame([row])], ignore_index=True)
 
-    # バックアップ
-    if backup:
-        ts = int(time.time())
-        backup_path = p.parent / f"{p.stem}.backup_{ts}{p.suffix}"
-        shutil.copy(p, backup_path)
+def append_row(path: str, row: dict, backup: bool = True) -> None:
+    """CSVに行を追記する（append_rows を参照）。
 
-    # 上書き保存
-    new_df.to_csv(p, index=False)
+    - path: CSVのパス
+    - row: カラム名をキーとする辞書
+    """
+    append_rows(path, [row], backup=backup)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,268 @@
+"""
+文字n-gram転置インデックス: 日本語の部分一致検索を線形スキャンなしで行う。
+
+日本語の授業名・教員名には単語境界がないため、列ごとに1〜3文字のn-gramの
+ポスティングリスト（行位置の配列）をロード時に作っておき、
+クエリのn-gramを積集合で絞り込んでから候補行だけを search_df と同じ述語で検証する。
+正規化済みのシャドウ列がある場合は、search_df と同様にシャドウ列のインデックスを使う。
+完全一致（exact）は値（教員名は1人ずつ）から行位置へのハッシュ索引で引く。
+結果は kakodata_utils.search_df と完全に一致する。
+"""
+import re
+import numpy as np
+import pandas as pd
+from kakodata_utils import (
+    _parse_filter, _predicate_mask, _filter_target, _column_mask, exact_keys, MULTI_VALUE_COLUMNS,
+)
+from normalize import NORM_PREFIX, is_normalized_column, normalized_column
+from query_planner import make_plan, sample_positions
+
+
+GRAM_SIZES = (1, 2, 3)
+# この文字を含むクエリは正規表現として解釈されるため、インデックスでは絞り込まない
+_REGEX_META = set('.^$*+?{}[]\\|()')
+_EXACT_RE = re.compile(r'^\^(.*)\$$', re.DOTALL)
+
+_fold_cache = {}
+
+
+def _fold_char(c: str) -> str:
+    f = _fold_cache.get(c)
+    if f is None:
+        # re.IGNORECASE で同一視される文字（ſ と s、K と k など）を同じキーにそろえる
+        u = c.upper()
+        f = u.lower() if len(u) == 1 else c.lower()
+        _fold_cache[c] = f
+    return f
+
+
+def fold_text(s: str) -> str:
+    """大文字小文字を畳み込んだ文字列を返す（インデックスのキー用）。"""
+    if s.isascii():
+        return s.lower()
+    return ''.join(_fold_char(c) for c in s)
+
+
+def _grams(text: str, n: int):
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def _is_literal(q: str) -> bool:
+    return not (set(q) & _REGEX_META)
+
+
+def index_columns(df: pd.DataFrame) -> list:
+    """インデックスを作る列。シャドウ列のある列はシャドウ列で検索するので、元の列は含めない。"""
+    return [c for c in df.columns if is_normalized_column(c) or normalized_column(c) not in df.columns]
+
+
+class NgramIndex:
+    """DataFrameの列ごとのn-gramポスティングリスト。
+
+    search() は search_df(df, filters, combine) と同じ結果を返す。
+    インデックス化されていない列や、正規表現のクエリは全行スキャンにフォールバックする。
+    """
+
+    def __init__(self, df: pd.DataFrame, columns: list = None):
+        self.df = df
+        if columns is None:
+            columns = list(df.columns) if df is not None else []
+        self._postings = {}
+        self._exact = {}
+        for col in columns:
+            s = df[col]
+            base = col[len(NORM_PREFIX):] if is_normalized_column(col) else col
+            multi = base in MULTI_VALUE_COLUMNS
+            # 列の文字列のコピーは持たない（候補の検証は df の列そのもので行う）
+            if isinstance(s.dtype, pd.CategoricalDtype):
+                self._exact[col] = self._build_exact_encoded(s, multi)
+                self._postings[col] = self._build_postings_encoded(s)
+            else:
+                text = s.astype(str)
+                self._exact[col] = self._build_exact(text, multi)
+                self._postings[col] = self._build_postings(text)
+
+    @staticmethod
+    def _build_exact(s: pd.Series, multi: bool) -> dict:
+        """完全一致用のハッシュ索引: 照合キー -> 行位置の配列。複数の値を持つ列は1人ずつ登録する。"""
+        lists = {}
+        for pos, value in enumerate(s):
+            if not isinstance(value, str):
+                continue
+            for key in exact_keys(value, multi):
+                lists.setdefault(key, []).append(pos)
+        return {k: np.asarray(v, dtype=np.int64) for k, v in lists.items()}
+
+    @staticmethod
+    def _code_rows(s: pd.Series):
+        """カテゴリ型の列の (コード, 重複のない値の文字列, そのコードの行位置) を順に返す。"""
+        codes = s.cat.codes.to_numpy()
+        order = np.argsort(codes, kind='stable')
+        bounds = np.searchsorted(codes[order], np.arange(len(s.cat.categories) + 1))
+        for code, value in enumerate(s.cat.categories.astype(str)):
+            rows = order[bounds[code]:bounds[code + 1]]
+            if len(rows):
+                yield code, value, rows
+
+    @classmethod
+    def _build_exact_encoded(cls, s: pd.Series, multi: bool) -> dict:
+        """カテゴリ型の列の完全一致索引。照合キーは重複のない値ごとに1回だけ作る。"""
+        lists = {}
+        for _, value, rows in cls._code_rows(s):
+            for key in exact_keys(value, multi):
+                lists.setdefault(key, []).append(rows)
+        return {k: np.sort(np.concatenate(v)).astype(np.int64) for k, v in lists.items()}
+
+    @classmethod
+    def _build_postings_encoded(cls, s: pd.Series) -> dict:
+        """カテゴリ型の列は重複のない値ごとにn-gramを作り、コードで行位置に展開する。"""
+        lists = {}
+        for _, value, rows in cls._code_rows(s):
+            folded = fold_text(value)
+            for n in GRAM_SIZES:
+                for g in _grams(folded, n):
+                    lists.setdefault(g, []).append(rows)
+        return {g: np.sort(np.concatenate(v)).astype(np.int64) for g, v in lists.items()}
+
+    @staticmethod
+    def _build_postings(s: pd.Series) -> dict:
+        lists = {}
+        for pos, value in enumerate(s):
+            if not isinstance(value, str):
+                # 文字列型の列の欠損値は astype(str) 後も欠損のまま（na=False で一致しない）
+                continue
+            folded = fold_text(value)
+            for n in GRAM_SIZES:
+                for g in _grams(folded, n):
+                    lists.setdefault(g, []).append(pos)
+        return {g: np.asarray(v, dtype=np.int64) for g, v in lists.items()}
+
+    def candidates(self, col: str, q: str):
+        """リテラル q を含みうる行位置の配列を返す（上位集合）。絞り込めない場合は None。"""
+        postings = self._postings.get(col)
+        if postings is None:
+            return None
+        folded = fold_text(q)
+        n = min(len(folded), GRAM_SIZES[-1])
+        if n == 0:
+            return None
+        grams = _grams(folded, n)
+        lists = []
+        for g in grams:
+            p = postings.get(g)
+            if p is None:
+                return np.empty(0, dtype=np.int64)
+            lists.append(p)
+        lists.sort(key=len)
+        result = lists[0]
+        for p in lists[1:]:
+            if len(result) == 0:
+                break
+            result = np.intersect1d(result, p, assume_unique=True)
+        return result
+
+    def _literal_for(self, q: str, mode: str):
+        """インデックスで絞り込みに使えるリテラルを返す。使えなければ None。"""
+        if mode in ('substring', 'prefix'):
+            return q
+        if mode == 'range':
+            return None
+        if mode == 'startswith':
+            return q.lower()
+        if mode == 'regex':
+            m = _EXACT_RE.match(q)
+            if m and _is_literal(m.group(1)):
+                return m.group(1)
+            return None
+        return q if _is_literal(q) else None
+
+    def _estimate(self, step, rank: bool) -> None:
+        """完全一致索引の件数・ポスティングの長さ（候補の行数）から選択度を見積もる。どちらも評価に使い回す。"""
+        df = self.df
+        if step.col not in df.columns:
+            step.estimate, step.source, step.exact = 0.0, 'missing', True
+            return
+        step.target = tcol, tq, tmode = _filter_target(df, step.col, str(step.q), step.mode)
+        n = len(df)
+        if tmode in ('exact', 'exact_multi') and tcol in self._exact:
+            step.state = self._exact[tcol].get(tq, np.empty(0, dtype=np.int64))
+            step.estimate, step.source, step.exact = len(step.state) / n, 'exact_index', True
+            return
+        literal = self._literal_for(tq, tmode)
+        cand = self.candidates(tcol, literal) if literal else None
+        if cand is not None:
+            # 候補は一致する行の上位集合なので、0件のときだけ実際の割合になる
+            step.state = cand
+            step.estimate, step.source, step.exact = len(cand) / n, 'postings', len(cand) == 0
+            return
+        if rank:
+            m = _column_mask(df[tcol].iloc[sample_positions(n)], tq, tmode).to_numpy(dtype=bool)
+            step.estimate, step.source = float(m.mean()), 'sample'
+
+    def _verify(self, col: str, hits: np.ndarray, q, mode: str) -> np.ndarray:
+        """候補の行位置 hits のうち、実際にフィルタに一致するものの bool 配列。"""
+        s = self.df[col]
+        if not isinstance(s.dtype, pd.CategoricalDtype):
+            return _column_mask(s.iloc[hits], q, mode).to_numpy(dtype=bool)
+        # カテゴリ型の列は候補の行に出てくる値だけに述語を適用する
+        codes = s.cat.codes.to_numpy()[hits]
+        uniq, inverse = np.unique(codes, return_inverse=True)
+        present = uniq >= 0
+        m = np.zeros(len(uniq), dtype=bool)
+        values = pd.Series(s.cat.categories.take(uniq[present])).astype(str)
+        m[present] = _predicate_mask(values, q, mode).to_numpy(dtype=bool)
+        return m[inverse]
+
+    def _evaluate(self, step, positions) -> np.ndarray:
+        """positions（None なら全行）の行だけにフィルタを適用する。"""
+        n = len(self.df)
+        tcol, tq, tmode = step.target
+        if step.state is None:
+            s = self.df[tcol] if positions is None else self.df[tcol].iloc[positions]
+            return _column_mask(s, tq, tmode).to_numpy(dtype=bool)
+        hits = step.state
+        if step.source == 'postings':
+            if positions is not None:
+                hits = np.intersect1d(hits, positions, assume_unique=True)
+            if len(hits):
+                hits = hits[self._verify(tcol, hits, tq, tmode)]
+        mask = np.zeros(n, dtype=bool)
+        mask[hits] = True
+        return mask if positions is None else mask[positions]
+
+    def plan(self, filters: list, combine: str = 'AND'):
+        """search() の実行計画（query_planner.Plan）。"""
+        items = []
+        for item in filters:
+            col, q, mode = _parse_filter(item)
+            if not q or str(q).strip() == "":
+                continue
+            items.append((col, q, mode))
+        return make_plan(items, combine, len(self.df) if self.df is not None else 0, self._estimate)
+
+    def explain(self, filters: list, combine: str = 'AND') -> str:
+        """search() と同じ検索を実行し、評価順と各フィルタで評価した行数・一致した行数を返す。"""
+        plan = self.plan(filters, combine)
+        if self.df is not None and not self.df.empty and plan.steps:
+            plan.execute(self._evaluate)
+        return plan.explain()
+
+    def search_positions(self, filters: list, combine: str = 'AND') -> np.ndarray:
+        """search() の結果の行位置（昇順）。"""
+        df = self.df
+        if df is None or df.empty:
+            return np.empty(0, dtype=np.int64)
+        plan = self.plan(filters, combine)
+        if not plan.steps:
+            return np.arange(len(df))
+        return plan.execute(self._evaluate)
+
+    def search(self, filters: list, combine: str = 'AND') -> pd.DataFrame:
+        """search_df と同じ引数・同じ結果の検索。フィルタは query_planner の計画の順に評価する。"""
+        df = self.df
+        if df is None or df.empty:
+            return df
+        plan = self.plan(filters, combine)
+        if not plan.steps:
+            return df
+        return df.iloc[plan.execute(self._evaluate)]
@@ -0,0 +1,123 @@
+"""
+検索用の文字列正規化と、正規化済みのシャドウ列の作成。
+
+正規化の内容:
+- ローマ数字（Ⅰ〜Ⅻ）をアラビア数字に（「民法Ⅲ」と「民法3」を同一視）
+- NFKC（全角英数字・半角カナなどの幅の違いを吸収）
+- 小文字化
+- カタカナをひらがなに
+
+シャドウ列は `_norm_<列名>` という名前でロード時に1回だけ作り、
+search_df / search_db / ハイライト表示はこちらに対して部分一致・前方一致を行う。
+"""
+import functools
+import unicodedata
+import pandas as pd
+
+
+NORM_PREFIX = '_norm_'
+
+_ROMAN = {chr(0x2160 + i): str(i + 1) for i in range(12)}
+_ROMAN.update({chr(0x2170 + i): str(i + 1) for i in range(12)})
+# ァ〜ヶ、ヽヾ → ぁ〜ゖ、ゝゞ
+_KANA = {c: c - 0x60 for c in range(0x30A1, 0x30F7)}
+_KANA.update({0x30FD: 0x309D, 0x30FE: 0x309E})
+# 直前の文字と合わせて正規化する結合文字（半角の濁点・半濁点を含む）
+_HALFWIDTH_MARKS = ('ﾞ', 'ﾟ')
+
+
+def _is_mark(c: str) -> bool:
+    return c in _HALFWIDTH_MARKS or unicodedata.combining(c) != 0
+
+
+def _groups(s: str):
+    """基底文字とそれに続く結合文字のまとまりごとに (開始, 終了) を返す。"""
+    i, n = 0, len(s)
+    while i < n:
+        j = i + 1
+        while j < n and _is_mark(s[j]):
+            j += 1
+        yield i, j
+        i = j
+
+
+@functools.lru_cache(maxsize=65536)
+def _normalize_group(g: str) -> str:
+    roman = _ROMAN.get(g)
+    if roman is not None:
+        return roman
+    return unicodedata.normalize('NFKC', g).lower().translate(_KANA)
+
+
+def normalize_text(s: str) -> str:
+    """検索用に正規化した文字列を返す。"""
+    if s.isascii():
+        return s.lower()
+    return ''.join(_normalize_group(s[i:j]) for i, j in _groups(s))
+
+
+def normalize_with_map(s: str) -> tuple:
+    """正規化した文字列と、正規化後の各文字が元の文字列のどこから来たかを返す。
+
+    戻り値: (normalized, starts, ends)
+    normalized[k] は元の s[starts[k]:ends[k]] に対応する。
+    """
+    out = []
+    starts = []
+    ends = []
+    for i, j in _groups(s):
+        t = _normalize_group(s[i:j])
+        out.append(t)
+        starts.extend([i] * len(t))
+        ends.extend([j] * len(t))
+    return ''.join(out), starts, ends
+
+
+def find_spans(text: str, query: str, prefix: bool = False) -> list:
+    """正規化した text の中で正規化した query に一致する箇所を、元の text の (開始, 終了) で返す。"""
+    nq = normalize_text(query)
+    if not nq:
+        return []
+    norm, starts, ends = normalize_with_map(text)
+    if prefix:
+        return [(starts[0], ends[len(nq) - 1])] if norm.startswith(nq) else []
+    spans = []
+    pos = norm.find(nq)
+    while pos != -1:
+        spans.append((starts[pos], ends[pos + len(nq) - 1]))
+        pos = norm.find(nq, pos + len(nq))
+    return spans
+
+
+def normalized_column(col) -> str:
+    """列名に対応するシャドウ列の名前。"""
+    return f"{NORM_PREFIX}{col}"
+
+
+def is_normalized_column(col) -> bool:
+    return isinstance(col, str) and col.startswith(NORM_PREFIX)
+
+
+def normalize_series(s: pd.Series) -> pd.Series:
+    """Seriesを正規化する。重複した値は1回だけ正規化し、欠損値は空文字にする。"""
+    values = s.astype(str).where(s.notna(), '')
+    mapping = {v: normalize_text(v) for v in pd.unique(values)}
+    return values.map(mapping)
+
+
+def add_normalized_columns(df: pd.DataFrame, columns: list = None) -> pd.DataFrame:
+    """シャドウ列を追加したDataFrameを返す（元のdfは変更しない）。"""
+    if df is None or df.empty:
+        return df
+    if columns is None:
+        columns = [c for c in df.columns if not is_normalized_column(c)]
+    shadows = {normalized_column(c): normalize_series(df[c]) for c in columns}
+    return df.assign(**shadows)
+
+
+def drop_normalized_columns(df: pd.DataFrame) -> pd.DataFrame:
+    """表示・ダウンロード用にシャドウ列を除いたDataFrameを返す。"""
+    if df is None:
+        return df
+    shadow = [c for c in df.columns if is_normalized_column(c)]
+    return df.drop(columns=shadow) if shadow else df
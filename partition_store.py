@@ -0,0 +1,357 @@
+"""
+年度ごとのパーティションに分けたデータストア。
+
+data/kakodata_YYYY.csv のように年度ごとに分かれたCSVを、整数の年度をキーとする
+パーティションとして扱う。
+- 年度の範囲（'2019-2023' など。mode='range'）はパーティション単位で判定し、
+  範囲外のパーティションは文字列の条件を評価する前に丸ごと除く
+- パーティションは検索で必要になったときに読み込み、正規化列とn-gramインデックスもそのとき作る
+- パーティションは年度の降順に並べて持つので、検索結果と最新N件のプレビューに並べ替えは要らない
+
+ファイル名から年度がわからないCSVは、読み込んでから年度の列の値で分ける。
+ファイル名に年度があるCSVは、中の行もすべてその年度のものとして扱う。
+
+コンパクトモード（compact=True、または環境変数 KAKOMON_COMPACT=1）では、全年度を1つの共有フレーム
+（Arrow の文字列・int16 の年度・全体で共通のカテゴリ）に読み込み、各パーティションはその行範囲（ビュー）にする。
+search_positions() は共有フレームの行位置を返すので、検索結果の行をコピーせずに持てる（query_cache を参照）。
+"""
+from pathlib import Path
+import re
+import threading
+import numpy as np
+import pandas as pd
+from kakodata_cache import SNAPSHOT_DIRNAME, _file_hash, load_partition, data_version, file_report
+from ingest import YEAR_COLUMNS
+from instrument import traced
+from kakodata_utils import _parse_filter, parse_year_range, in_year_range, encode_columns, compact_columns, compact_default
+from ngram_index import NgramIndex, index_columns
+from normalize import add_normalized_columns, drop_normalized_columns, normalized_column
+
+
+# ファイル名の最後の4桁の数字（kakodata_2019.csv -> 2019）
+_FILE_YEAR_RE = re.compile(r'(?<!\d)(\d{4})(?!\d)(?!.*\d)')
+
+
+def file_year(path) -> int:
+    """ファイル名から年度を読み取る。読み取れなければ None。"""
+    m = _FILE_YEAR_RE.search(Path(path).stem)
+    return int(m.group(1)) if m else None
+
+
+def _read_header(path: Path) -> list:
+    try:
+        return list(pd.read_csv(path, nrows=0).columns)
+    except Exception:
+        return []
+
+
+def _year_key(value):
+    return None if pd.isna(value) else int(value)
+
+
+class _Partition:
+    """1年度分のデータ（正規化列つき・辞書エンコード済み）と、最初の検索で作るn-gramインデックス。"""
+
+    def __init__(self, df: pd.DataFrame):
+        self.df = df
+        self._index = None
+
+    @property
+    def index(self) -> NgramIndex:
+        if self._index is None:
+            self._index = NgramIndex(self.df, index_columns(self.df))
+        return self._index
+
+
+class _Base:
+    """コンパクトモードの共有フレームと、その行範囲のパーティション（あるデータバージョンのもの）。"""
+
+    def __init__(self, version: str, frame: pd.DataFrame, parts: dict, offsets: dict):
+        self.version = version
+        self.frame = frame
+        self.parts = parts
+        self.offsets = offsets
+
+
+class PartitionedStore:
+    """年度ごとのパーティションに分けたCSVディレクトリ。
+
+    検索結果と head() は年度の降順（同じ年度の中は元のファイル・行の順）で、
+    load_snapshot の結果を年度で安定ソートしたものと同じ並びになる。
+    """
+
+    def __init__(self, dir_path: str, year_col: str = None, cache_dir: str = None, compact: bool = False):
+        p = Path(dir_path)
+        if not p.exists() or not p.is_dir():
+            raise FileNotFoundError(f"Directory not found: {dir_path}")
+        self.dir = p
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else p / SNAPSHOT_DIRNAME
+        self._year_col = year_col
+        self._lock = threading.RLock()
+        # path -> ((size, mtime_ns), fingerprint, 列名)
+        self._files = {}
+        # 年度 -> [path]（ファイル名順）。年度の列がない・数値でない行は None
+        self._sources = {}
+        # ファイル名に年度がないファイル（読み込んでから年度で分ける）
+        self._split = set()
+        # 年度 -> _Partition（読み込み済みのものだけ）
+        self._parts = {}
+        self.compact = compact
+        # コンパクトモードの共有フレーム（_Base）
+        self._base = None
+        self.version = None
+        self.columns = []
+        self.year_col = None
+        self.refresh()
+
+    # --- ディレクトリの変更の反映 ---
+    def refresh(self) -> bool:
+        """ディレクトリの変更を反映する。変更があれば True を返し、影響する年度のパーティションだけ捨てる。"""
+        with self._lock:
+            current = {}
+            changed = set()
+            for f in sorted(self.dir.glob('*.csv')):
+                key = str(f)
+                st = f.stat()
+                stat_key = (st.st_size, st.st_mtime_ns)
+                old = self._files.get(key)
+                if old is not None and old[0] == stat_key:
+                    current[key] = old
+                    continue
+                fp = (key, st.st_size, st.st_mtime_ns, _file_hash(f))
+                if old is not None and old[1][3] == fp[3]:
+                    # touchされただけで内容は同じ
+                    current[key] = (stat_key, fp, old[2])
+                    continue
+                current[key] = (stat_key, fp, _read_header(f))
+                changed.add(key)
+            changed |= set(self._files) - set(current)
+            if not changed and self.version is not None:
+                return False
+
+            self._files = current
+            columns = []
+            for _, _, header in current.values():
+                columns.extend(c for c in header if c not in columns)
+            self.columns = columns
+            self.year_col = self._year_col if self._year_col in columns else next(
+                (c for c in columns if str(c).lower() in YEAR_COLUMNS), None)
+
+            old_sources = self._sources
+            self._sources = {}
+            self._split = set()
+            for key in current:
+                year = file_year(key) if self.year_col is not None else None
+                if year is not None or self.year_col is None:
+                    self._sources.setdefault(year, []).append(key)
+                    continue
+                self._split.add(key)
+                for y in self._file_years(key):
+                    self._sources.setdefault(y, []).append(key)
+            # コンパクトモードのパーティションは共有フレームの一部なので、全部作り直す
+            self._base = None
+            for year in list(self._parts):
+                paths = self._sources.get(year)
+                if paths != old_sources.get(year) or any(k in changed for k in paths):
+                    del self._parts[year]
+            self.version = data_version(fp for _, fp, _ in current.values())
+            return True
+
+    def _file_years(self, key: str) -> list:
+        df = load_partition(key, self.cache_dir)[1]
+        if df is None or self.year_col not in df.columns:
+            return [None] if df is not None else []
+        years = pd.to_numeric(df[self.year_col], errors='coerce')
+        return list(dict.fromkeys(_year_key(v) for v in years))
+
+    def _frame_for(self, key: str, year) -> pd.DataFrame:
+        df = load_partition(key, self.cache_dir)[1]
+        if df is None or key not in self._split:
+            return df
+        if self.year_col not in df.columns:
+            return df if year is None else None
+        years = pd.to_numeric(df[self.year_col], errors='coerce')
+        return df[years.isna()] if year is None else df[years == year]
+
+    # --- パーティション ---
+    def years(self) -> list:
+        """年度の降順（年度がわからない行のパーティション None は最後）。"""
+        return sorted(self._sources, key=lambda y: (y is None, -(y or 0)))
+
+    def _read_year(self, year) -> pd.DataFrame:
+        frames = [self._frame_for(key, year) for key in self._sources.get(year, [])]
+        frames = [f for f in frames if f is not None]
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=self.columns)
+
+    def base(self) -> _Base:
+        """コンパクトモードの共有フレーム。全年度を年度の降順につなぎ、正規化列とカテゴリを全体でそろえてから
+        コンパクトな型にする。パーティションはその行範囲のビューになる。"""
+        with self._lock:
+            if self._base is None or self._base.version != self.version:
+                years = self.years()
+                frames = [self._read_year(y) for y in years]
+                frame = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=self.columns)
+                frame = compact_columns(encode_columns(add_normalized_columns(frame)), self.year_col)
+                parts, offsets = {}, {}
+                start = 0
+                for y, f in zip(years, frames):
+                    offsets[y] = start
+                    parts[y] = _Partition(frame.iloc[start:start + len(f)])
+                    start += len(f)
+                self._base = _Base(self.version, frame, parts, offsets)
+                self._parts = parts
+            return self._base
+
+    def partition(self, year) -> _Partition:
+        """年度のパーティションを返す（初めて使うときに読み込む）。"""
+        if self.compact:
+            part = self.base().parts.get(year)
+            return part if part is not None else _Partition(self._empty())
+        with self._lock:
+            part = self._parts.get(year)
+            if part is None:
+                part = _Partition(encode_columns(add_normalized_columns(self._read_year(year))))
+                self._parts[year] = part
+            return part
+
+    @property
+    def loaded_years(self) -> list:
+        return [y for y in self.years() if y in self._parts]
+
+    @property
+    def reports(self) -> list:
+        """読み込み済みのファイルの取り込み結果（ingest.FileReport、ファイル名順）。
+        読めなかったファイルや、年度が数値でないため除いた行はここでわかる。"""
+        with self._lock:
+            keys = list(self._files)
+        return [r for r in (file_report(k) for k in keys) if r is not None]
+
+    @property
+    def search_columns(self) -> list:
+        """検索対象のDataFrameの列（正規化列を含む）。"""
+        return self.columns + [normalized_column(c) for c in self.columns]
+
+    def _empty(self) -> pd.DataFrame:
+        return pd.DataFrame(columns=self.search_columns)
+
+    def _concat(self, frames: list) -> pd.DataFrame:
+        return pd.concat(frames, ignore_index=True) if frames else self._empty()
+
+    def frame(self) -> pd.DataFrame:
+        """全パーティションを年度の降順につないだDataFrame（正規化列つき）。コンパクトモードでは共有フレームそのもの。"""
+        if self.compact:
+            return self.base().frame
+        return self._concat([self.partition(y).df for y in self.years()])
+
+    def value_counts(self, column: str) -> pd.Series:
+        """列の値（文字列）ごとの出現回数。パーティションを作らず、ファイルごとに数えて足し合わせる。"""
+        with self._lock:
+            keys = list(self._files)
+        counts = []
+        for key in keys:
+            df = load_partition(key, self.cache_dir)[1]
+            if df is not None and column in df.columns:
+                vc = df[column].value_counts(sort=False)
+                vc.index = vc.index.astype(str)
+                counts.append(vc)
+        if not counts:
+            return pd.Series(dtype='int64')
+        return pd.concat(counts).groupby(level=0, sort=False).sum()
+
+    def head(self, n: int = 200) -> pd.DataFrame:
+        """最新 n 件（表示用、正規化列なし）。必要な年度のパーティションだけ読み込む。"""
+        if self.compact:
+            # 共有フレームは年度の降順なので先頭を取るだけ
+            return drop_normalized_columns(self.base().frame.iloc[:n])
+        frames = []
+        total = 0
+        for year in self.years():
+            if total >= n:
+                break
+            df = self.partition(year).df
+            frames.append(df.head(n - total))
+            total += len(frames[-1])
+        return drop_normalized_columns(self._concat(frames)).reset_index(drop=True)
+
+    # --- 検索 ---
+    def _search_parts(self, filters: list, combine: str, parts) -> list:
+        """[(年度, パーティション, 一致した行位置 or None（全行）)] を年度の降順で返す。parts(year) でパーティションを得る。"""
+        if combine not in ('AND', 'OR'):
+            combine = 'AND'
+        ranges = []
+        rest = []
+        for item in filters:
+            col, q, mode = _parse_filter(item)
+            if not q or str(q).strip() == "":
+                continue
+            bounds = parse_year_range(q) if mode == 'range' and col == self.year_col else None
+            if bounds is not None:
+                ranges.append(bounds)
+            else:
+                rest.append((col, q, mode))
+
+        out = []
+        for year in self.years():
+            hits = [in_year_range(year, b) for b in ranges]
+            if combine == 'AND':
+                if not all(hits):
+                    continue
+                part = parts(year)
+                out.append((year, part, part.index.search_positions(rest, 'AND') if rest else None))
+            elif any(hits) or not (ranges or rest):
+                out.append((year, parts(year), None))
+            elif rest:
+                part = parts(year)
+                out.append((year, part, part.index.search_positions(rest, 'OR')))
+        return out
+
+    @traced('store.search')
+    def search(self, filters: list, combine: str = 'AND') -> pd.DataFrame:
+        """search_df と同じフィルタで検索し、年度の降順で返す（正規化列つき）。
+
+        年度の列に対する mode='range' のフィルタはパーティション単位で評価する。
+        AND では範囲外のパーティションを読み込まずに除き、OR では範囲内のパーティションを丸ごと返す。
+        """
+        found = self._search_parts(filters, combine, self.partition)
+        return self._concat([part.df if pos is None else part.df.iloc[pos] for _, part, pos in found])
+
+    @traced('store.search_segments')
+    def search_segments(self, filters: list, combine: str = 'AND') -> list:
+        """search() と同じ検索をし、行をコピーせずに [(パーティションのフレーム, その中の行位置)] を年度の降順で返す。"""
+        found = self._search_parts(filters, combine, self.partition)
+        segments = [(part.df, np.arange(len(part.df)) if pos is None else np.asarray(pos))
+                    for _, part, pos in found]
+        return segments or [(self._empty(), np.empty(0, dtype=np.int64))]
+
+    @traced('store.search_positions')
+    def search_positions(self, filters: list, combine: str = 'AND') -> tuple:
+        """search() と同じ検索をし、(共有フレーム, その中の行位置) を返す（コンパクトモード用）。
+
+        行位置は search() の結果と同じ並び。検索中にデータが変わっても、返す行位置は一緒に返すフレームのもの。
+        """
+        base = self.base()
+        found = self._search_parts(filters, combine, lambda y: base.parts.get(y) or _Partition(self._empty()))
+        positions = [base.offsets[y] + (np.arange(len(part.df)) if pos is None else pos)
+                     for y, part, pos in found if y in base.offsets]
+        return base.frame, np.concatenate(positions) if positions else np.empty(0, dtype=np.int64)
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def open_store(dir_path: str, cache_dir: str = None, compact: bool = None) -> PartitionedStore:
+    """ディレクトリごとに共有するストアを返す。呼ぶたびにファイルの変更を反映する。
+
+    compact を省略すると環境変数 KAKOMON_COMPACT に従う。
+    """
+    if compact is None:
+        compact = compact_default()
+    key = (str(Path(dir_path).resolve()), cache_dir, compact)
+    with _stores_lock:
+        store = _stores.get(key)
+        if store is None:
+            store = _stores[key] = PartitionedStore(dir_path, cache_dir=cache_dir, compact=compact)
+            return store
+    store.refresh()
+    return store
@@ -0,0 +1,309 @@
+"""
+プロセス全体で共有する検索結果のLRUキャッシュ。
+
+キーは (データバージョン, 正規化したフィルタ, combine, 検索モード)。値として
+結果の行位置（年度降順に並べ済み）と、ダウンロード用にエンコード済みのCSVバイト列を持つ。
+年度パーティションのストア（partition_store）の検索は、(パーティションのフレーム, 行位置) の組を持ち、
+CSVは初めて使うときに作る。コンパクトモードのストアでは、共有フレームとその行位置の組ひとつになる。
+
+キャッシュにない検索でも、キャッシュ済みの検索を絞り込んだもの（部分一致のクエリが
+伸びた、前方一致のクエリが伸びた、年度の範囲が狭まったなど）であれば、キャッシュ済みの結果行だけを対象に検索する。
+入力途中の検索はだんだん安くなる。
+"""
+from collections import OrderedDict
+import threading
+import numpy as np
+import pandas as pd
+from instrument import span
+from kakodata_utils import _parse_filter, parse_year_range, search_df
+from normalize import normalized_column, normalize_text, drop_normalized_columns
+
+
+DEFAULT_MAXSIZE = 256
+# この文字を含む contains は正規表現として評価されるので、絞り込みの判定に使わない
+_REGEX_META = set('.^$*+?{}[]\\|()')
+
+
+class CachedResult:
+    """キャッシュされた検索結果。frame は表示用（シャドウ列なし、年度は数値）。
+
+    ストアの結果は行をコピーせず、(フレーム, 行位置) の組（segments）だけを持つ。
+    frame と csv_bytes は初めて使うときに作り、page() は1ページ分の行だけを取り出す。
+    """
+
+    def __init__(self, frame, csv_bytes, positions, hit: str, segments: list = None, entry: list = None,
+                 sort_col=None):
+        self._frame = frame
+        self._csv_bytes = csv_bytes
+        self.positions = positions
+        # 'hit' | 'refined' | 'miss'
+        self.hit = hit
+        self._segments = segments
+        # 作った csv_bytes を書き戻すキャッシュのエントリ
+        self._entry = entry
+        self._sort_col = sort_col
+
+    @property
+    def total(self) -> int:
+        if self._frame is not None:
+            return len(self._frame)
+        return _segment_rows(self._segments)
+
+    def page(self, offset: int, size: int) -> pd.DataFrame:
+        """offset 行目から size 行（表示用）。"""
+        if self._frame is not None:
+            return self._frame.iloc[offset:offset + size]
+        rows = []
+        for df, pos in self._segments:
+            if size <= 0:
+                break
+            if offset >= len(pos):
+                offset -= len(pos)
+                continue
+            take = pos[offset:offset + size]
+            rows.append(df.iloc[take])
+            size -= len(take)
+            offset = 0
+        if not rows:
+            rows = [self._segments[0][0].iloc[:0]]
+        found = rows[0] if len(rows) == 1 else pd.concat(rows, ignore_index=True)
+        return QueryCache._display(found, self._sort_col)
+
+    @property
+    def frame(self) -> pd.DataFrame:
+        if self._frame is None:
+            self._frame = self.page(0, self.total)
+        return self._frame
+
+    @property
+    def csv_bytes(self) -> bytes:
+        if self._csv_bytes is None:
+            self._csv_bytes = _encode_csv(self.frame)
+            if self._entry is not None:
+                self._entry[1] = self._csv_bytes
+        return self._csv_bytes
+
+
+def _segment_rows(segments: list) -> int:
+    return sum(len(pos) for _, pos in segments)
+
+
+def _entry_rows(entry) -> int:
+    """エントリの結果の行数（行位置の配列か segments）。"""
+    return _segment_rows(entry[0]) if isinstance(entry[0], list) else len(entry[0])
+
+
+def _encode_csv(frame: pd.DataFrame) -> bytes:
+    """ダウンロード用のCSVバイト列（Excelでの文字化けを防ぐため utf-8-sig）。"""
+    with span('csv_encode', rows_in=len(frame)):
+        return frame.to_csv(index=False).encode('utf-8-sig')
+
+
+def _normalize_filters(columns, filters: list) -> tuple:
+    """キャッシュキー用にフィルタをそろえる。空のクエリは除き、正規化列がある列のクエリは正規化する。
+    exact は検索と同じく前後の空白を除く。"""
+    out = []
+    for item in filters:
+        col, q, mode = _parse_filter(item)
+        if not q or str(q).strip() == "":
+            continue
+        q = str(q).strip() if mode == 'exact' else str(q)
+        if mode not in ('regex', 'range') and normalized_column(col) in columns:
+            q = normalize_text(q)
+        out.append((col, q, mode))
+    return tuple(out)
+
+
+def _within(inner: tuple, outer: tuple) -> bool:
+    """年度の範囲 inner が outer に含まれるか。"""
+    (ilo, ihi), (olo, ohi) = inner, outer
+    return ((olo is None or (ilo is not None and ilo >= olo))
+            and (ohi is None or (ihi is not None and ihi <= ohi)))
+
+
+def _is_store_range(item: tuple, year_col) -> bool:
+    """ストアがパーティション（ファイル名の年度）単位で判定する、年度の列の範囲フィルタか。"""
+    return year_col is not None and item[0] == year_col and item[2] == 'range'
+
+
+def _is_refinement(old: tuple, new: tuple, columns, year_col=None) -> bool:
+    """new の結果が必ず old の結果に含まれるなら True。
+
+    year_col の範囲フィルタ（ストアの年度）は行の値では絞り込めないので、同じ範囲のときだけ絞り込みとみなす。
+    """
+    if len(old) != len(new):
+        return False
+    for (ocol, oq, omode), (ncol, nq, nmode) in zip(old, new):
+        if (ocol, omode) != (ncol, nmode):
+            return False
+        if oq == nq:
+            continue
+        if _is_store_range((ocol, oq, omode), year_col):
+            return False
+        if omode == 'startswith' and nq.startswith(oq):
+            continue
+        if omode == 'range':
+            ob, nb = parse_year_range(oq), parse_year_range(nq)
+            if ob is not None and nb is not None and _within(nb, ob):
+                continue
+            return False
+        if omode not in ('startswith', 'regex', 'exact') and oq in nq:
+            literal = normalized_column(ocol) in columns or not (set(oq + nq) & _REGEX_META)
+            if literal:
+                continue
+        return False
+    return True
+
+
+class QueryCache:
+    """検索結果のLRUキャッシュ（スレッドセーフ）。"""
+
+    def __init__(self, maxsize: int = DEFAULT_MAXSIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _find_base(self, key: tuple, columns, year_col=None):
+        """key を絞り込んだ検索とみなせるキャッシュ済みエントリのうち、結果が最も少ないものを探す。"""
+        version, filters, combine, match_mode = key
+        if combine == 'OR' and any(_is_store_range(f, year_col) for f in filters):
+            # 範囲内のパーティションの行は文字列の条件によらず残るので、行だけでは絞り込めない
+            return None
+        best = None
+        with self._lock:
+            for (v, f, c, m), entry in self._entries.items():
+                if (v, c, m) != (version, combine, match_mode):
+                    continue
+                if _is_refinement(f, filters, columns, year_col) and (best is None or _entry_rows(entry) < _entry_rows(best)):
+                    best = entry
+        return best
+
+    def search(self, df: pd.DataFrame, version: str, filters: list, combine: str = 'AND',
+               match_mode: str = 'contains', search_fn=None, sort_col=None) -> CachedResult:
+        """df を filters で検索し、sort_col があれば年度として降順に並べた結果を返す。
+
+        search_fn(filters, combine) は df 全体を検索する関数（NgramIndex.search など）。
+        省略時は search_df を使う。絞り込み検索はキャッシュ済みの行だけに search_df を適用する。
+        """
+        if combine not in ('AND', 'OR'):
+            combine = 'AND'
+        key = (version, _normalize_filters(df.columns, filters), combine, match_mode)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is not None:
+            return self._result(df, entry, sort_col, 'hit')
+
+        base = self._find_base(key, df.columns)
+        if base is not None:
+            cand = np.sort(base[0])
+            found = search_df(df.iloc[cand], filters, combine=combine)
+            hit = 'refined'
+        else:
+            found = search_fn(filters, combine) if search_fn is not None else search_df(df, filters, combine=combine)
+            hit = 'miss'
+        positions = np.sort(df.index.get_indexer(found.index))
+        positions = self._sort_positions(df, positions, sort_col)
+        frame = self._frame(df, positions, sort_col)
+        csv_bytes = _encode_csv(frame)
+        self._put(key, (positions, csv_bytes))
+        return CachedResult(frame, csv_bytes, positions, hit)
+
+    def search_store(self, store, filters: list, combine: str = 'AND', match_mode: str = 'contains') -> CachedResult:
+        """年度パーティションのストア（partition_store.PartitionedStore）を検索する。
+
+        結果はストアの並び（年度降順）のままなので並べ替えない。
+        エントリには結果の行をコピーせず、(パーティションのフレーム, 行位置) の組を持つ。
+        絞り込み検索はその行だけに search_df を適用する。年度の列の範囲はストアがファイル名の年度で判定するので、
+        同じ範囲の検索だけを絞り込みに使い、行の値では評価し直さない。
+        """
+        if combine not in ('AND', 'OR'):
+            combine = 'AND'
+        columns = store.search_columns
+        if getattr(store, 'compact', False):
+            return self._search_compact(store, columns, filters, combine, match_mode)
+        key = (('store', store.version), _normalize_filters(columns, filters), combine, match_mode)
+        return self._search_segments(key, columns, filters, combine, store.year_col, store.year_col,
+                                     lambda: store.search_segments(filters, combine))
+
+    def _search_compact(self, store, columns, filters: list, combine: str, match_mode: str) -> CachedResult:
+        """コンパクトモードのストアの検索。segments は (共有フレーム, その中の行位置) の組ひとつ。"""
+        key = (('compact', store.version), _normalize_filters(columns, filters), combine, match_mode)
+
+        def search():
+            base, positions = store.search_positions(filters, combine)
+            return [(base, positions)]
+        return self._search_segments(key, columns, filters, combine, None, store.year_col, search)
+
+    def _search_segments(self, key: tuple, columns, filters: list, combine: str, sort_col, year_col,
+                         search) -> CachedResult:
+        """エントリは [segments, CSV or None]。search() はキャッシュにないときの segments を返す。"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        if entry is not None:
+            return CachedResult(None, entry[1], None, 'hit', segments=entry[0], entry=entry, sort_col=sort_col)
+
+        prev = self._find_base(key, columns, year_col)
+        if prev is not None:
+            # 年度の範囲はキャッシュ済みの検索と同じなので、残りの条件だけを行に適用する
+            rest = [f for f in (_parse_filter(item) for item in filters) if not _is_store_range(f, year_col)]
+            segments = []
+            for df, pos in prev[0]:
+                found = search_df(df.iloc[pos].reset_index(drop=True), rest, combine=combine)
+                segments.append((df, pos[found.index.to_numpy()]))
+            hit = 'refined'
+        else:
+            segments = search()
+            hit = 'miss'
+        entry = [segments, None]
+        self._put(key, entry)
+        return CachedResult(None, None, None, hit, segments=segments, entry=entry, sort_col=sort_col)
+
+    def _put(self, key: tuple, entry) -> None:
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    @staticmethod
+    def _sort_positions(df: pd.DataFrame, positions: np.ndarray, sort_col) -> np.ndarray:
+        if sort_col is None or sort_col not in df.columns or len(positions) == 0:
+            return positions
+        years = pd.to_numeric(pd.Series(df[sort_col].iloc[positions].to_numpy()), errors='coerce')
+        order = years.sort_values(ascending=False, kind='stable', na_position='last').index.to_numpy()
+        return positions[order]
+
+    @classmethod
+    def _frame(cls, df: pd.DataFrame, positions: np.ndarray, sort_col) -> pd.DataFrame:
+        return cls._display(df.iloc[positions], sort_col)
+
+    @staticmethod
+    def _display(found: pd.DataFrame, sort_col) -> pd.DataFrame:
+        frame = drop_normalized_columns(found).reset_index(drop=True)
+        if sort_col is not None and sort_col in frame.columns:
+            frame[sort_col] = pd.to_numeric(frame[sort_col], errors='coerce')
+        return frame
+
+    def _result(self, df: pd.DataFrame, entry: tuple, sort_col, hit: str) -> CachedResult:
+        positions, csv_bytes = entry
+        return CachedResult(self._frame(df, positions, sort_col), csv_bytes, positions, hit)
+
+
+def uncached_result(found: pd.DataFrame, sort_col=None) -> CachedResult:
+    """キャッシュしない検索結果（アップロードされたデータなど）。found は並べ替え済みの検索結果。"""
+    return CachedResult(QueryCache._display(found, sort_col), None, None, 'miss')
+
+
+# 全セッションで共有するキャッシュ
+shared_cache = QueryCache()
@@ -0,0 +1,161 @@
+"""
+検索条件の実行計画: フィルタを評価する順序と、途中での打ち切り。
+
+search_df・NgramIndex.search・KakoDB.search が共有する。
+- 各フィルタの選択度（一致する行の割合）を見積もる。見積もり方は呼び出し側が渡す
+  （カテゴリ型の列の重複のない値の出現回数、n-gramのポスティングの長さ、完全一致索引の件数、標本の行など）
+- AND は選択度の小さい（よく絞り込む）順に並べ、前のフィルタで残った候補行だけを次のフィルタで評価する。
+  候補が0行になればそこで打ち切る
+- OR は選択度の大きい順に並べ、まだどのフィルタにも一致していない行だけを次のフィルタで評価する。
+  全行が一致すればそこで打ち切る
+- 見積もれないフィルタは、見積もれたフィルタの後に元の順で並べる
+
+どの順で評価しても結果の行（と元の並び）は同じ。explain() は選んだ順序と見積もりを、
+実行後なら各フィルタで評価した行数と一致した行数も一緒に返す。
+"""
+import numpy as np
+
+
+# 標本で見積もるときの行数
+SAMPLE_ROWS = 256
+# これ以下の行数のデータは見積もらずに元の順で評価する（見積もりの方が高くつく）
+MIN_ROWS_TO_ESTIMATE = 4 * SAMPLE_ROWS
+
+
+class Step:
+    """1つのフィルタの計画と実行結果。"""
+
+    def __init__(self, col, q, mode, state=None):
+        self.col = col
+        self.q = q
+        self.mode = mode
+        # 評価する (列, クエリ, モード)（_filter_target の結果など）。呼び出し側が設定する
+        self.target = None
+        # 一致する行の割合の見積もり（0〜1）。見積もれなければ None
+        self.estimate = None
+        # 見積もりの根拠（'categories' / 'postings' / 'exact_index' / 'sample' / 'missing' など）
+        self.source = None
+        # estimate が見積もりではなく実際の割合なら True（0 なら AND を評価せずに打ち切れる）
+        self.exact = False
+        # 見積もりや評価で使う呼び出し側のデータ（カテゴリごとの一致、候補の行位置、SQLの条件など）
+        self.state = state
+        self.rows_in = None
+        self.rows_out = None
+        self.skipped = False
+
+    def to_dict(self) -> dict:
+        return {
+            'col': self.col,
+            'q': self.q,
+            'mode': self.mode,
+            'target': list(self.target) if self.target is not None else None,
+            'estimate': self.estimate,
+            'source': self.source,
+            'exact': self.exact,
+            'rows_in': self.rows_in,
+            'rows_out': self.rows_out,
+            'skipped': self.skipped,
+        }
+
+
+class Plan:
+    """フィルタの評価順（steps）と combine。execute() で実行する。"""
+
+    def __init__(self, steps: list, combine: str, n_rows: int):
+        self.steps = steps
+        self.combine = combine
+        self.n_rows = n_rows
+        self.executed = False
+
+    @property
+    def empty(self) -> bool:
+        """評価するまでもなく結果が0行か（AND で一致が0件と確定したフィルタがある）。"""
+        return self.combine == 'AND' and any(s.exact and s.estimate == 0 for s in self.steps)
+
+    def execute(self, evaluate) -> np.ndarray:
+        """計画を実行し、一致した行位置（昇順）を返す。
+
+        evaluate(step, positions) は positions（None なら全行）の各行が step に一致するかの bool 配列を返す。
+        """
+        self.executed = True
+        positions = None
+        if self.combine == 'AND':
+            for i, step in enumerate(self.steps):
+                n = self.n_rows if positions is None else len(positions)
+                if n == 0 or (step.exact and step.estimate == 0):
+                    for rest in self.steps[i:]:
+                        rest.skipped = True
+                    return np.empty(0, dtype=np.int64)
+                m = np.asarray(evaluate(step, positions), dtype=bool)
+                positions = np.flatnonzero(m) if positions is None else positions[m]
+                step.rows_in, step.rows_out = n, len(positions)
+            return positions if positions is not None else np.arange(self.n_rows)
+
+        matched = np.zeros(self.n_rows, dtype=bool)
+        for i, step in enumerate(self.steps):
+            n = self.n_rows if positions is None else len(positions)
+            if n == 0:
+                for rest in self.steps[i:]:
+                    rest.skipped = True
+                break
+            if step.exact and step.estimate == 0:
+                step.rows_in, step.rows_out = 0, 0
+                continue
+            m = np.asarray(evaluate(step, positions), dtype=bool)
+            hits = np.flatnonzero(m) if positions is None else positions[m]
+            matched[hits] = True
+            positions = np.flatnonzero(~m) if positions is None else positions[~m]
+            step.rows_in, step.rows_out = n, len(hits)
+        return np.flatnonzero(matched)
+
+    def explain(self) -> str:
+        """選んだ評価順と見積もり（実行後は評価した行数・一致した行数も）をテキストにする。"""
+        lines = [f"{self.combine} over {self.n_rows} rows"]
+        for i, s in enumerate(self.steps, 1):
+            est = 'unknown' if s.estimate is None else f"{s.estimate:.4f}"
+            line = f"  {i}. {s.col} {s.mode} {s.q!r}  est={est}"
+            if s.source:
+                line += f" ({s.source}{', exact' if s.exact else ''})"
+            if s.skipped:
+                line += "  skipped"
+            elif s.rows_in is not None:
+                line += f"  rows {s.rows_in} -> {s.rows_out}"
+            lines.append(line)
+        return '\n'.join(lines)
+
+    def to_dict(self) -> dict:
+        return {'combine': self.combine, 'n_rows': self.n_rows, 'steps': [s.to_dict() for s in self.steps]}
+
+    def __repr__(self) -> str:
+        return self.explain()
+
+
+def sample_positions(n_rows: int, size: int = SAMPLE_ROWS) -> np.ndarray:
+    """見積もり用に等間隔で選んだ行位置（同じ行数なら毎回同じ）。"""
+    if n_rows <= size:
+        return np.arange(n_rows)
+    return np.linspace(0, n_rows - 1, size).astype(np.int64)
+
+
+def make_plan(filters: list, combine: str, n_rows: int, estimate=None) -> Plan:
+    """フィルタ [(col, q, mode)] または [(col, q, mode, state)]（空のクエリは除いたもの）の評価順を決める。
+
+    estimate(step, rank) は step.target・estimate・source・exact・state を設定する関数。
+    rank が False のとき（フィルタが1つ、または行数が少なく並べ替えの得がないとき）は、
+    評価にも使うもの（target など）と、ただで分かる見積もりだけを設定すればよい。
+    """
+    if combine not in ('AND', 'OR'):
+        combine = 'AND'
+    steps = [Step(*f) for f in filters]
+    if estimate is not None:
+        rank = len(steps) > 1 and n_rows >= MIN_ROWS_TO_ESTIMATE
+        for step in steps:
+            estimate(step, rank)
+    order = sorted(range(len(steps)), key=lambda i: _order_key(steps[i], combine, i))
+    return Plan([steps[i] for i in order], combine, n_rows)
+
+
+def _order_key(step: Step, combine: str, i: int) -> tuple:
+    if step.estimate is None:
+        return (1, 0.0, i)
+    return (0, step.estimate if combine == 'AND' else -step.estimate, i)
@@ -0,0 +1,260 @@
+"""
+静的ホスティング用の分割済み検索インデックスを作る。
+
+    python static_index.py --data-dir data --out static_index
+
+サーバなしで配信する index.html が、毎回CSV全体を取得して全行を線形に絞り込まなくて済むように、
+次のファイルを事前に作る。マニフェスト以外のファイル名には内容のハッシュを入れるので、
+CDNでは期限なしでキャッシュでき、データが変わったファイルだけ名前が変わる。
+
+- manifest.json            列・行数・シャードとパーティションのファイル名（これだけは短いキャッシュで配信する）
+- postings/<n>.<hash>.json  n-gram（1文字と2文字）→ 行番号の差分符号化リスト。n-gramのハッシュでシャードに分ける
+- rows/<年度>.<hash>.json   年度ごとの行（年度の降順に通し番号を振るので、各ファイルは連続した行番号の範囲）
+
+検索（index.html と StaticIndex.search）は、空白区切りの各語について
+- 語の2文字のn-gram（1文字の語ならその文字）のポスティングを積集合して候補の行番号を求め
+- 候補を含む年度のファイルだけを取得し、語がどれかの列の部分文字列になっているかを確かめる
+取得するファイルの数と大きさはヒットする行数で決まり、アーカイブ全体の大きさには比例しない。
+
+文字列は normalize_text で正規化する（index.html の normalizeText は同じ変換を JavaScript で行う）。
+"""
+import argparse
+import hashlib
+import json
+import math
+import sys
+from pathlib import Path
+import pandas as pd
+from ingest import YEAR_COLUMNS, report_problems
+from kakodata_utils import load_csvs_from_dir
+from normalize import normalize_text
+
+
+INDEX_FORMAT = 1
+MANIFEST_NAME = 'manifest.json'
+POSTINGS_DIR = 'postings'
+ROWS_DIR = 'rows'
+# ポスティングのシャード1つのおおよその大きさ（バイト）
+SHARD_TARGET_BYTES = 64 * 1024
+# index.html が表示に使う列（年度・授業名・教員名）の候補
+FIELD_CANDIDATES = {
+    'year': YEAR_COLUMNS,
+    'subject': ('授業名', '科目', 'subject', 'class'),
+    'teacher': ('教員名', '教員', 'teacher', 'instructor'),
+}
+
+
+def gram_hash(gram: str) -> int:
+    """n-gramのシャードを決める32ビットFNV-1a（コードポイント単位。index.html の gramHash と同じ）。"""
+    h = 0x811c9dc5
+    for ch in gram:
+        h = ((h ^ ord(ch)) * 0x01000193) & 0xffffffff
+    return h
+
+
+def query_grams(word: str) -> list:
+    """正規化済みの語を引くのに使うn-gram。"""
+    if len(word) < 2:
+        return [word] if word else []
+    return list(dict.fromkeys(word[i:i + 2] for i in range(len(word) - 1)))
+
+
+def _text_grams(text: str) -> set:
+    grams = set(text)
+    grams.update(text[i:i + 2] for i in range(len(text) - 1))
+    return grams
+
+
+def _delta(ids: list) -> list:
+    return [ids[0]] + [b - a for a, b in zip(ids, ids[1:])] if ids else []
+
+
+def _undelta(deltas: list) -> list:
+    out = []
+    total = 0
+    for d in deltas:
+        total += d
+        out.append(total)
+    return out
+
+
+def _dumps(obj) -> bytes:
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def _write_hashed(dir_path: Path, stem: str, body: bytes) -> str:
+    """内容のハッシュを入れた名前で書き、出力ディレクトリからの相対パスを返す。"""
+    name = f"{stem}.{hashlib.sha1(body).hexdigest()[:12]}.json"
+    path = dir_path / name
+    if not path.exists():
+        path.write_bytes(body)
+    return f"{dir_path.name}/{name}"
+
+
+def _find_field(columns: list, candidates) -> int:
+    lowered = [str(c).lower() for c in columns]
+    for cand in candidates:
+        if cand.lower() in lowered:
+            return lowered.index(cand.lower())
+    return None
+
+
+def _cell(v) -> str:
+    return '' if pd.isna(v) else str(v)
+
+
+def _manifest_files(path: Path) -> set:
+    """マニフェストが参照するファイルの相対パス。マニフェストがない・読めないときは空。"""
+    try:
+        manifest = json.loads(path.read_text(encoding='utf-8'))
+    except (OSError, ValueError):
+        return set()
+    return set(manifest.get('shards', [])) | {p['file'] for p in manifest.get('partitions', [])}
+
+
+def build_static_index(data_dir: str, out_dir: str, shard_bytes: int = SHARD_TARGET_BYTES, reports: list = None) -> dict:
+    """data_dir のCSVから out_dir に分割インデックスを作り、マニフェストを返す。
+
+    マニフェストは最後に置き換えるので、書き出し中に配信しても古いか新しいかのどちらかが揃って見える。
+    置き換える前のマニフェストが参照するファイルは残すので、前の世代のマニフェストを読んだクライアントも
+    次に作り直すまでは検索を続けられる。消すのは直近2世代のどちらのマニフェストからも参照されないファイルだけ。
+    reports にリストを渡すと、CSVごとの取り込み結果（ingest.FileReport）を追加する。
+    """
+    df = load_csvs_from_dir(data_dir, reports)
+    columns = [str(c) for c in df.columns]
+    fields = {k: _find_field(columns, cands) for k, cands in FIELD_CANDIDATES.items()}
+    year_col = columns[fields['year']] if fields['year'] is not None else None
+    if year_col is not None:
+        df = df.sort_values(year_col, ascending=False, kind='stable', na_position='last')
+    rows = [[_cell(v) for v in row] for row in df.itertuples(index=False, name=None)]
+    if year_col is not None:
+        for row in rows:
+            # 年度は数値として出す（空欄の年度があるファイルは float で読まれている）
+            y = row[fields['year']]
+            row[fields['year']] = int(float(y)) if y else None
+
+    out = Path(out_dir)
+    postings_dir = out / POSTINGS_DIR
+    rows_dir = out / ROWS_DIR
+    postings_dir.mkdir(parents=True, exist_ok=True)
+    rows_dir.mkdir(parents=True, exist_ok=True)
+
+    # 年度ごとの行のファイル（行番号は通し番号）
+    partitions = []
+    start = 0
+    while start < len(rows):
+        year = rows[start][fields['year']] if year_col is not None else None
+        end = start
+        while end < len(rows) and (year_col is None or rows[end][fields['year']] == year):
+            end += 1
+        stem = str(year) if year is not None else 'none'
+        partitions.append({'year': year, 'start': start, 'count': end - start,
+                           'file': _write_hashed(rows_dir, stem, _dumps(rows[start:end]))})
+        start = end
+
+    # n-gram → 行番号
+    postings = {}
+    for rid, row in enumerate(rows):
+        grams = set()
+        for v in row:
+            if v is not None and v != '':
+                grams |= _text_grams(normalize_text(str(v)))
+        for g in grams:
+            postings.setdefault(g, []).append(rid)
+    encoded = {g: _delta(ids) for g, ids in postings.items()}
+    approx = sum(len(_dumps(g)) + len(_dumps(d)) + 2 for g, d in encoded.items())
+    n_shards = max(1, math.ceil(approx / shard_bytes))
+    shards = [{} for _ in range(n_shards)]
+    for g in sorted(encoded):
+        shards[gram_hash(g) % n_shards][g] = encoded[g]
+    shard_files = [_write_hashed(postings_dir, str(i), _dumps(s)) for i, s in enumerate(shards)]
+
+    manifest = {
+        'format': INDEX_FORMAT,
+        'columns': columns,
+        'fields': fields,
+        'rows': len(rows),
+        'shards': shard_files,
+        'partitions': partitions,
+    }
+    previous = _manifest_files(out / MANIFEST_NAME)
+    tmp = out / (MANIFEST_NAME + '.tmp')
+    tmp.write_bytes(_dumps(manifest))
+    tmp.replace(out / MANIFEST_NAME)
+
+    keep = _manifest_files(out / MANIFEST_NAME) | previous
+    for d in (postings_dir, rows_dir):
+        for f in d.glob('*.json'):
+            if f"{d.name}/{f.name}" not in keep:
+                f.unlink()
+    return manifest
+
+
+class StaticIndex:
+    """build_static_index で作ったインデックスを、index.html と同じ手順で検索する（確認・テスト用）。
+
+    fetched には取得したファイルの相対パスが入る。
+    """
+
+    def __init__(self, out_dir: str):
+        self.dir = Path(out_dir)
+        self.manifest = json.loads((self.dir / MANIFEST_NAME).read_text(encoding='utf-8'))
+        self.fetched = []
+        self._files = {}
+
+    def _load(self, rel: str):
+        data = self._files.get(rel)
+        if data is None:
+            data = self._files[rel] = json.loads((self.dir / rel).read_text(encoding='utf-8'))
+            self.fetched.append(rel)
+        return data
+
+    def _postings(self, gram: str) -> list:
+        shards = self.manifest['shards']
+        return _undelta(self._load(shards[gram_hash(gram) % len(shards)]).get(gram, []))
+
+    def search(self, query: str) -> list:
+        """空白区切りの語をすべて含む行（年度の降順）を返す。"""
+        words = [normalize_text(w) for w in query.replace('　', ' ').split()]
+        words = [w for w in words if w]
+        if not words:
+            return []
+        cand = None
+        for w in words:
+            for g in query_grams(w):
+                ids = set(self._postings(g))
+                cand = ids if cand is None else cand & ids
+                if not cand:
+                    return []
+        out = []
+        for part in self.manifest['partitions']:
+            lo, hi = part['start'], part['start'] + part['count']
+            ids = sorted(i for i in cand if lo <= i < hi)
+            if not ids:
+                continue
+            rows = self._load(part['file'])
+            for i in ids:
+                row = rows[i - lo]
+                texts = [normalize_text(str(v)) for v in row if v is not None]
+                if all(any(w in t for t in texts) for w in words):
+                    out.append(row)
+        return out
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='index.html 用の分割済み検索インデックスを作る')
+    parser.add_argument('--data-dir', default='data')
+    parser.add_argument('--out', default='static_index')
+    parser.add_argument('--shard-bytes', type=int, default=SHARD_TARGET_BYTES)
+    args = parser.parse_args(argv)
+    reports = []
+    manifest = build_static_index(args.data_dir, args.out, args.shard_bytes, reports)
+    for line in report_problems(reports):
+        print(line, file=sys.stderr)
+    print(f"{manifest['rows']} rows, {len(manifest['shards'])} posting shards, "
+          f"{len(manifest['partitions'])} year partitions -> {args.out}", file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,88 @@
+"""
+授業名・教員名の入力候補（オートコンプリート）。
+
+ロード時に列ごとの重複のない値と出現回数を集計し、正規化したキーの整列済み配列を作る。
+前方一致は bisect による範囲検索、部分一致（infix）は全ての接尾辞を並べた配列
+（接尾辞配列）に対する同じ範囲検索で求める。候補は出現回数の多い順に上位k件を返す。
+教員名のように「・」区切りで複数の値を持つ列は、1人ずつに分けて集計する。
+"""
+from bisect import bisect_left
+from collections import Counter
+import heapq
+import pandas as pd
+from normalize import normalize_text
+
+
+DEFAULT_K = 10
+TEACHER_SEP = '・'
+_MAX_CHAR = '\U0010ffff'
+
+
+class _Field:
+    def __init__(self, counts: Counter):
+        self.values = list(counts)
+        self.freq = [counts[v] for v in self.values]
+        keys = [normalize_text(v) for v in self.values]
+        prefix = sorted((k, i) for i, k in enumerate(keys))
+        self.prefix_keys = [k for k, _ in prefix]
+        self.prefix_ids = [i for _, i in prefix]
+        suffix = sorted((k[j:], i) for i, k in enumerate(keys) for j in range(len(k)))
+        self.suffix_keys = [k for k, _ in suffix]
+        self.suffix_ids = [i for _, i in suffix]
+
+
+def _range(keys: list, ids: list, nq: str) -> list:
+    lo = bisect_left(keys, nq)
+    hi = bisect_left(keys, nq + _MAX_CHAR, lo)
+    return ids[lo:hi]
+
+
+class Suggester:
+    """列ごとの入力候補。
+
+    columns: {列名: 区切り文字 or None}
+    """
+
+    def __init__(self, df: pd.DataFrame, columns: dict):
+        self._fields = {}
+        for col, sep in columns.items():
+            if col is None or df is None or col not in df.columns:
+                continue
+            self._add_field(col, sep, df[col].dropna().astype(str).value_counts(sort=False))
+
+    @classmethod
+    def from_counts(cls, counts: dict, columns: dict) -> 'Suggester':
+        """列ごとの値の出現回数（{列名: pd.Series}）から作る。全行をつないだDataFrameを作らずに済む。"""
+        self = cls(None, {})
+        for col, sep in columns.items():
+            if col is not None and col in counts:
+                self._add_field(col, sep, counts[col])
+        return self
+
+    def _add_field(self, col: str, sep, value_counts: pd.Series) -> None:
+        counts = Counter()
+        for value, n in value_counts.items():
+            parts = value.split(sep) if sep else [value]
+            for part in parts:
+                part = part.strip()
+                if part:
+                    counts[part] += int(n)
+        self._fields[col] = _Field(counts)
+
+    @property
+    def columns(self) -> list:
+        return list(self._fields)
+
+    def suggest(self, column: str, q: str, k: int = DEFAULT_K, infix: bool = False) -> list:
+        """q で始まる（infix=True なら q を含む）値を [(値, 出現回数)] で返す。
+
+        並び順は、前方一致 → 出現回数の多い順 → 値の順。
+        """
+        field = self._fields.get(column)
+        nq = normalize_text(str(q).strip())
+        if field is None or not nq:
+            return []
+        prefix = set(_range(field.prefix_keys, field.prefix_ids, nq))
+        cand = set(_range(field.suffix_keys, field.suffix_ids, nq)) if infix else prefix
+        top = heapq.nsmallest(k, cand, key=lambda i: (i not in prefix, -field.freq[i], field.values[i]))
+        return [(field.values[i], field.freq[i]) for i in top]
@@ -5,3 +5,14 @@ from pathlib import Path
 ROOT = Path(__file__).resolve().parents[1]
 if str(ROOT) not in sys.path:
     sys.path.insert(0, str(ROOT))
+
+import pytest
+
+
+@pytest.fixture
+def write_year():
+    """年度ごとのCSV（kakodata_<年度>.csv、列は 年度・授業名・教員名）を書く関数。rows は (授業名, 教員名) の組。"""
+    def write(dir_path, year, rows):
+        lines = ['年度,授業名,教員名'] + [f"{year},{s},{t}" for s, t in rows]
+        (Path(dir_path) / f"kakodata_{year}.csv").write_text('\n'.join(lines) + '\n', encoding='utf-8')
+    return write
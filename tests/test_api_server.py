@@ -0,0 +1,89 @@
+import gzip
+import json
+import threading
+import urllib.error
+import urllib.request
+from urllib.parse import quote
+import pytest
+import api_server
+from api_server import make_server
+from query_cache import QueryCache
+
+
+@pytest.fixture
+def api(tmp_path, write_year):
+    write_year(tmp_path, 2018, [('民法1', '森田'), ('刑法', '佐伯')])
+    write_year(tmp_path, 2019, [('上級民法2', '中原・森田'), ('憲法', '宍戸')])
+    write_year(tmp_path, 2020, [('民法3', '小粥')])
+    server = make_server(str(tmp_path), port=0, quiet=True)
+    server.service.cache = QueryCache()
+    t = threading.Thread(target=server.serve_forever, daemon=True)
+    t.start()
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+
+    def get(path, headers=None):
+        req = urllib.request.Request(base + path, headers=headers or {})
+        try:
+            with urllib.request.urlopen(req) as r:
+                return r.status, dict(r.headers), r.read()
+        except urllib.error.HTTPError as e:
+            return e.code, dict(e.headers), e.read()
+
+    yield get, tmp_path
+    server.shutdown()
+    server.server_close()
+
+
+def test_search_pagination_and_filters(api):
+    get, _ = api
+    status, _, body = get('/search?' + quote('授業名') + '=' + quote('民法') + '&page_size=2')
+    data = json.loads(body)
+    assert status == 200
+    assert data['total'] == 3 and data['pages'] == 2
+    assert data['columns'] == ['年度', '授業名', '教員名']
+    assert data['rows'] == [[2020, '民法3', '小粥'], [2019, '上級民法2', '中原・森田']]
+    assert json.loads(get('/search?' + quote('授業名') + '=' + quote('民法') + '&page_size=2&page=2')[2])['rows'] == [
+        [2018, '民法1', '森田']]
+
+    # 年度は範囲、filter= で列ごとのモード、OR
+    q = '&'.join([quote('年度') + '=2019-2020', 'filter=' + quote('教員名:exact:森田'), 'combine=OR'])
+    data = json.loads(get('/search?' + q)[2])
+    assert [r[1] for r in data['rows']] == ['民法3', '上級民法2', '憲法', '民法1']
+
+    assert get('/search?mode=fuzzy')[0] == 400
+    assert get('/search?filter=' + quote('授業名:regex:('))[0] == 400
+    assert get('/search?nosuch=x')[0] == 400
+    assert get('/nowhere')[0] == 404
+
+
+def test_etag_and_gzip(api, monkeypatch, write_year):
+    get, tmp_path = api
+    monkeypatch.setattr(api_server, 'GZIP_MIN_BYTES', 0)
+    status, headers, body = get('/search?page_size=1000', {'Accept-Encoding': 'gzip'})
+    assert status == 200 and headers['Content-Encoding'] == 'gzip'
+    assert json.loads(gzip.decompress(body))['total'] == 5
+    etag = headers['ETag']
+
+    status, _, body = get('/search?page_size=1000', {'If-None-Match': etag})
+    assert status == 304 and body == b''
+    # 別のクエリは別のETag
+    assert get('/search?page_size=10')[1]['ETag'] != etag
+
+    # データが変わればETagも変わる
+    write_year(tmp_path, 2021, [('民法4', '森田')])
+    status, headers, body = get('/search?page_size=1000', {'If-None-Match': etag})
+    assert status == 200 and headers['ETag'] != etag
+    assert json.loads(body)['total'] == 6
+
+
+def test_suggest_and_export(api):
+    get, _ = api
+    data = json.loads(get('/suggest?column=' + quote('教員名') + '&q=' + quote('森'))[2])
+    assert data['suggestions'] == [{'value': '森田', 'count': 2}]
+    data = json.loads(get('/suggest?column=' + quote('授業名') + '&q=' + quote('民法') + '&infix=1&k=2')[2])
+    assert [s['value'] for s in data['suggestions']] == ['民法1', '民法3']
+    assert get('/suggest?column=nosuch&q=x')[0] == 400
+
+    status, headers, body = get('/export?' + quote('授業名') + '=' + quote('民法'))
+    assert status == 200 and headers['Content-Type'].startswith('text/csv')
+    assert body.decode('utf-8-sig').splitlines() == ['年度,授業名,教員名', '2020,民法3,小粥', '2019,上級民法2,中原・森田', '2018,民法1,森田']
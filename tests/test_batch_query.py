@@ -0,0 +1,89 @@
+import io
+import json
+import pandas as pd
+import batch_query
+from batch_query import BatchQuery, BatchRunner, BatchQueryError, read_queries, run_batch, open_runner, main
+from kakodata_utils import search_df
+from normalize import add_normalized_columns
+
+
+def _df():
+    return add_normalized_columns(pd.DataFrame({
+        '年度': [2020, 2019, 2019, 2018, 2018],
+        '授業名': ['民法3', '上級民法2', '憲法', '民法1', '刑法'],
+        '教員名': ['小粥', '中原・森田', '宍戸', '森田', '佐伯'],
+    }))
+
+
+def test_read_queries_groups_by_id(tmp_path):
+    (tmp_path / 'q.csv').write_text(
+        'id,column,query,mode,combine\n'
+        'a,授業名,民法,,\n'
+        'a,教員名,森田,exact,\n'
+        'b,年度,2019-,,OR\n', encoding='utf-8')
+    queries = read_queries(str(tmp_path / 'q.csv'))
+    assert [(q.id, q.filters, q.combine) for q in queries] == [
+        ('a', [('授業名', '民法', 'contains'), ('教員名', '森田', 'exact')], 'AND'),
+        ('b', [('年度', '2019-', 'range')], 'OR'),
+    ]
+    jsonl = '{"filters": [["授業名", "民法"]], "combine": "or"}\n\n{"id": 7, "column": "教員名", "query": "森"}\n'
+    queries = read_queries(io.StringIO(jsonl), 'jsonl')
+    assert [(q.id, q.filters, q.combine) for q in queries] == [
+        (1, [('授業名', '民法', 'contains')], 'OR'), (7, [('教員名', '森', 'contains')], 'AND')]
+    try:
+        read_queries(io.StringIO('column,query,mode\n授業名,民法,fuzzy\n'), 'csv')
+        assert False
+    except BatchQueryError as e:
+        assert 'line 1' in str(e)
+
+
+def test_results_match_search_df():
+    df = _df()
+    runner = BatchRunner(df)
+    queries = [
+        BatchQuery('q1', [('授業名', '民法')]),
+        BatchQuery('q2', [('授業名', '民法'), ('教員名', '森田', 'exact')]),
+        BatchQuery('q3', [('年度', '2020', 'range'), ('教員名', '佐伯')], 'OR'),
+        BatchQuery('q4', [('授業名', '')]),
+        BatchQuery('bad', [('授業名', '(', 'regex')]),
+        BatchQuery('q5', [('nosuch', 'x')]),
+    ]
+    for q in queries[:4]:
+        assert list(runner.positions(q)) == list(search_df(df, q.filters, q.combine).index), q
+
+    out = io.StringIO()
+    stats = run_batch(runner, queries, out, 'jsonl', workers=1, limit=2)
+    lines = [json.loads(line) for line in out.getvalue().splitlines()]
+    assert lines[0] == {'query_id': 'q1', '年度': 2020, '授業名': '民法3', '教員名': '小粥'}
+    assert [r['query_id'] for r in lines] == ['q1', 'q1', 'q2', 'q2', 'q3', 'q3', 'q4', 'q4', 'bad', 'q5']
+    assert 'error' in lines[-1] and 'error' in lines[-2]
+    assert stats['rows'] == 8 and [qid for qid, _ in stats['errors']] == ['bad', 'q5']
+
+    out = io.StringIO()
+    run_batch(runner, queries[1:3], out, 'csv', workers=1)
+    assert out.getvalue().splitlines() == [
+        'query_id,年度,授業名,教員名', 'q2,2019,上級民法2,中原・森田', 'q2,2018,民法1,森田',
+        'q3,2020,民法3,小粥', 'q3,2018,刑法,佐伯']
+
+
+def test_process_pool_gives_same_output(monkeypatch):
+    monkeypatch.setattr(batch_query, 'PARALLEL_MIN_QUERIES', 1)
+    runner = BatchRunner(_df())
+    queries = [BatchQuery(i, [('授業名', q)]) for i, q in enumerate(['民法', '法', '憲', '民法', 'なし'] * 3)]
+    serial, pooled = io.StringIO(), io.StringIO()
+    s1 = run_batch(runner, queries, serial, 'jsonl', workers=1, chunk_size=2)
+    s2 = run_batch(runner, queries, pooled, 'jsonl', workers=2, chunk_size=2)
+    assert serial.getvalue() == pooled.getvalue() and s1 == s2
+
+
+def test_cli_reads_data_dir(tmp_path):
+    data = tmp_path / 'data'
+    data.mkdir()
+    df = _df().drop(columns=[c for c in _df().columns if c.startswith('_norm_')])
+    for year, part in df.groupby('年度'):
+        part.to_csv(data / f'kakodata_{year}.csv', index=False)
+    (tmp_path / 'q.jsonl').write_text('{"id": "x", "column": "授業名", "query": "民法"}\n', encoding='utf-8')
+    out = tmp_path / 'out.csv'
+    assert main([str(tmp_path / 'q.jsonl'), '--data-dir', str(data), '--format', 'csv', '--out', str(out)]) == 0
+    assert out.read_text(encoding='utf-8').splitlines()[1:] == ['x,2020,民法3,小粥', 'x,2019,上級民法2,中原・森田', 'x,2018,民法1,森田']
+    assert len(open_runner(str(data)).frame) == 5
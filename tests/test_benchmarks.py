@@ -0,0 +1,28 @@
+import json
+from benchmarks.generate import generate, write_dir
+from benchmarks.harness import run, compare, MODES, COMBINES
+
+
+def test_generate_is_deterministic_and_realistic(tmp_path):
+    df = generate(2000, seed=1)
+    assert list(df.columns) == ['年度', '授業名', '教員名']
+    assert df.equals(generate(2000, seed=1))
+    assert df['教員名'].str.contains('・').mean() > 0.1
+    paths = write_dir(tmp_path, 500, seed=1, years=(2020, 2021))
+    assert [p.name for p in paths] == ['kakodata_2020.csv', 'kakodata_2021.csv']
+
+
+def test_run_covers_every_mode_and_compares(tmp_path):
+    report = run([300], repeat=1, workdir=str(tmp_path))
+    json.dumps(report, ensure_ascii=False)
+    names = {e['name'] for e in report['results']}
+    assert names == {'load_csvs_from_dir', 'search_df', 'append_row', 'import_dir_to_db', 'search_db', 'append_row_db'}
+    searches = [e for e in report['results'] if e['name'] == 'search_df']
+    assert {(e['mode'], e['combine']) for e in searches} == {(m, c) for m in MODES for c in COMBINES}
+    # 同じ検索は search_df と search_db で同じ件数になる
+    hits = {}
+    for e in report['results']:
+        if e['name'] in ('search_df', 'search_db'):
+            hits.setdefault((e['mode'], e['combine'], e['selectivity']), set()).add(e['hits'])
+    assert all(len(v) == 1 for v in hits.values())
+    assert len(compare(report, report)) == len(report['results'])
@@ -1,7 +1,10 @@
 import tempfile
 import os
 import pandas as pd
-from db_utils import init_db, import_csv_to_db, search_db, append_row_db, get_table_columns
+import sqlite3
+import pytest
+import db_utils
+from db_utils import init_db, import_csv_to_db, search_db, append_row_db, append_rows_db, get_table_columns, get_db, import_dir_to_db
 
 
 def test_import_and_search_and_append(tmp_path):
@@ -43,3 +46,205 @@ def test_search_modes_db(tmp_path):
     assert len(r1) == 2
     r2 = search_db(str(db_path), [('notes', '^abc', 'regex')])
     assert len(r2) == 1
+
+
+def test_fts_and_regexp_modes(tmp_path):
+    csv_path = tmp_path / 'test3.csv'
+    df = pd.DataFrame({
+        'subject': ['基本科目民法1', '上級民法2', '刑法', 'Civil Law'],
+        'teacher': ['森田修', '中原太郎・水津太郎', '佐伯仁志', 'Smith']
+    })
+    df.to_csv(csv_path, index=False)
+    db_path = tmp_path / 'test3.db'
+    import_csv_to_db(str(csv_path), str(db_path), if_exists='replace', fts=True)
+    plain_path = tmp_path / 'plain.db'
+    import_csv_to_db(str(csv_path), str(plain_path), if_exists='replace', fts=False)
+
+    queries = [
+        ([('subject', '科目民法')], 'AND'),   # FTS(3文字以上)
+        ([('subject', '民法')], 'AND'),       # 3文字未満はLIKE
+        ([('subject', 'civil law')], 'AND'),
+        ([('teacher', '水津太郎')], 'AND'),
+        ([('subject', '上級民', 'startswith')], 'AND'),
+        ([('subject', '^刑', 'regex'), ('teacher', '森田')], 'OR'),
+        ([('subject', '民法', 'contains'), ('teacher', '太郎$', 'regex')], 'AND'),
+        ([('nosuch', '民法')], 'AND'),
+    ]
+    for filters, combine in queries:
+        r1 = search_db(str(db_path), filters, combine=combine)
+        r2 = search_db(str(plain_path), filters, combine=combine)
+        assert list(r1['subject']) == list(r2['subject'])
+
+    assert len(search_db(str(db_path), [('subject', '^刑', 'regex'), ('teacher', '森田')], combine='OR')) == 2
+
+    # 追加した行もFTS経由で見つかる
+    append_row_db(str(db_path), {'subject': '上級刑法', 'teacher': '川出敏裕'}, backup=False)
+    assert len(search_db(str(db_path), [('teacher', '川出敏裕')])) == 1
+
+    # 列を追加した後に追加した行も、その列のFTS（3文字以上）で見つかる
+    append_row_db(str(db_path), {'subject': '商法', 'teacher': '神作', 'note': 'abcdefg'}, backup=False)
+    append_row_db(str(db_path), {'subject': '会社法', 'teacher': '神田', 'note': 'abcdefg'}, backup=False)
+    assert list(search_db(str(db_path), [('note', 'abcdef')])['subject']) == ['商法', '会社法']
+
+
+def test_append_rows_uses_wal_and_changelog(tmp_path, monkeypatch):
+    csv_path = tmp_path / 'test4.csv'
+    pd.DataFrame({'subject': ['民法'], 'teacher': ['森田']}).to_csv(csv_path, index=False)
+    db_path = tmp_path / 'test4.db'
+    import_csv_to_db(str(csv_path), str(db_path))
+
+    append_rows_db(str(db_path), [
+        {'subject': '刑法', 'teacher': '田中'},
+        {'teacher': '佐藤', 'subject': '憲法'},
+        {'subject': '商法', 'teacher': '鈴木', 'note': '追加列'},
+    ])
+    res = search_db(str(db_path), [('subject', '法')])
+    assert list(res['subject']) == ['民法', '刑法', '憲法', '商法']
+    assert res.iloc[3]['note'] == '追加列'
+
+    conn = sqlite3.connect(str(db_path))
+    assert conn.execute("PRAGMA journal_mode").fetchone()[0] == 'wal'
+    conn.close()
+
+    log = tmp_path / 'test4.changelog.jsonl'
+    assert len(log.read_text(encoding='utf-8').splitlines()) == 3
+
+    # ログが上限を超えたらCSVバックアップに畳み込まれる
+    monkeypatch.setattr(db_utils, 'BACKUP_LOG_MAX_BYTES', 0)
+    append_row_db(str(db_path), {'subject': '行政法', 'teacher': '太田'})
+    assert log.read_text(encoding='utf-8') == ''
+    assert len(pd.read_csv(tmp_path / 'test4.backup.csv')) == 5
+
+
+def test_concurrent_appends_keep_backup_and_changelog_consistent(tmp_path, monkeypatch):
+    import json
+    import threading
+    db_path = str(tmp_path / 'test_race.db')
+    append_row_db(db_path, {'subject': '初期', 'teacher': '森田'})
+    monkeypatch.setattr(db_utils, 'BACKUP_LOG_MAX_BYTES', 300)
+
+    def work(w):
+        for i in range(20):
+            append_row_db(db_path, {'subject': f'{w}-{i}', 'teacher': '田中'})
+    threads = [threading.Thread(target=work, args=(w,)) for w in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    # バックアップと変更ログを合わせると、テーブルの行がちょうど1回ずつ現れる
+    table = sorted(r[0] for r in sqlite3.connect(db_path).execute("SELECT subject FROM kakodata"))
+    backup = pd.read_csv(tmp_path / 'test_race.backup.csv')['subject'].tolist()
+    log = [json.loads(line)['row']['subject']
+           for line in (tmp_path / 'test_race.changelog.jsonl').read_text(encoding='utf-8').splitlines()]
+    assert len(table) == 81
+    assert sorted(backup + log) == table
+
+
+def test_kakodb_reuses_connections_and_caches_schema(tmp_path):
+    csv_path = tmp_path / 'test5.csv'
+    pd.DataFrame({'subject': ['民法', '刑法'], 'teacher': ['森田', '田中']}).to_csv(csv_path, index=False)
+    db_path = tmp_path / 'test5.db'
+    import_csv_to_db(str(csv_path), str(db_path))
+
+    db = get_db(str(db_path))
+    assert db is get_db(str(db_path))
+    reader = db.reader()
+    search_db(str(db_path), [('subject', '民法')])
+    search_db(str(db_path), [('subject', '刑法')])
+    assert db.reader() is reader
+    assert len(db._sql_cache) == 1
+
+    # 検索用コネクションは読み取り専用
+    with pytest.raises(sqlite3.OperationalError):
+        reader.execute("DELETE FROM kakodata")
+
+    assert get_table_columns(str(db_path)) == ['subject', 'teacher']
+    append_row_db(str(db_path), {'subject': '憲法', 'teacher': '佐藤', 'note': 'x'}, backup=False)
+    assert get_table_columns(str(db_path)) == ['subject', 'teacher', 'note']
+    db.close()
+    assert len(search_db(str(db_path), [('note', 'x')])) == 1
+
+    # 終わったスレッドのコネクションは閉じて、持ち続けない
+    import gc
+    import threading
+    for _ in range(20):
+        t = threading.Thread(target=lambda: search_db(str(db_path), [('subject', '民法')]))
+        t.start()
+        t.join()
+    gc.collect()
+    assert len(db._threads) == 1
+    # 別スレッドのコネクションも close() で閉じる
+    t = threading.Thread(target=db.reader)
+    t.start()
+    t.join()
+    held = [c for tc in db._threads for c in tc.conns]
+    db.close()
+    with pytest.raises(sqlite3.ProgrammingError):
+        held[0].execute("SELECT 1")
+
+
+def test_search_db_exact_mode(tmp_path):
+    csv_path = tmp_path / 'test6.csv'
+    pd.DataFrame({
+        '授業名': ['民法(1)', '民法(1)演習', '民法Ⅰ'],
+        '教員名': ['小粥太郎・石川博康', '石川博康', '小粥太郎'],
+    }).to_csv(csv_path, index=False)
+    db_path = tmp_path / 'test6.db'
+    import_csv_to_db(str(csv_path), str(db_path))
+    assert search_db(str(db_path), [('授業名', '民法(1)', 'exact')])['授業名'].tolist() == ['民法(1)']
+    assert len(search_db(str(db_path), [('教員名', '石川博康', 'exact')])) == 2
+
+    # 追加した行も完全一致索引に入る
+    append_row_db(str(db_path), {'授業名': '民法(1)', '教員名': '森田宏樹・石川博康'}, backup=False)
+    assert len(search_db(str(db_path), [('教員名', '石川博康', 'exact')])) == 3
+    assert len(search_db(str(db_path), [('授業名', '民法(1)', 'exact'), ('教員名', '森田宏樹', 'exact')])) == 1
+
+    # 索引テーブルがなくても同じ結果になる
+    csv2 = tmp_path / 'test7.db'
+    import_csv_to_db(str(csv_path), str(csv2), exact=False)
+    assert len(search_db(str(csv2), [('教員名', '石川博康', 'exact')])) == 2
+    assert len(search_db(str(csv2), [('授業名', '民法1', 'exact')])) == 1
+
+    # 区切りの前後に空白があっても、索引・索引なし・search_df が同じ行を返す
+    from kakodata_utils import search_df
+    spaced = pd.DataFrame({'授業名': ['民法', '刑法'], '教員名': ['小粥太郎 ・ 石川博康', '石川博康二']})
+    spaced.to_csv(tmp_path / 'test8.csv', index=False)
+    filters = [('教員名', '石川博康', 'exact')]
+    expected = search_df(spaced, filters)['授業名'].tolist()
+    assert expected == ['民法']
+    for exact in (True, False):
+        db = str(tmp_path / f'test8_{exact}.db')
+        import_csv_to_db(str(tmp_path / 'test8.csv'), db, exact=exact)
+        assert search_db(db, filters)['授業名'].tolist() == expected
+
+
+def test_import_dir_reimports_only_changed_files(tmp_path, monkeypatch):
+    data = tmp_path / 'data'
+    data.mkdir()
+    pd.DataFrame({'年度': [2015, 2015], '授業名': ['民法1', '刑法'], '教員名': ['森田', '田中']}).to_csv(data / 'kakodata_2015.csv', index=False)
+    pd.DataFrame({'年度': [2016], '授業名': ['民法2'], '教員名': ['佐藤']}).to_csv(data / 'kakodata_2016.csv', index=False)
+    db_path = str(tmp_path / 'dir.db')
+
+    result = import_dir_to_db(str(data), db_path)
+    assert result['imported'] == ['kakodata_2015.csv', 'kakodata_2016.csv']
+    assert get_table_columns(db_path) == ['年度', '授業名', '教員名']
+    assert len(search_db(db_path, [('授業名', '民法')])) == 2
+
+    # 変更のないファイルは読まない
+    read = []
+    orig = db_utils.read_files
+    monkeypatch.setattr(db_utils, 'read_files', lambda paths: read.extend(paths) or orig(paths))
+    pd.DataFrame({'年度': [2016, 2016], '授業名': ['民法3', '商法'], '教員名': ['佐藤', '藤田']}).to_csv(data / 'kakodata_2016.csv', index=False)
+    (data / 'kakodata_2015.csv').unlink()
+    result = import_dir_to_db(str(data), db_path)
+    assert [p.name for p in read] == ['kakodata_2016.csv']
+    assert result['removed'] == ['kakodata_2015.csv']
+    assert search_db(db_path, [])['授業名'].tolist() == ['民法3', '商法']
+    assert len(search_db(db_path, [('教員名', '佐藤', 'exact')])) == 1
+    assert len(search_db(db_path, [('授業名', '民法3', 'contains')])) == 1
+
+    with sqlite3.connect(db_path) as conn:
+        manifest = conn.execute("SELECT source, rows FROM kakodata_manifest").fetchall()
+        indexes = {r[1] for r in conn.execute("PRAGMA index_list(kakodata)")}
+    assert manifest == [('kakodata_2016.csv', 2)]
+    assert {'kakodata_年度_idx', 'kakodata_授業名_idx', 'kakodata_教員名_idx', 'kakodata__source_idx'} <= indexes
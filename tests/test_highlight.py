@@ -0,0 +1,25 @@
+import pandas as pd
+from highlight import render_table_html, compile_filters, page_count
+
+
+def test_marks_only_filtered_columns_and_escapes():
+    df = pd.DataFrame({
+        'subject': ['民法<1>', 'R&D法'],
+        'teacher': ['民法', '<b>田中</b>'],
+    })
+    html = render_table_html(df, [('subject', '民法', 'contains'), ('subject', '&d', 'contains')])
+    assert '<td><mark>民法</mark>&lt;1&gt;</td>' in html
+    assert '<td>R<mark>&amp;D</mark>法</td>' in html
+    # フィルタ対象外の列はエスケープのみ
+    assert '<td>民法</td>' in html
+    assert '&lt;b&gt;田中&lt;/b&gt;' in html
+
+
+def test_invalid_regex_is_skipped_and_pagination():
+    df = pd.DataFrame({'subject': [f'科目{i}' for i in range(25)]})
+    assert compile_filters([('subject', '(', 'regex')]) == {}
+    html = render_table_html(df, [('subject', '科目', 'contains')], page_size=10, offset=20)
+    assert html.count('<tr>') == 1 + 5
+    assert '科目</mark>20' in html and '科目</mark>19' not in html
+    assert page_count(25, 10) == 3
+    assert page_count(0, 10) == 1
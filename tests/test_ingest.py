@@ -0,0 +1,55 @@
+import io
+import pandas as pd
+from ingest import read_csv_typed, ingest_dir, ingest_files, iter_csv_chunks
+
+
+def test_typed_read_rejects_bad_years(tmp_path):
+    path = tmp_path / 'kakodata_2019.csv'
+    path.write_text('年度,授業名,教員名\n2019,民法,森田\n不明,刑法,田中\n,憲法,\n 2019 ,001,佐藤\n', encoding='utf-8')
+    df, report = read_csv_typed(path, chunksize=2)
+    assert report.ok
+    assert (report.rows_read, report.rows_rejected) == (4, 1)
+    # 年度が空欄の行は欠損として残す
+    assert df['年度'].tolist()[::2] == [2019, 2019] and pd.isna(df['年度'][1])
+    assert df['年度'].dtype == 'float64'
+    # 年度以外は型推論をせず文字列のまま
+    assert df['授業名'].tolist() == ['民法', '憲法', '001']
+    df, report = read_csv_typed(io.StringIO('年度,授業名\n2019,民法\n2020,刑法\n'))
+    assert df['年度'].dtype == 'int64'
+
+
+def test_chunks_are_bounded(tmp_path):
+    path = tmp_path / 'big.csv'
+    pd.DataFrame({'year': range(2000, 2010), 'subject': list('abcdefghij')}).to_csv(path, index=False)
+    sizes = [len(chunk) for chunk, _ in iter_csv_chunks(path, chunksize=3)]
+    assert sizes == [3, 3, 3, 1]
+
+
+def test_ingest_reports_every_file(tmp_path):
+    pd.DataFrame({'年度': [2015], '授業名': ['民法']}).to_csv(tmp_path / 'a_2015.csv', index=False)
+    pd.DataFrame({'年度': [2016], '授業名': ['刑法']}).to_csv(tmp_path / 'b_2016.csv', index=False)
+    (tmp_path / 'c_broken.csv').write_bytes(b'')
+    df, reports = ingest_dir(tmp_path, max_workers=2)
+    assert df['授業名'].tolist() == ['民法', '刑法']
+    assert [r.ok for r in reports] == [True, True, False]
+    assert 'EmptyDataError' in reports[2].error
+
+    # アップロードされたファイル（ファイルオブジェクト）も同じように読める
+    upload = io.BytesIO('年度,授業名\n2020,商法\n'.encode('utf-8'))
+    upload.name = 'upload.csv'
+    df, reports = ingest_files([upload])
+    assert df['年度'].tolist() == [2020]
+    assert reports[0].name == 'upload.csv'
+
+
+def test_blank_years_kept_and_reports_reach_store(tmp_path):
+    from kakodata_utils import load_csvs_from_dir
+    from partition_store import PartitionedStore
+    (tmp_path / 'kakodata.csv').write_text('年度,授業名\n2019,民法\n,刑法\n不明,憲法\n', encoding='utf-8')
+    reports = []
+    df = load_csvs_from_dir(tmp_path, reports)
+    assert df['授業名'].tolist() == ['民法', '刑法']
+    assert reports[0].rows_rejected == 1
+    store = PartitionedStore(tmp_path)
+    assert store.years() == [2019, None]
+    assert [(r.name.endswith('kakodata.csv'), r.rows_rejected) for r in store.reports] == [(True, 1)]
@@ -0,0 +1,57 @@
+import json
+import threading
+import pandas as pd
+import instrument
+from instrument import span, traced
+from kakodata_utils import search_df
+
+
+def test_off_records_nothing():
+    instrument.disable()
+    instrument.set_thread_enabled(False)
+    mark = instrument.last_seq()
+    with span('x') as s:
+        s.set(rows_out=1, note='ignored')
+    search_df(pd.DataFrame({'a': ['x']}), [('a', 'x')])
+    assert instrument.records(since=mark) == []
+
+
+def test_spans_record_rows_nesting_and_export(tmp_path):
+    instrument.set_thread_enabled(True)
+    try:
+        mark = instrument.last_seq()
+        df = pd.DataFrame({'授業名': ['民法', '刑法', '民法2']})
+        with span('outer', rows_in=len(df)) as s:
+            res = search_df(df, [('授業名', '民法')])
+            s.set(rows_out=len(res), cache='miss')
+    finally:
+        instrument.set_thread_enabled(False)
+    recs = instrument.records(since=mark, thread=threading.get_ident())
+    assert [r['name'] for r in recs] == ['search_df', 'outer']
+    inner, outer = recs
+    assert (inner['rows_in'], inner['rows_out'], inner['depth']) == (3, 2, 1)
+    assert (outer['rows_out'], outer['depth'], outer['meta']) == (2, 0, {'cache': 'miss'})
+    assert outer['seconds'] >= inner['seconds']
+
+    path = tmp_path / 'trace.jsonl'
+    assert instrument.export_jsonl(str(path), recs) == 2
+    lines = [json.loads(l) for l in path.read_text(encoding='utf-8').splitlines()]
+    assert [l['name'] for l in lines] == ['search_df', 'outer']
+
+
+def test_thread_enabled_is_per_thread():
+    @traced('work')
+    def work(df):
+        return df
+
+    instrument.set_thread_enabled(True)
+    try:
+        mark = instrument.last_seq()
+        t = threading.Thread(target=work, args=(pd.DataFrame({'a': [1]}),))
+        t.start()
+        t.join()
+        work(pd.DataFrame({'a': [1, 2]}))
+    finally:
+        instrument.set_thread_enabled(False)
+    recs = instrument.records(since=mark)
+    assert [(r['name'], r['rows_in']) for r in recs] == [('work', 2)]
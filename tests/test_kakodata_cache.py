@@ -0,0 +1,51 @@
+import os
+import pandas as pd
+import kakodata_cache
+from kakodata_cache import load_snapshot, clear_cache
+from kakodata_utils import load_csvs_from_dir
+
+
+def _write_years(d, write_year):
+    write_year(d, 2015, [('民法', '森田'), ('刑法', '田中')])
+    write_year(d, 2016, [('憲法', '佐藤')])
+
+
+def test_snapshot_matches_load_csvs_from_dir(tmp_path, write_year):
+    clear_cache()
+    _write_years(tmp_path, write_year)
+    df, version = load_snapshot(tmp_path)
+    pd.testing.assert_frame_equal(df, load_csvs_from_dir(tmp_path))
+    df2, version2 = load_snapshot(tmp_path)
+    assert df2 is df
+    assert version2 == version
+
+
+def test_only_changed_partition_is_reparsed(tmp_path, monkeypatch, write_year):
+    clear_cache()
+    _write_years(tmp_path, write_year)
+    load_snapshot(tmp_path)
+
+    read = []
+    orig = kakodata_cache._read_partition
+    monkeypatch.setattr(kakodata_cache, '_read_partition', lambda p: read.append(p.name) or orig(p))
+
+    f = tmp_path / 'kakodata_2016.csv'
+    with open(f, 'a', encoding='utf-8') as fh:
+        fh.write('2016,商法,鈴木\n')
+    st = f.stat()
+    os.utime(f, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000))
+    df, _ = load_snapshot(tmp_path)
+    assert read == ['kakodata_2016.csv']
+    assert len(df) == 4
+
+
+def test_cold_start_uses_disk_snapshot(tmp_path, monkeypatch, write_year):
+    clear_cache()
+    _write_years(tmp_path, write_year)
+    df, version = load_snapshot(tmp_path)
+    clear_cache()
+
+    monkeypatch.setattr(kakodata_cache, '_read_partition', lambda p: (_ for _ in ()).throw(AssertionError(p)))
+    df2, version2 = load_snapshot(tmp_path)
+    pd.testing.assert_frame_equal(df, df2)
+    assert version2 == version
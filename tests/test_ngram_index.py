@@ -0,0 +1,68 @@
+import pandas as pd
+from kakodata_utils import search_df, load_csvs_from_dir
+from ngram_index import NgramIndex
+from normalize import add_normalized_columns
+from pathlib import Path
+
+DATA_DIR = Path(__file__).resolve().parents[1] / 'data'
+
+
+def _assert_same(df, idx, filters, combine='AND'):
+    pd.testing.assert_frame_equal(idx.search(filters, combine=combine), search_df(df, filters, combine=combine))
+
+
+def test_matches_search_df_on_bundled_data():
+    df = load_csvs_from_dir(DATA_DIR)
+    idx = NgramIndex(df)
+    queries = [
+        [('授業名', '民法', 'contains')],
+        [('授業名', '法', 'contains')],
+        [('教員名', '森田', 'contains'), ('授業名', '民法', 'contains')],
+        [('教員名', '森田', 'contains'), ('授業名', '刑法', 'contains')],
+        [('授業名', '上級', 'startswith')],
+        [('授業名', '^基本科目民法1$', 'regex')],
+        [('授業名', '民法[12]', 'regex')],
+        [('年度', '2020', 'contains')],
+        [('授業名', '存在しない授業', 'contains')],
+        [('存在しない列', '民法', 'contains')],
+        [('授業名', '  ', 'contains')],
+    ]
+    for filters in queries:
+        for combine in ('AND', 'OR'):
+            _assert_same(df, idx, filters, combine)
+
+
+def test_single_character_and_case_insensitive():
+    df = pd.DataFrame({
+        'subject': ['Civil Law', '民法', 'criminal law', '刑法'],
+        'teacher': ['A', 'b', 'B', 'a'],
+    })
+    idx = NgramIndex(df)
+    _assert_same(df, idx, [('subject', 'L', 'contains')])
+    _assert_same(df, idx, [('subject', '法', 'contains')])
+    _assert_same(df, idx, [('teacher', 'b', 'startswith'), ('subject', 'law')], combine='OR')
+
+
+def test_exact_mode_uses_hash_index():
+    df = add_normalized_columns(pd.DataFrame({
+        '授業名': ['民法(1)', '民法(1)演習', '民法Ⅰ', None],
+        '教員名': ['小粥太郎・石川博康', '石川博康', '小粥太郎', '森田'],
+    }))
+    idx = NgramIndex(df)
+    for q in ('民法(1)', '民法1', '民法Ⅰ', '存在しない'):
+        _assert_same(df, idx, [('授業名', q, 'exact')])
+    _assert_same(df, idx, [('教員名', '石川博康', 'exact')])
+    assert list(idx.search([('教員名', ' 小粥太郎 ', 'exact')]).index) == [0, 2]
+
+
+def test_encoded_columns_are_not_copied_as_strings():
+    from kakodata_utils import encode_columns
+    df = encode_columns(add_normalized_columns(pd.DataFrame({
+        '授業名': ['民法1', '民法2', '刑法', '民法1'] * 10,
+        '教員名': ['森田', '中原・森田', '佐伯', None] * 10,
+    })))
+    idx = NgramIndex(df)
+    # 候補の検証は df の列（カテゴリのコード）で行い、列全体の文字列のコピーは持たない
+    assert set(vars(idx)) == {'df', '_postings', '_exact'}
+    for filters in ([('授業名', '民法1')], [('教員名', '森田', 'exact')], [('教員名', '森')], [('授業名', '^民', 'regex')]):
+        pd.testing.assert_frame_equal(idx.search(filters), search_df(df, filters))
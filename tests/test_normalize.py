@@ -0,0 +1,45 @@
+import pandas as pd
+from normalize import normalize_text, find_spans, add_normalized_columns, drop_normalized_columns
+from kakodata_utils import search_df
+from ngram_index import NgramIndex
+from db_utils import import_csv_to_db, search_db
+from highlight import render_table_html
+
+
+def test_normalize_width_roman_and_kana():
+    assert normalize_text('民法３') == normalize_text('民法Ⅲ') == normalize_text('民法3')
+    assert normalize_text('ｶﾞｸｾｲ') == normalize_text('ガクセイ') == 'がくせい'
+    assert normalize_text('ＡＢＣ') == 'abc'
+    # マッチ位置は元の文字列の位置で返る
+    assert find_spans('上級民法Ⅲ', '民法3') == [(2, 5)]
+    assert find_spans('ｶﾞｸｾｲ', 'がく') == [(0, 3)]
+    assert find_spans('民法3', '法', prefix=True) == []
+
+
+def test_search_uses_normalized_columns():
+    df = pd.DataFrame({'subject': ['基本科目民法Ⅲ', '基本科目民法３', '民法(1)', 'ガクセイ'], 'teacher': ['a', 'b', 'c', None]})
+    ndf = add_normalized_columns(df)
+    res = search_df(ndf, [('subject', '民法3', 'contains')])
+    assert list(res.index) == [0, 1]
+    # 正規化後はリテラル一致なので括弧もそのまま検索できる
+    assert list(search_df(ndf, [('subject', '民法(1)', 'contains')]).index) == [2]
+    assert list(search_df(ndf, [('subject', 'がく', 'startswith')]).index) == [3]
+    assert search_df(ndf, [('teacher', 'nan')]).empty
+    assert list(drop_normalized_columns(res).columns) == ['subject', 'teacher']
+
+    idx = NgramIndex(ndf)
+    for filters in ([('subject', '民法3')], [('subject', '民法(1)')], [('subject', 'ｶﾞ', 'startswith')]):
+        pd.testing.assert_frame_equal(idx.search(filters), search_df(ndf, filters))
+
+
+def test_search_db_and_highlight_use_normalized_text(tmp_path):
+    csv_path = tmp_path / 'n.csv'
+    pd.DataFrame({'subject': ['基本科目民法Ⅲ', '基本科目民法３', '刑法']}).to_csv(csv_path, index=False)
+    db_path = tmp_path / 'n.db'
+    import_csv_to_db(str(csv_path), str(db_path))
+    res = search_db(str(db_path), [('subject', '科目民法3')])
+    assert list(res['subject']) == ['基本科目民法Ⅲ', '基本科目民法３']
+    assert list(res.columns) == ['subject']
+
+    html = render_table_html(res, [('subject', '民法3', 'contains')])
+    assert '<mark>民法Ⅲ</mark>' in html and '<mark>民法３</mark>' in html
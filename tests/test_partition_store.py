@@ -0,0 +1,73 @@
+import pandas as pd
+from kakodata_utils import search_df
+from normalize import add_normalized_columns, drop_normalized_columns
+from partition_store import PartitionedStore
+
+
+def _write_years(d, write_year):
+    write_year(d, 2015, [('民法1', '森田'), ('刑法', '田中')])
+    write_year(d, 2016, [('民法2', '佐藤')])
+    write_year(d, 2017, [('憲法', '森田'), ('民法3', '中原')])
+
+
+def test_range_prunes_partitions_before_loading(tmp_path, write_year):
+    _write_years(tmp_path, write_year)
+    store = PartitionedStore(tmp_path)
+    assert store.years() == [2017, 2016, 2015]
+    assert store.loaded_years == []
+    res = store.search([('年度', '2016-', 'range'), ('授業名', '民法')])
+    assert drop_normalized_columns(res)['授業名'].tolist() == ['民法3', '民法2']
+    assert store.loaded_years == [2017, 2016]
+    # シャドウ列のある列は、シャドウ列だけをインデックスに持つ
+    assert set(store.partition(2017).index._postings) == {'_norm_年度', '_norm_授業名', '_norm_教員名'}
+    # 最新の年度から必要な分だけ読む
+    assert store.head(2)['授業名'].tolist() == ['憲法', '民法3']
+
+
+def test_search_matches_sorted_search_df(tmp_path, write_year):
+    _write_years(tmp_path, write_year)
+    pd.DataFrame({'年度': [2018, 2016, None], '授業名': ['民法4', '商法', '民法5'], '教員名': ['森田', '森田', '森田']}).to_csv(tmp_path / 'extra.csv', index=False)
+    store = PartitionedStore(tmp_path)
+    assert store.years() == [2018, 2017, 2016, 2015, None]
+
+    df = add_normalized_columns(pd.concat([pd.read_csv(p) for p in sorted(tmp_path.glob('*.csv'))], ignore_index=True))
+    for filters, combine in [
+        ([('授業名', '民法')], 'AND'),
+        ([('年度', '2016-2017', 'range'), ('教員名', '森田', 'exact')], 'OR'),
+        ([('年度', '2018', 'range'), ('教員名', '森田')], 'AND'),
+        ([], 'AND'),
+    ]:
+        expected = search_df(df, filters, combine)
+        expected = expected.iloc[pd.to_numeric(expected['年度']).reset_index(drop=True)
+                                 .sort_values(ascending=False, kind='stable').index]
+        got = store.search(filters, combine)
+        assert drop_normalized_columns(got)['授業名'].tolist() == expected['授業名'].tolist()
+
+
+def test_refresh_drops_only_changed_partitions(tmp_path, write_year):
+    _write_years(tmp_path, write_year)
+    store = PartitionedStore(tmp_path)
+    store.search([('授業名', '民法')])
+    version = store.version
+    assert store.refresh() is False
+    write_year(tmp_path, 2016, [('民法2', '佐藤'), ('行政法', '太田')])
+    assert store.refresh() is True
+    assert store.version != version
+    assert store.loaded_years == [2017, 2015]
+    assert len(store.search([('年度', '2016', 'range')])) == 2
+
+
+def test_compact_store_gives_same_results_from_shared_frame(tmp_path, write_year):
+    _write_years(tmp_path, write_year)
+    store = PartitionedStore(tmp_path)
+    compact = PartitionedStore(tmp_path, compact=True)
+    for filters, combine in [([('授業名', '民法')], 'AND'), ([('年度', '2016', 'range'), ('教員名', '森田')], 'OR'), ([], 'AND')]:
+        expected = drop_normalized_columns(store.search(filters, combine)).reset_index(drop=True)
+        base, positions = compact.search_positions(filters, combine)
+        got = drop_normalized_columns(base.iloc[positions]).reset_index(drop=True)
+        assert got.astype(object).equals(expected.astype(object)), filters
+    base = compact.base().frame
+    assert base['年度'].dtype == 'int16'
+    # パーティションは共有フレームの一部で、結果ごとに行をコピーしない
+    assert compact.search_positions([('授業名', '民法')], 'AND')[0] is base
+    assert compact.head(2)['授業名'].tolist() == ['憲法', '民法3']
@@ -0,0 +1,113 @@
+import pandas as pd
+from kakodata_utils import search_df
+from normalize import add_normalized_columns
+from query_cache import QueryCache
+
+
+def _df():
+    return add_normalized_columns(pd.DataFrame({
+        '年度': [2015, 2017, 2016, 2017, 2015],
+        '授業名': ['民法1', '上級民法2', '刑法', '基本科目民法3', '民法2'],
+        '教員名': ['森田', '中原', '佐伯', '小粥', '森田'],
+    }))
+
+
+def test_hit_and_sorted_result():
+    df = _df()
+    cache = QueryCache(maxsize=2)
+    r1 = cache.search(df, 'v1', [('授業名', '民法')], sort_col='年度')
+    assert r1.hit == 'miss'
+    assert list(r1.frame['授業名']) == ['上級民法2', '基本科目民法3', '民法1', '民法2']
+    assert '_norm_授業名' not in r1.frame.columns
+    assert r1.csv_bytes == r1.frame.to_csv(index=False).encode('utf-8-sig')
+
+    # 正規化後に同じクエリはキャッシュを共有する
+    r2 = cache.search(df, 'v1', [('授業名', '民法'), ('教員名', '  ')], sort_col='年度')
+    assert r2.hit == 'hit'
+    # データバージョンが変わればキャッシュは使わない
+    assert cache.search(df, 'v2', [('授業名', '民法')], sort_col='年度').hit == 'miss'
+    assert len(cache) == 2
+    # exact は前後の空白を除いたクエリで共有する
+    assert cache.search(df, 'v2', [('教員名', ' 森田 ', 'exact')]).hit == 'miss'
+    assert cache.search(df, 'v2', [('教員名', '森田', 'exact')]).hit == 'hit'
+
+
+def test_refinement_only_searches_cached_rows():
+    df = _df()
+    cache = QueryCache()
+    calls = []
+
+    def full_search(filters, combine):
+        calls.append(filters)
+        return search_df(df, filters, combine=combine)
+
+    cache.search(df, 'v1', [('授業名', '民')], search_fn=full_search, sort_col='年度')
+    r = cache.search(df, 'v1', [('授業名', '民法2')], search_fn=full_search, sort_col='年度')
+    assert r.hit == 'refined'
+    assert len(calls) == 1
+    expected = search_df(df, [('授業名', '民法2')])
+    assert sorted(r.positions) == list(expected.index)
+
+    # 正規表現は絞り込みとみなさない
+    r = cache.search(df, 'v1', [('授業名', '民法[12]', 'regex')], search_fn=full_search)
+    assert r.hit == 'miss'
+
+
+def test_search_store_refines_same_year_range(tmp_path):
+    from partition_store import PartitionedStore
+    df = _df().drop(columns=[c for c in _df().columns if c.startswith('_norm_')])
+    for year, part in df.groupby('年度'):
+        part.to_csv(tmp_path / f'kakodata_{year}.csv', index=False)
+    store = PartitionedStore(tmp_path)
+    cache = QueryCache()
+    r1 = cache.search_store(store, [('年度', '2016-2017', 'range'), ('授業名', '民法')])
+    assert r1.hit == 'miss'
+    assert list(r1.frame['授業名']) == ['上級民法2', '基本科目民法3']
+    r2 = cache.search_store(store, [('年度', '2016-2017', 'range'), ('授業名', '民法3')])
+    assert r2.hit == 'refined'
+    assert list(r2.frame['授業名']) == ['基本科目民法3']
+    r3 = cache.search_store(store, [('年度', '2015-2017', 'range'), ('授業名', '民法')])
+    assert r3.hit == 'miss' and r3.total == 4
+    # パーティションをまたいでページを取り出す
+    assert list(r3.page(1, 2)['授業名']) == ['基本科目民法3', '民法1']
+    # エントリは結果の行のコピーを持たず、パーティションのフレームと行位置の組だけを持つ
+    parts = {id(store.partition(y).df) for y in store.years()}
+    for segments, _ in cache._entries.values():
+        assert all(id(df) in parts for df, _ in segments)
+
+
+def test_year_range_does_not_depend_on_cache_history(tmp_path):
+    from partition_store import PartitionedStore
+    # ファイル名の年度と違う年度の行を含む
+    pd.DataFrame({'年度': [2018, 2019], '授業名': ['民法1', '民法2']}).to_csv(tmp_path / 'kakodata_2019.csv', index=False)
+    pd.DataFrame({'年度': [2020], '授業名': ['民法3']}).to_csv(tmp_path / 'kakodata_2020.csv', index=False)
+    for compact in (False, True):
+        store = PartitionedStore(tmp_path, compact=compact)
+        cold = QueryCache().search_store(store, [('年度', '2019-2020', 'range'), ('授業名', '民法')])
+        cache = QueryCache()
+        cache.search_store(store, [('年度', '2018-2020', 'range'), ('授業名', '民法')])
+        warm = cache.search_store(store, [('年度', '2019-2020', 'range'), ('授業名', '民法')])
+        assert warm.hit == 'miss' and warm.total == cold.total == 3
+        # 同じ範囲なら文字列の条件だけで絞り込む
+        r = cache.search_store(store, [('年度', '2019-2020', 'range'), ('授業名', '民法2')])
+        assert r.hit == 'refined' and list(r.frame['授業名']) == ['民法2']
+
+
+def test_search_store_compact_keeps_only_positions(tmp_path):
+    from partition_store import PartitionedStore
+    df = _df().drop(columns=[c for c in _df().columns if c.startswith('_norm_')])
+    for year, part in df.groupby('年度'):
+        part.to_csv(tmp_path / f'kakodata_{year}.csv', index=False)
+    store = PartitionedStore(tmp_path, compact=True)
+    cache = QueryCache()
+    r1 = cache.search_store(store, [('授業名', '民法')])
+    assert r1.hit == 'miss' and r1.total == 4
+    assert list(r1.page(1, 2)['授業名']) == ['基本科目民法3', '民法1']
+    assert list(r1.frame.columns) == ['年度', '授業名', '教員名']
+    # CSVは初めて使うときに作り、キャッシュにも残る
+    csv = r1.csv_bytes
+    r2 = cache.search_store(store, [('授業名', '民法')])
+    assert r2.hit == 'hit' and r2.csv_bytes is csv
+    r3 = cache.search_store(store, [('授業名', '民法2')])
+    assert r3.hit == 'refined'
+    assert list(r3.frame['授業名']) == ['上級民法2', '民法2']
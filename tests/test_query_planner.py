@@ -0,0 +1,100 @@
+import numpy as np
+import pandas as pd
+from db_utils import import_csv_to_db, get_db, search_db, explain_db
+from kakodata_utils import search_df, encode_columns, plan_df, explain_df
+from ngram_index import NgramIndex
+from normalize import add_normalized_columns
+from query_planner import make_plan
+
+
+def _df(n=2000):
+    # 授業名は '民法' が1/4、'刑法' が3/4。教員名は '森田' が1/100
+    return add_normalized_columns(pd.DataFrame({
+        '年度': [2015 + i % 10 for i in range(n)],
+        '授業名': ['民法' if i % 4 == 0 else '刑法' for i in range(n)],
+        '教員名': ['森田' if i % 100 == 0 else f"教員{i % 37}" for i in range(n)],
+    }))
+
+
+def test_orders_and_short_circuits():
+    calls = []
+
+    def estimate(step, rank):
+        step.estimate = {'a': 0.5, 'b': 0.01, 'c': None}[step.col]
+
+    def evaluate(step, positions):
+        calls.append((step.col, None if positions is None else len(positions)))
+        n = 10 if positions is None else len(positions)
+        return np.zeros(n, dtype=bool) if step.col == 'b' else np.ones(n, dtype=bool)
+
+    plan = make_plan([('a', 'x', 'contains'), ('c', 'x', 'contains'), ('b', 'x', 'contains')], 'AND', 10, estimate)
+    assert [s.col for s in plan.steps] == ['b', 'a', 'c']
+    assert len(plan.execute(evaluate)) == 0
+    # 最初のフィルタで候補が0行になったので残りは評価しない
+    assert calls == [('b', None)]
+    assert [s.skipped for s in plan.steps] == [False, True, True]
+
+    calls.clear()
+    plan = make_plan([('b', 'x', 'contains'), ('a', 'x', 'contains')], 'OR', 10, estimate)
+    assert [s.col for s in plan.steps] == ['a', 'b']
+    assert list(plan.execute(evaluate)) == list(range(10))
+    # 全行が一致した後のフィルタは評価しない
+    assert calls == [('a', None)]
+
+
+def test_search_df_plan_matches_unplanned_result():
+    for df in (_df(), encode_columns(_df())):
+        filters = [('授業名', '刑法'), ('教員名', '森田', 'exact'), ('年度', '2015-2016', 'range')]
+        plan = plan_df(df, filters)
+        assert [s.col for s in plan.steps][0] == '教員名'
+        for combine in ('AND', 'OR'):
+            expected = df[(df['授業名'] == '刑法') & (df['教員名'] == '森田') & (df['年度'] <= 2016)] if combine == 'AND' \
+                else df[(df['授業名'] == '刑法') | (df['教員名'] == '森田') | (df['年度'] <= 2016)]
+            pd.testing.assert_frame_equal(search_df(df, filters, combine=combine), expected)
+            pd.testing.assert_frame_equal(NgramIndex(df).search(filters, combine=combine), expected)
+
+    text = explain_df(_df(), [('存在しない列', 'x'), ('授業名', '民法')])
+    assert 'missing' in text and 'skipped' in text
+
+
+def test_explain_shows_rows_per_step():
+    df = encode_columns(_df())
+    text = explain_df(df, [('授業名', '民法'), ('教員名', '森田', 'exact')])
+    lines = text.splitlines()
+    assert lines[0] == 'AND over 2000 rows'
+    assert '教員名 exact' in lines[1] and 'rows 2000 -> 20' in lines[1]
+    assert '授業名 contains' in lines[2] and 'rows 20 -> 20' in lines[2]
+    assert '教員名 exact' in NgramIndex(df).explain([('授業名', '民法'), ('教員名', '森田', 'exact')]).splitlines()[1]
+
+
+def test_search_db_plan_and_early_exit(tmp_path):
+    csv = tmp_path / 'k.csv'
+    _df().drop(columns=[c for c in _df().columns if c.startswith('_norm_')]).to_csv(csv, index=False)
+    db = str(tmp_path / 'k.db')
+    import_csv_to_db(str(csv), db)
+    kdb = get_db(db)
+    text = kdb.explain([('授業名', '刑法'), ('教員名', '森田', 'exact')])
+    assert text.splitlines()[1].startswith('  1. 教員名 exact')
+    assert 'EXPLAIN' not in text and 'kakodata_exact' in text
+    assert len(search_db(db, [('授業名', '刑法'), ('教員名', '森田', 'exact')])) == 0
+    assert len(search_db(db, [('授業名', '民法'), ('教員名', '森田', 'exact')])) == 20
+    # 完全一致が0件なら SQL を実行しない
+    assert explain_db(db, [('教員名', '該当なし', 'exact'), ('授業名', '民法')]).endswith('(empty: not executed)')
+    res = search_db(db, [('教員名', '該当なし', 'exact'), ('授業名', '民法')])
+    assert res.empty and list(res.columns) == ['年度', '授業名', '教員名']
+    kdb.close()
+
+
+def test_search_db_plan_with_invalid_or_python_only_regex(tmp_path):
+    csv = tmp_path / 'k.csv'
+    _df().drop(columns=[c for c in _df().columns if c.startswith('_norm_')]).to_csv(csv, index=False)
+    db = str(tmp_path / 'k.db')
+    import_csv_to_db(str(csv), db)
+    kdb = get_db(db)
+    # 不正な正規表現は見積もらない（計画を作るところでは失敗しない）
+    steps = {s.col: s for s in kdb.plan([('授業名', '(民'), ('教員名', '[', 'regex')]).steps}
+    assert steps['教員名'].estimate is None
+    # 検索と同じく Python の re で見積もる（先読みは RE2 では書けない）
+    steps = {s.col: s for s in kdb.plan([('授業名', '民法'), ('教員名', '森(?=田)', 'regex')]).steps}
+    assert steps['教員名'].estimate == 0.01
+    kdb.close()
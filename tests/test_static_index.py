@@ -0,0 +1,70 @@
+import json
+from normalize import normalize_text
+from static_index import build_static_index, StaticIndex, MANIFEST_NAME
+
+
+def _data(tmp_path, write_year):
+    data = tmp_path / 'data'
+    data.mkdir()
+    write_year(data, 2018, [('民法1', '森田'), ('刑法', '佐伯'), ('ローマ法', '木庭')])
+    write_year(data, 2019, [('上級民法Ⅱ', '中原・森田'), ('憲法', '宍戸')])
+    write_year(data, 2020, [('民法3', '小粥'), ('ﾃﾞｰﾀ法', '森')])
+    return data
+
+
+def _brute(rows, query):
+    words = [normalize_text(w) for w in query.split()]
+    return [r for r in rows if all(any(w in normalize_text(str(v)) for v in r) for w in words)]
+
+
+def test_search_matches_linear_scan(tmp_path, write_year):
+    data = _data(tmp_path, write_year)
+    manifest = build_static_index(str(data), str(tmp_path / 'out'), shard_bytes=64)
+    assert manifest['rows'] == 7 and len(manifest['shards']) > 1
+    assert [p['year'] for p in manifest['partitions']] == [2020, 2019, 2018]
+
+    all_rows = []
+    for p in manifest['partitions']:
+        all_rows += json.loads((tmp_path / 'out' / p['file']).read_text(encoding='utf-8'))
+    for q in ['法', '民法', '森田', '民法 森田', '民法2', 'データ', 'ﾐﾝ', '2019', '存在しない', '法　2018']:
+        assert StaticIndex(str(tmp_path / 'out')).search(q) == _brute(all_rows, q.replace('　', ' ')), q
+
+
+def test_fetches_only_needed_files(tmp_path, write_year):
+    data = _data(tmp_path, write_year)
+    build_static_index(str(data), str(tmp_path / 'out'), shard_bytes=64)
+    ix = StaticIndex(str(tmp_path / 'out'))
+    assert ix.search('憲法') == [[2019, '憲法', '宍戸']]
+    rows_files = [f for f in ix.fetched if f.startswith('rows/')]
+    assert rows_files == [p['file'] for p in ix.manifest['partitions'] if p['year'] == 2019]
+    assert len([f for f in ix.fetched if f.startswith('postings/')]) <= 2
+    # 1つもヒットしなければ行のファイルは取得しない
+    ix = StaticIndex(str(tmp_path / 'out'))
+    assert ix.search('存在しない') == []
+    assert not [f for f in ix.fetched if f.startswith('rows/')]
+
+
+def test_rebuild_keeps_previous_generation_and_removes_older(tmp_path, write_year):
+    data = _data(tmp_path, write_year)
+    out = tmp_path / 'out'
+    m1 = build_static_index(str(data), str(out))
+    write_year(data, 2020, [('民法3', '小粥'), ('ﾃﾞｰﾀ法', '森'), ('行政法', '北島')])
+    m2 = build_static_index(str(data), str(out))
+    files1 = {p['year']: p['file'] for p in m1['partitions']}
+    files2 = {p['year']: p['file'] for p in m2['partitions']}
+    # 変わった年度のファイルだけ名前が変わる
+    assert files1[2018] == files2[2018] and files1[2019] == files2[2019]
+    assert files1[2020] != files2[2020]
+    # 前の世代のマニフェストが参照するファイルは残す
+    on_disk = {f"{f.parent.name}/{f.name}" for f in out.glob('*/*.json')}
+    gen1 = set(m1['shards']) | set(files1.values())
+    gen2 = set(m2['shards']) | set(files2.values())
+    assert on_disk == gen1 | gen2
+    assert json.loads((out / MANIFEST_NAME).read_text(encoding='utf-8')) == m2
+    # 2世代前だけが参照するファイルは消す
+    write_year(data, 2020, [('民法4', '小粥')])
+    m3 = build_static_index(str(data), str(out))
+    gen3 = set(m3['shards']) | {p['file'] for p in m3['partitions']}
+    on_disk = {f"{f.parent.name}/{f.name}" for f in out.glob('*/*.json')}
+    assert on_disk == gen2 | gen3
+    assert files1[2020] not in on_disk
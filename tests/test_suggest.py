@@ -0,0 +1,39 @@
+import pandas as pd
+from suggest import Suggester, TEACHER_SEP
+
+
+def _suggester():
+    df = pd.DataFrame({
+        '授業名': ['基本科目民法1', '基本科目民法1', '上級民法2', '民事訴訟法', 'ﾐﾝﾎﾟｳ演習'],
+        '教員名': ['森田修', '森田宏樹・石川博康', '森田宏樹', '畑瑞穂', None],
+    })
+    return Suggester(df, {'授業名': None, '教員名': TEACHER_SEP})
+
+
+def test_prefix_is_ranked_by_frequency_and_splits_teachers():
+    s = _suggester()
+    assert s.suggest('教員名', '森田') == [('森田宏樹', 2), ('森田修', 1)]
+    assert s.suggest('教員名', '石川') == [('石川博康', 1)]
+    assert s.suggest('教員名', '森田', k=1) == [('森田宏樹', 2)]
+    assert s.suggest('教員名', '') == []
+    assert s.suggest('存在しない列', '森') == []
+
+
+def test_infix_and_normalized_matching():
+    s = _suggester()
+    assert [v for v, _ in s.suggest('授業名', '民法')] == []
+    assert [v for v, _ in s.suggest('授業名', '民法', infix=True)] == ['基本科目民法1', '上級民法2']
+    # 前方一致の候補が先に並ぶ
+    assert [v for v, _ in s.suggest('授業名', '民', infix=True)][0] == '民事訴訟法'
+    assert s.suggest('授業名', 'みんぽう') == [('ﾐﾝﾎﾟｳ演習', 1)]
+
+
+def test_from_store_counts_without_loading_partitions(tmp_path):
+    from partition_store import PartitionedStore
+    pd.DataFrame({'年度': [2015, 2015], '教員名': ['森田宏樹', '森田修']}).to_csv(tmp_path / 'kakodata_2015.csv', index=False)
+    pd.DataFrame({'年度': [2016], '教員名': ['森田宏樹・石川博康']}).to_csv(tmp_path / 'kakodata_2016.csv', index=False)
+    store = PartitionedStore(tmp_path)
+    columns = {'教員名': TEACHER_SEP}
+    s = Suggester.from_counts({c: store.value_counts(c) for c in columns}, columns)
+    assert s.suggest('教員名', '森田') == [('森田宏樹', 2), ('森田修', 1)]
+    assert store.loaded_years == []
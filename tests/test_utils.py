@@ -1,5 +1,7 @@
+import pytest
 import pandas as pd
-from kakodata_utils import search_df
+import kakodata_utils
+from kakodata_utils import search_df, append_row, append_rows, load_csvs_from_dir, encode_columns, parse_year_range
 
 
 def test_search_single_column():
@@ -31,3 +33,69 @@ def test_search_startswith_and_regex():
     assert len(res1) == 2
     res2 = search_df(df, [('notes', '^abc', 'regex')])
     assert len(res2) == 1
+
+
+def test_append_rows_streams_to_end(tmp_path):
+    path = tmp_path / 'kakodata_2024.csv'
+    pd.DataFrame({'年度': [2024], '授業名': ['民法'], '教員名': ['森田']}).to_csv(path, index=False)
+    append_row(str(path), {'授業名': '刑法', '年度': 2024, '教員名': '田中'})
+    append_rows(str(path), [{'年度': 2024, '授業名': '憲法'}, {'年度': 2024, '授業名': '商法', '教員名': '鈴木'}])
+
+    df = pd.read_csv(path)
+    assert list(df['授業名']) == ['民法', '刑法', '憲法', '商法']
+    assert pd.isna(df.iloc[2]['教員名'])
+    journal = tmp_path / 'kakodata_2024.csv.journal.jsonl'
+    assert len(journal.read_text(encoding='utf-8').splitlines()) == 3
+    # バックアップやジャーナルはデータとして読み込まれない
+    assert len(load_csvs_from_dir(tmp_path)) == 4
+
+    with pytest.raises(ValueError):
+        append_row(str(path), {'年度': 2024, '備考': 'x'})
+
+
+def test_journal_rotation_is_bounded(tmp_path, monkeypatch):
+    monkeypatch.setattr(kakodata_utils, 'JOURNAL_MAX_BYTES', 0)
+    path = tmp_path / 'data.csv'
+    for i in range(6):
+        append_row(str(path), {'subject': f'科目{i}'})
+    assert len(pd.read_csv(path)) == 6
+    journals = sorted(p.name for p in tmp_path.glob('data.csv.journal.jsonl*'))
+    assert len(journals) == 1 + kakodata_utils.JOURNAL_BACKUP_COUNT
+    assert (tmp_path / 'data.csv.bak').exists()
+
+
+def test_encoded_columns_give_same_results():
+    df = pd.DataFrame({
+        'year': [2015, 2016, 2017, 2018, 2019],
+        'subject': ['民法', '民法', '刑法', '民法', None],
+        'teacher': ['森田', '森田', '田中', '佐藤', '森田'],
+    })
+    enc = encode_columns(df)
+    assert isinstance(enc['subject'].dtype, pd.CategoricalDtype)
+    assert not isinstance(enc['year'].dtype, pd.CategoricalDtype)
+    for filters, combine in [
+        ([('subject', '民', 'contains')], 'AND'),
+        ([('subject', '刑', 'startswith'), ('teacher', '^森', 'regex')], 'OR'),
+        ([('subject', '民法'), ('teacher', '田')], 'AND'),
+    ]:
+        assert list(search_df(enc, filters, combine).index) == list(search_df(df, filters, combine).index)
+
+
+def test_exact_mode_matches_whole_value_and_each_teacher():
+    df = pd.DataFrame({
+        '授業名': ['民法(1)', '民法(1)演習', '民法Ⅰ'],
+        '教員名': ['小粥太郎・石川博康', '石川博康', '小粥太郎'],
+    })
+    assert list(search_df(df, [('授業名', '民法(1)', 'exact')]).index) == [0]
+    assert list(search_df(df, [('教員名', '石川博康', 'exact')]).index) == [0, 1]
+    assert list(search_df(df, [('教員名', '小粥太郎・石川博康', 'exact')]).index) == [0]
+    assert search_df(df, [('教員名', '石川', 'exact')]).empty
+
+
+def test_range_mode_and_parse_year_range():
+    assert parse_year_range('2019-2023') == (2019, 2023)
+    assert parse_year_range('２０２０〜') == (2020, None)
+    assert parse_year_range('20') is None
+    df = pd.DataFrame({'年度': [2018, 2019, 2023, None], '授業名': ['a', 'b', 'c', 'd']})
+    assert list(search_df(df, [('年度', '2019-2023', 'range')]).index) == [1, 2]
+    assert list(search_df(df, [('年度', '-2018', 'range')]).index) == [0]